@@ -0,0 +1,164 @@
+import argparse
+import contextlib
+import io
+from time import perf_counter
+
+import numpy as np
+
+import usm_constproduct
+
+# Compares usm_constproduct.Pool.execute_batch() with applying the same ops one at a time: throughput, and how far the batched outcomes differ.  The workload is a run of timestamps (blocks), each
+# with a price move and many ops from a population of users.  Reports:
+# 1. Ops/sec for the whole run, sequential vs batched.
+# 2. Per batch, from the same starting state (forked and rolled back): each op's result batched vs sequential, and sequential in a shuffled order vs sequential - the latter being how much
+#    the outcome already depends on the order the ops happen to arrive in.
+# 3. The final states of the two whole runs, and the users' final balances.
+
+OPS = ('mint', 'burn', 'fund_eth', 'defund')
+model = usm_constproduct.Pool()
+FUNCTIONS = {command: getattr(model, function) for command, function in model.BATCH_COMMANDS.items()}
+
+def setup(users, rng):
+    # A pool where every user holds some USM and FUM, with the adjustments from getting there decayed away:
+    model.reset_state()
+    model.set_oracle_eth_price(200)
+    initial = {}
+    for user in users:
+        model.mint_usm(user, rng.lognormal(0, 1))
+        model.create_fum_from_eth(user, rng.lognormal(0, 1))
+        model.set_time(model.time + 1)
+    model.set_time(model.time + 100 * model.BUY_SELL_ADJUSTMENTS_HALF_LIFE)
+    model.prepare_for_next_command()
+    for user in users:
+        initial[user] = (model.usm_holdings[user], model.fum_holdings[user])
+    return initial
+
+def workload(users, initial, timestamps, ops_per_timestamp, rng, block_seconds=13, volatility=0.002):
+    # [(seconds to wait, new price, [(command, user, amount), ...]), ...].  Burn/defund sizes are small fractions of the user's starting balance, so few are rejected for lack of funds.
+    price = 200
+    blocks = []
+    for _ in range(timestamps):
+        price *= rng.lognormal(0, volatility)
+        commands = rng.choice(OPS, ops_per_timestamp)
+        chosen = rng.integers(len(users), size=ops_per_timestamp)
+        fractions = rng.uniform(0, 0.02, ops_per_timestamp)
+        eth_sizes = rng.lognormal(-3, 1, ops_per_timestamp)
+        ops = []
+        for command, user_index, fraction, eth in zip(commands.tolist(), chosen.tolist(), fractions.tolist(), eth_sizes.tolist()):
+            user = users[user_index]
+            amount = eth if command in ('mint', 'fund_eth') else initial[user][command == 'defund'] * fraction
+            ops.append((command, user, amount))
+        blocks.append((block_seconds, price, ops))
+    return blocks
+
+def start_block(wait, price):
+    model.prepare_for_next_command()
+    model.set_time(model.time + wait)
+    model.set_oracle_eth_price(price)
+
+def run_sequential(ops):
+    results = []
+    for command, user, amount in ops:
+        model.prepare_for_next_command()
+        try:
+            results.append(FUNCTIONS[command](user, amount))
+        except Exception as err:
+            results.append(err)
+    model.prepare_for_next_command()
+    return results
+
+def run_batched(ops):
+    results = model.execute_batch(ops)
+    model.prepare_for_next_command()
+    return results
+
+def state():
+    return {'pool_eth': model.pool_eth, 'usm_supply': model.usm_supply, 'fum_supply': model.fum_supply, 'debt_ratio': model.debt_ratio(),
+            'mint_burn_adjustment': model.mint_burn_adjustment(), 'fund_defund_adjustment': model.fund_defund_adjustment(), 'fum_mid_price': model.calc_fum_price(model.MID),
+            'min_fum_buy_price_in_eth': model.min_fum_buy_price_in_eth()}
+
+def run(blocks, execute):
+    start = perf_counter()
+    for wait, price, ops in blocks:
+        start_block(wait, price)
+        execute(ops)
+    return perf_counter() - start
+
+def result_differences(ops, results, baseline):
+    # {command: array of relative differences of results from baseline}, over the ops that succeeded in both:
+    differences = {command: [] for command in OPS}
+    for (command, _, _), result, base in zip(ops, results, baseline):
+        if not isinstance(result, Exception) and not isinstance(base, Exception) and base != 0:
+            differences[command].append(result / base - 1)
+    return differences
+
+def summarize(name, differences):
+    print("{:<32} {:>9} {:>12} {:>12} {:>12} {:>12}".format(name, "ops", "mean", "median |d|", "p99 |d|", "max |d|"))
+    for command in OPS:
+        values = np.array(differences[command])
+        if len(values):
+            print("  {:<30} {:>9,} {:>+12.4%} {:>12.4%} {:>12.4%} {:>12.4%}".format(command, len(values), values.mean(), np.median(np.abs(values)), np.percentile(np.abs(values), 99),
+                                                                          np.abs(values).max()))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark usm_constproduct.Pool.execute_batch() against sequential execution, and report how far their outcomes diverge.")
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--timestamps', type=int, default=100)
+    parser.add_argument('--ops-per-timestamp', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    users = ['user{}'.format(i) for i in range(args.users)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        initial = setup(users, rng)
+    blocks = workload(users, initial, args.timestamps, args.ops_per_timestamp, rng)
+    total_ops = args.timestamps * args.ops_per_timestamp
+
+    # 1. Throughput, and 3. the final states, of two whole runs from the same start:
+    final_states, final_holdings, elapsed = {}, {}, {}
+    for name, execute in (('sequential', run_sequential), ('batched', run_batched)):
+        with contextlib.redirect_stdout(io.StringIO()):
+            initial = setup(users, np.random.default_rng(args.seed))
+            elapsed[name] = run(blocks, execute)
+        final_states[name] = state()
+        final_holdings[name] = np.array([[model.usm_holdings.get(user, 0), model.fum_holdings.get(user, 0)] for user in users])
+        print("{:<12} {:,} ops in {:,} batches of {:,}: {:.3f}s = {:,.0f} ops/sec".format(name, total_ops, args.timestamps, args.ops_per_timestamp, elapsed[name], total_ops / elapsed[name]))
+    print("Speedup: {:.2f}x".format(elapsed['sequential'] / elapsed['batched']))
+    print()
+
+    # 2. Batch by batch, from the same state each time (the batched run's):
+    batched_vs_sequential = {command: [] for command in OPS}
+    shuffled_vs_sequential = {command: [] for command in OPS}
+    with contextlib.redirect_stdout(io.StringIO()):
+        setup(users, np.random.default_rng(args.seed))
+        for wait, price, ops in blocks:
+            start_block(wait, price)
+            sequential = model.what_if(run_sequential, ops)
+            order = rng.permutation(len(ops))
+            shuffled = model.what_if(run_sequential, [ops[i] for i in order])
+            unshuffled = [None] * len(ops)
+            for position, i in enumerate(order):
+                unshuffled[i] = shuffled[position]
+            batched = run_batched(ops)
+            for differences, results in ((batched_vs_sequential, batched), (shuffled_vs_sequential, unshuffled)):
+                for command, values in result_differences(ops, results, sequential).items():
+                    differences[command].extend(values)
+    print("Per-op results, relative to the same ops applied one at a time in arrival order, from the same state:")
+    summarize("batched", batched_vs_sequential)
+    summarize("sequential, shuffled order", shuffled_vs_sequential)
+    print()
+
+    print("Final state after the whole run:")
+    print("  {:<26} {:>22} {:>22} {:>12}".format("", "sequential", "batched", "difference"))
+    for key in final_states['sequential']:
+        sequential, batched = final_states['sequential'][key], final_states['batched'][key]
+        print("  {:<26} {:>22,.6f} {:>22,.6f} {:>+12.4%}".format(key, sequential, batched, batched / sequential - 1 if sequential else 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        balance_differences = np.abs(final_holdings['batched'] / final_holdings['sequential'] - 1)
+    for column, token in enumerate(('USM', 'FUM')):
+        values = balance_differences[:, column][np.isfinite(balance_differences[:, column])]
+        print("  Users' final {} balances: median |difference| {:.4%}, p99 {:.4%}, max {:.4%}".format(token, np.median(values), np.percentile(values, 99), values.max()))
+
+if __name__ == '__main__':
+    main()
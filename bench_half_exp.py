@@ -0,0 +1,48 @@
+import argparse
+import random
+from time import perf_counter
+
+import usm_constproduct
+
+# Compares the accuracy, speed and multiplication count of the ways usm_constproduct.py can compute 0.5**power: exact floats, half_exp_approx()'s round-to-tenths repeated squaring
+# (the APPROXIMATE_TO_SAVE_GAS path), and half_exp_table_approx() at various table resolutions.  Each approximation is run as a pool with those settings runs it (Pool.half_exp()), so
+# nothing here changes usm_constproduct's own state.
+
+def tenths_multiplications(power_shifted):
+    # Number of fixed-point multiplications half_to_the_one_tenth_exp_approx() does: one squaring per level of recursion, plus one more for each odd level.
+    power = (int(power_shifted) + usm_constproduct.ONE_TENTH_SHIFTED // 2) // usm_constproduct.ONE_TENTH_SHIFTED
+    return power.bit_length() + bin(power).count('1')
+
+def table_multiplications(power_shifted, bits):
+    power_in_units = (int(power_shifted) * 2**bits + usm_constproduct.ONE_SHIFTED // 2) // usm_constproduct.ONE_SHIFTED
+    return bin(power_in_units & ((1 << bits) - 1)).count('1')
+
+def measure(name, approx, powers, multiplications=None):
+    start = perf_counter()
+    results = [approx(power) for power in powers]
+    elapsed = perf_counter() - start
+    errors = [abs(result - 0.5 ** power) / 0.5 ** power for result, power in zip(results, powers)]
+    average_multiplications = "" if multiplications is None else "{:.1f}".format(sum(map(multiplications, powers)) / len(powers))
+    print("{:<22} {:>12.3g} {:>12.3g} {:>12.3f} {:>10}".format(name, max(errors), sum(errors) / len(errors), elapsed / len(powers) * 1e6, average_multiplications))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the 0.5**power approximations in usm_constproduct.py.")
+    parser.add_argument('-n', type=int, default=100000, help="number of random powers to try")
+    parser.add_argument('--max-power', type=float, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    powers = [rng.uniform(0, args.max_power) for _ in range(args.n)]
+    print("{:<22} {:>12} {:>12} {:>12} {:>10}".format("method", "max rel err", "mean rel err", "us/call", "mults/call"))
+    measure("exact (0.5 ** power)", lambda power: 0.5 ** power, powers)
+    pool = usm_constproduct.Pool(APPROXIMATE_TO_SAVE_GAS=True)
+    measure("tenths (recursive)", lambda power: pool.half_exp(power * usm_constproduct.ONE_SHIFTED) / usm_constproduct.ONE_SHIFTED, powers,
+            lambda power: tenths_multiplications(power * usm_constproduct.ONE_SHIFTED))
+    for bits in (4, 8, 12, 16, 24, 32):
+        pool = usm_constproduct.Pool(APPROXIMATE_TO_SAVE_GAS=True, USE_HALF_EXP_TABLE=True, HALF_EXP_TABLE_BITS=bits)
+        measure("table, 1/2**{} steps".format(bits), lambda power: pool.half_exp(power * usm_constproduct.ONE_SHIFTED) / usm_constproduct.ONE_SHIFTED, powers,
+                lambda power: table_multiplications(power * usm_constproduct.ONE_SHIFTED, bits))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import argparse
+import contextlib
+import io
+from time import perf_counter
+import tracemalloc
+
+import numpy as np
+
+import usm_constproduct
+import usm_ledger
+
+# Compares the memory and speed of the models' holdings dicts with usm_ledger.Ledger, at millions of holders: bytes per holder, bulk credit/debit, a top-N query, the status_summary() printout,
+# and ops run one at a time through usm_constproduct.py.  Dicts are measured at a smaller size by default (--dict-holders), since at 10M they need several GB.
+
+def traced_bytes(build):
+    tracemalloc.start()
+    try:
+        result = build()
+        return result, tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+def build_dicts(n):
+    usm_holdings, fum_holdings = {}, {}
+    for i in range(n):
+        name = 'user{}'.format(i)
+        usm_holdings[name] = float(i)
+        fum_holdings[name] = float(i) / 2
+    return usm_holdings, fum_holdings
+
+def build_ledger(n):
+    ledger = usm_ledger.Ledger()
+    holder_ids = np.arange(n)
+    ledger.usm.credit(holder_ids, holder_ids.astype(float))
+    ledger.fum.credit(holder_ids, holder_ids / 2)
+    return ledger
+
+def timed(name, f, count=1):
+    start = perf_counter()
+    result = f()
+    elapsed = perf_counter() - start
+    print("{:<56} {:>12.3f} ms {:>16}".format(name, elapsed * 1000, "" if count == 1 else "{:,.0f}/sec".format(count / elapsed)))
+    return result
+
+def run_ops(model, users, ops):
+    # mint then burn for a stream of users, one op at a time: the models' per-op path through usm_holdings.get()/[] and the supply totals.
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(ops):
+            user = users[i % len(users)]
+            model.mint_usm(user, 1)
+            model.burn_usm(user, model.usm_holdings.get(user, 0) / 2)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark usm_ledger.Ledger against holdings dicts.")
+    parser.add_argument('--holders', type=int, default=10_000_000)
+    parser.add_argument('--dict-holders', type=int, default=1_000_000)
+    parser.add_argument('--ops', type=int, default=200_000, help="mint/burn pairs to run through usm_constproduct.py, with each kind of holdings")
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    print("{:<56} {:>15} {:>16}".format("", "time", "throughput"))
+    (usm_holdings, fum_holdings), dict_bytes = traced_bytes(lambda: build_dicts(args.dict_holders))
+    ledger, ledger_bytes = traced_bytes(lambda: build_ledger(args.holders))
+    print("Memory: dicts {:,.1f} bytes/holder (at {:,}), ledger {:,.1f} bytes/holder (at {:,}; {:,.1f} for the balance arrays alone)".format(
+        dict_bytes / args.dict_holders, args.dict_holders, ledger_bytes / args.holders, args.holders, ledger.nbytes() / args.holders))
+
+    holder_ids = np.arange(args.holders)
+    timed("ledger: bulk credit {:,} holders".format(args.holders), lambda: ledger.usm.credit(holder_ids, 1.0), args.holders)
+    timed("ledger: bulk debit {:,} holders".format(args.holders), lambda: ledger.usm.debit(holder_ids, 1.0), args.holders)
+    timed("dicts: credit {:,} holders".format(args.dict_holders), lambda: [usm_holdings.__setitem__(name, balance + 1) for name, balance in usm_holdings.items()], args.dict_holders)
+    timed("ledger: top {} of {:,}".format(args.top, args.holders), lambda: ledger.usm.top(args.top))
+    timed("dicts: top {} of {:,}".format(args.top, args.dict_holders), lambda: sorted(usm_holdings.items(), key=lambda item: item[1], reverse=True)[:args.top])
+    timed("ledger: repr() for status_summary()", lambda: repr(ledger.usm))
+    timed("dicts: repr() for status_summary()", lambda: repr(usm_holdings))
+    del usm_holdings, fum_holdings
+
+    users = ['user{}'.format(i) for i in range(1000)]
+    for kind in ('dicts', 'ledger'):
+        pool = usm_constproduct.Pool()
+        if kind == 'ledger':
+            usm_ledger.use_ledger(pool)
+        pool.set_oracle_eth_price(200)
+        timed("{}: {:,} mint+burn pairs via usm_constproduct".format(kind, args.ops), lambda: run_ops(pool, users, args.ops), 2 * args.ops)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+import argparse
+import contextlib
+from datetime import datetime, timezone
+import gc
+import importlib
+import itertools
+import json
+import os
+import platform
+import sys
+from time import perf_counter
+
+import numpy as np
+
+import usm_ledger
+import usm_metrics
+
+# Times each top-level op of both models, at a range of holder counts, with the holdings as dicts or as a usm_ledger.Ledger, and (usm_constproduct.py only - usm.py has no approximations)
+# under both settings of APPROXIMATE_TO_SAVE_GAS.  Results can be saved as a JSON baseline, and a later run compared against it, eg:
+#   python bench_suite.py --save baseline.json
+#   python bench_suite.py --compare baseline.json          # Flags any op more than --threshold slower than the baseline, and exits with status 1 if there are any
+# Each timing is the fastest of --repeat runs of as many calls as fill --min-time (like timeit), with the state put back after each run, so every run times the same calls from the same state.
+# Noise mostly makes runs slower, never faster, which the threshold has to allow for: compare runs from the same machine.
+
+OPS = ('mint_usm', 'burn_usm', 'create_fum_from_eth', 'create_fum_from_usm', 'redeem_fum', 'set_oracle_eth_price', 'status_summary')
+MODELS = ('usm', 'usm_constproduct')
+HOLDINGS = ('dict', 'ledger')
+USER = 0                                                                            # The holder every op is done by: holders are numbered, as a Ledger's IDs are
+USER_USM, OTHER_USM = 1e12, 1000.0                                                  # USER holds enough of everything that no run of calls uses it up; the others, about OTHER_*
+USER_FUM, OTHER_FUM = 1e10, 10.0
+DEBT_RATIO = 0.5
+MAX_CALLS = 10**7
+
+def build_state(model, holders, holdings):
+    # Puts model into a state with holders holders (numbered 0 to holders - 1), holding around OTHER_USM/OTHER_FUM each (drawn from a lognormal distribution, seeded so every run gets the same
+    # balances), USER much more, and enough ETH in the pool for a debt ratio of DEBT_RATIO.
+    model.reset_state()
+    rng = np.random.default_rng(0)
+    usm_balances, fum_balances = rng.lognormal(np.log(OTHER_USM), 1, holders), rng.lognormal(np.log(OTHER_FUM), 1, holders)
+    usm_balances[USER], fum_balances[USER] = USER_USM, USER_FUM
+    if holdings == 'ledger':
+        ledger = usm_ledger.Ledger.from_balances(usm_balances, fum_balances)
+        model.usm_holdings, model.fum_holdings = ledger.usm, ledger.fum
+    else:
+        model.usm_holdings, model.fum_holdings = dict(enumerate(usm_balances.tolist())), dict(enumerate(fum_balances.tolist()))
+    model.usm_supply, model.fum_supply = float(usm_balances.sum()), float(fum_balances.sum())
+    model.pool_eth = model.usm_supply / (DEBT_RATIO * usm_metrics.eth_mid_price(model))
+    if hasattr(model, 'invalidate_derived_state'):
+        model.invalidate_derived_state()
+
+def save_state(model):
+    # The state the ops can change: every scalar state variable, and USER's balances.
+    scalars = {name: getattr(model, name) for name in model.STATE_VARIABLES if name not in ('usm_holdings', 'fum_holdings')}
+    return scalars, model.usm_holdings[USER], model.fum_holdings[USER]
+
+def restore_state(model, saved):
+    scalars, usm_balance, fum_balance = saved
+    for name, value in scalars.items():
+        setattr(model, name, value)
+    model.usm_holdings[USER], model.fum_holdings[USER] = usm_balance, fum_balance
+    if hasattr(model, 'invalidate_derived_state'):
+        model.invalidate_derived_state()
+
+def op_calls(model):
+    # op -> a function making one call of it, small enough not to move the state much.  (usm.py's equivalent of set_oracle_eth_price() is change_eth_price().)  Prices alternate, so each
+    # call is a real change.
+    prices = itertools.cycle((usm_metrics.eth_mid_price(model) * 1.001, usm_metrics.eth_mid_price(model)))
+    set_price = model.set_oracle_eth_price if usm_metrics.is_constproduct(model) else model.change_eth_price
+    return {'mint_usm': lambda: model.mint_usm(USER, 0.01),
+            'burn_usm': lambda: model.burn_usm(USER, 1),
+            'create_fum_from_eth': lambda: model.create_fum_from_eth(USER, 0.01),
+            'create_fum_from_usm': lambda: model.create_fum_from_usm(USER, 1),
+            'redeem_fum': lambda: model.redeem_fum(USER, 0.01),
+            'set_oracle_eth_price': lambda: set_price(next(prices)),
+            'status_summary': model.status_summary}
+
+def time_calls(call, number):
+    # With the garbage collector off while timing, as timeit does, so a collection landing in one run doesn't count against whichever op it happened to land in:
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = perf_counter()
+        for _ in range(number):
+            call()
+        return perf_counter() - start
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+def time_op(model, call, min_time, repeat):
+    # Returns (seconds per call, calls per run): the number of calls per run doubles until a run takes at least min_time, then the fastest of repeat runs counts.
+    saved = save_state(model)
+    number = 1
+    while True:
+        elapsed = time_calls(call, number)
+        restore_state(model, saved)
+        if elapsed >= min_time or number >= MAX_CALLS:
+            break
+        number *= 2
+    for _ in range(repeat - 1):
+        elapsed = min(elapsed, time_calls(call, number))
+        restore_state(model, saved)
+    return elapsed / number, number
+
+def result_key(result):
+    return "{model}/{approximation}/{holdings}/{holders}/{op}".format(**result)
+
+def run_suite(model_names, holder_counts, holdings_kinds, ops, min_time=0.1, repeat=3, max_dict_holders=10**6, retime_if=None, retimes=0):
+    # Yields each timing, as a dict, as it's done.  If retime_if(timing) is true (eg, it looks like a regression), the op is timed again, up to retimes more times, keeping the fastest: so a
+    # one-off slowdown from something else running on the machine doesn't get flagged.
+    for model_name in model_names:
+        model = importlib.import_module(model_name).Pool()                             # A pool of its own, so switching its approximation below changes no one else's
+        approximations = (False, True) if hasattr(model, 'APPROXIMATE_TO_SAVE_GAS') else (None,)
+        for holdings, holders in itertools.product(holdings_kinds, holder_counts):
+            if holdings == 'dict' and holders > max_dict_holders:
+                print("Skipping {} with {:,} holders in dicts (over --max-dict-holders)".format(model_name, holders), file=sys.stderr)
+                continue
+            build_state(model, holders, holdings)
+            calls = op_calls(model)
+            for approximation in approximations:
+                if approximation is not None:
+                    model.APPROXIMATE_TO_SAVE_GAS = approximation
+                    model.invalidate_derived_state()
+                for op in ops:
+                    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):     # Silence the min FUM buy price messages
+                        seconds, number = time_op(model, calls[op], min_time, repeat)
+                        result = {'model': model_name, 'approximation': {None: 'none', False: 'exact', True: 'approximate'}[approximation], 'holdings': holdings, 'holders': holders,
+                                  'op': op, 'seconds_per_call': seconds, 'calls': number, 'retimes': 0}
+                        while retime_if is not None and result['retimes'] < retimes and retime_if(result):
+                            result['seconds_per_call'] = min(result['seconds_per_call'], time_op(model, calls[op], min_time, repeat)[0])
+                            result['retimes'] += 1
+                    yield result
+
+def metadata():
+    return {'date': datetime.now(timezone.utc).isoformat(), 'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'machine': platform.machine(), 'argv': sys.argv[1:]}
+
+def format_time(seconds):
+    return "{:,.2f} µs".format(seconds * 1e6) if seconds < 1e-3 else "{:,.3f} ms".format(seconds * 1e3) if seconds < 1 else "{:,.3f} s".format(seconds)
+
+def main():
+    parser = argparse.ArgumentParser(description="Time each op of both models at a range of holder counts, save the results as a baseline, and flag regressions against an earlier baseline.")
+    parser.add_argument('--models', default=','.join(MODELS), help="comma-separated, from: " + ", ".join(MODELS))
+    parser.add_argument('--holders', default='10,1000,100000,1000000,10000000', help="comma-separated holder counts")
+    parser.add_argument('--holdings', default=','.join(HOLDINGS), help="comma-separated, from: " + ", ".join(HOLDINGS))
+    parser.add_argument('--ops', default=','.join(OPS), help="comma-separated, from: " + ", ".join(OPS))
+    parser.add_argument('--max-dict-holders', type=int, default=10**6, help="skip dict holdings above this many holders (10M holders in dicts take several GB)")
+    parser.add_argument('--min-time', type=float, default=0.1, metavar='SECONDS', help="time enough calls per run to take at least this long")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per timing: the fastest counts")
+    parser.add_argument('--save', metavar='JSON', help="save the results as a baseline")
+    parser.add_argument('--compare', metavar='JSON', help="compare the results with this baseline")
+    parser.add_argument('--threshold', type=float, default=0.25, help="flag ops that got more than this fraction slower than the baseline")
+    parser.add_argument('--retimes', type=int, default=3, help="time an op that looks like a regression up to this many more times, before flagging it")
+    args = parser.parse_args()
+
+    model_names, holdings_kinds, ops = args.models.split(','), args.holdings.split(','), args.ops.split(',')
+    for name, chosen, allowed in (('model', model_names, MODELS), ('holdings', holdings_kinds, HOLDINGS), ('op', ops, OPS)):
+        for value in chosen:
+            if value not in allowed:
+                parser.error("unknown {} '{}'".format(name, value))
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = {result_key(result): result for result in json.load(baseline_file)['results']}
+
+    def change(result):
+        # Fractional change from the baseline, or None if it has no timing for this:
+        key = result_key(result)
+        return result['seconds_per_call'] / baseline[key]['seconds_per_call'] - 1 if key in baseline else None
+
+    def looks_like_regression(result):
+        return (change(result) or 0) > args.threshold
+
+    print("{:<64} {:>14} {:>10} {:>14} {:>9}".format("model/approximation/holdings/holders/op", "per call", "calls", "baseline", "change"))
+    results, regressions, improvements = [], [], []
+    start = perf_counter()
+    for result in run_suite(model_names, [int(holders) for holders in args.holders.split(',')], holdings_kinds, ops, args.min_time, args.repeat, args.max_dict_holders,
+                            looks_like_regression, args.retimes):
+        results.append(result)
+        key = result_key(result)
+        comparison = ""
+        result_change = change(result)
+        if result_change is not None:
+            flag = ""
+            if result_change > args.threshold:
+                regressions.append((key, result_change))
+                flag = "  REGRESSION"
+            elif result_change < 1 / (1 + args.threshold) - 1:
+                improvements.append((key, result_change))
+            comparison = "{:>14} {:>+9.1%}{}".format(format_time(baseline[key]['seconds_per_call']), result_change, flag)
+        print("{:<64} {:>14} {:>10,} {}".format(key, format_time(result['seconds_per_call']), result['calls'], comparison), flush=True)
+    print("{:,} timings in {:.1f}s.".format(len(results), perf_counter() - start))
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump({'metadata': metadata(), 'results': results}, baseline_file, indent=1)
+        print("Saved baseline to {}.".format(args.save))
+    if args.compare:
+        missing = len(set(baseline) - {result_key(result) for result in results})
+        print("Compared with {}: {:,} regressions (> {:.0%} slower), {:,} improvements, {:,} baseline timings not rerun.".format(
+            args.compare, len(regressions), args.threshold, len(improvements), missing))
+        for key, change in sorted(regressions, key=lambda regression: -regression[1]):
+            print("  REGRESSION {:<64} {:>+9.1%}".format(key, change))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,208 +1,513 @@
+import collections
+import contextlib
+import copy
 import math
 import sys
-
-# Parameters:
-USM_MINT_FEE    = 0.001
-USM_BURN_FEE    = 0.005
-FUM_CREATE_FEE  = 0.001
-FUM_REDEEM_FEE  = 0.005
-MAX_DEBT_RATIO  = 0.8   # Eg, if 1,000,000 USM are outstanding, users won't be able to redeem FUM unless the ETH pool's value is >= $1,000,000 / 0.8 = $1,250,000
+from time import perf_counter
 
 # Price side constants:
 THEORETICAL = 'theoretical'
 BUY         = 'buy'
 SELL        = 'sell'
 
-# State:
-eth_price                   = 200
-pool_eth                    = 0
-usm_holdings                = {}
-fum_holdings                = {}
-min_fum_buy_price_in_eth    = 0
+Quote = collections.namedtuple('Quote', 'output price debt_ratio rejected')        # What the quote_*() methods return: see "Read-only quotes" below
 
 def main():
-    input_loop()
+    import argparse                 # Here rather than at the top, so that importing the module just for Pool is fast
+    parser = argparse.ArgumentParser(description="Simulate the USM/FUM pool.  With no arguments, runs an interactive command loop.")
+    parser.add_argument('--replay', metavar='TRACE', help="apply the commands in TRACE (one per line, '-' for stdin) at full speed, instead of prompting for them")
+    parser.add_argument('--summary-every', metavar='N', type=int, default=0, help="while replaying, print the status summary every N commands, not just at the end")
+    args = parser.parse_args()
+    pool = Pool()
+    if args.replay is None:
+        input_loop(pool)
+    elif args.replay == '-':
+        pool.replay(sys.stdin, args.summary_every)
+    else:
+        with open(args.replay) as trace:
+            pool.replay(trace, args.summary_every)
 
-def input_loop():
+def input_loop(pool):
     while True:
-        clear_min_fum_buy_price_if_obsolete()
-        print(status_summary())
+        pool.prepare_for_next_command()
+        print(pool.status_summary())
         print()
         line = input("> ")
         words = line.split()
         try:
-            if words[0] == "price":
-                # "price 150" -> change the current ETH price in our simulation to $150
-                new_price = float(words[1])
-                change_eth_price(new_price)
-            elif words[0] == "mint":
-                # "mint A 10" -> user A adds 10 ETH to the pool, getting back 10 * eth_price newly-minted USM (minus fees)
-                user, eth_to_add = words[1], float(words[2])
-                usm_minted = mint_usm(user, eth_to_add)
+            pool.apply_command(words)
+        except:
+            print("Error:", sys.exc_info())
+
+
+class Pool:
+    """One USM/FUM pool: its parameters and its state, and the ops on them.  Pools are independent of each other, so one process can run any number of them side by side.  The parameters
+    below are every pool's defaults: override them for one pool by passing them in, eg Pool(USM_MINT_FEE=0.002), or by setting them on it."""
+
+    # Parameters:
+    USM_MINT_FEE    = 0.001
+    USM_BURN_FEE    = 0.005
+    FUM_CREATE_FEE  = 0.001
+    FUM_REDEEM_FEE  = 0.005
+    MAX_DEBT_RATIO  = 0.8   # Eg, if 1,000,000 USM are outstanding, users won't be able to redeem FUM unless the ETH pool's value is >= $1,000,000 / 0.8 = $1,250,000
+
+    # Debugging:
+    CHECK_SUPPLY_TOTALS = False     # Switch to True to verify, after every command, that usm_supply/fum_supply still match a full recount of the holdings
+
+    PARAMETERS  = ('USM_MINT_FEE', 'USM_BURN_FEE', 'FUM_CREATE_FEE', 'FUM_REDEEM_FEE', 'MAX_DEBT_RATIO', 'CHECK_SUPPLY_TOTALS')
+    THEORETICAL, BUY, SELL = THEORETICAL, BUY, SELL     # So code holding just a pool can name the price sides
+
+    # State, as a new pool (or reset_state()) starts it:
+    INITIAL_STATE = {
+        'eth_price':                200,
+        'pool_eth':                 0,
+        'usm_holdings':             {},
+        'fum_holdings':             {},
+        'usm_supply':               0,      # Running total of usm_holdings.values(), so usm_outstanding() doesn't have to sum over every holder
+        'fum_supply':               0,      # Same for fum_holdings
+        'min_fum_buy_price_in_eth': 0,
+    }
+    STATE_VARIABLES = tuple(INITIAL_STATE)
+
+    def __init__(self, **params):
+        for name in params:
+            if name not in self.PARAMETERS:
+                raise TypeError("{} is not a parameter of {}.Pool".format(name, __name__))
+        for name in self.PARAMETERS:
+            setattr(self, name, params.get(name, getattr(self, name)))     # Set on the pool even if it's the default: looking it up there is faster than on the class
+        self.forks = []     # Open forks of the state, innermost last: each a journal of {state variable name, or (holdings name, user): value before the fork touched it}.  See fork()
+        self.verbose = True # Print the min FUM buy price messages?  See quiet()
+        self.reset_state()
+
+    def replay(self, lines, summary_every=0):
+        # Like input_loop(), but reads commands from lines (eg, an open trace file, read lazily) rather than prompting, and only prints the status summary every summary_every commands (if nonzero) and at the end - formatting it after every command would dominate the runtime.
+        commands = errors = 0
+        start = perf_counter()
+        with self.quiet():                                                                  # The min FUM buy price messages would swamp the output: status_summary() shows the price
+            for line_number, line in enumerate(lines, 1):
+                words = line.split()
+                if not words or words[0].startswith('#'):
+                    continue
+                try:
+                    self.prepare_for_next_command()                                         # Inside the try, so eg a CHECK_SUPPLY_TOTALS failure is reported against this line, not fatal
+                    self.apply_command(words, verbose=False)
+                except Exception as err:
+                    errors += 1
+                    print("Error on line {}: {!r}".format(line_number, err), file=sys.stderr)
+                commands += 1
+                if summary_every and commands % summary_every == 0:
+                    print(self.status_summary())
+                    print()
+            self.prepare_for_next_command()
+        elapsed = perf_counter() - start
+        print(self.status_summary())
+        print()
+        print("Replayed {:,} commands ({:,} errors) in {:.3f}s = {:,.0f} ops/sec.".format(commands, errors, elapsed, commands / elapsed if elapsed > 0 else math.inf))
+        return commands
+
+    def prepare_for_next_command(self):
+        if self.CHECK_SUPPLY_TOTALS:
+            self.check_supply_totals()
+        self.clear_min_fum_buy_price_if_obsolete()
+
+    def apply_command(self, words, verbose=True):
+        if words[0] == "price":
+            # "price 150" -> change the current ETH price in our simulation to $150, or "price 150/160" (a sell/buy price, as usm_constproduct.py takes) -> change it to the mid price, $155
+            prices = [float(price) for price in words[1].split('/')]
+            self.change_eth_price(sum(prices) / len(prices))
+        elif words[0] == "mint":
+            # "mint A 10" -> user A adds 10 ETH to the pool, getting back 10 * eth_price newly-minted USM (minus fees)
+            user, eth_to_add = words[1], float(words[2])
+            usm_minted = self.mint_usm(user, eth_to_add)
+            if verbose:
                 print("Minted {:,} new USM for {} from {:,} ETH.".format(round(usm_minted, 4), user, round(eth_to_add, 6)))
-            elif words[0] == "burn":
-                # "burn A 1000" -> user A burns 1,000 of their USM, getting back (1,000 / eth_price) ETH (minus fees)
-                user, usm_to_burn = words[1], float(words[2])
-                eth_removed = burn_usm(user, usm_to_burn)
-                print("Burned {:,} of {}'s USM for ${:,} each, yielding {:,} ETH.".format(round(usm_to_burn, 4), user, round(eth_removed * eth_price / usm_to_burn, 6), round(eth_removed, 6)))
-            elif words[0] == "fund_eth":
-                # "fund_eth B 5" -> user B adds 5 ETH to the pool, getting back a corresponding amount of newly-created FUM (based on the current FUM price, roughly buffer_value() / fum_outstanding())
-                user, eth_to_add = words[1], float(words[2])
-                fum_created = create_fum_from_eth(user, eth_to_add)
+            return usm_minted
+        elif words[0] == "burn":
+            # "burn A 1000" -> user A burns 1,000 of their USM, getting back (1,000 / eth_price) ETH (minus fees)
+            user, usm_to_burn = words[1], float(words[2])
+            eth_removed = self.burn_usm(user, usm_to_burn)
+            if verbose:
+                print("Burned {:,} of {}'s USM for ${:,} each, yielding {:,} ETH.".format(round(usm_to_burn, 4), user, round(eth_removed * self.eth_price / usm_to_burn, 6), round(eth_removed, 6)))
+            return eth_removed
+        elif words[0] == "fund_eth":
+            # "fund_eth B 5" -> user B adds 5 ETH to the pool, getting back a corresponding amount of newly-created FUM (based on the current FUM price, roughly buffer_value() / fum_outstanding())
+            user, eth_to_add = words[1], float(words[2])
+            fum_created = self.create_fum_from_eth(user, eth_to_add)
+            if verbose:
                 print("Created {:,} new FUM for {} from {:,} ETH.".format(round(fum_created, 4), user, round(eth_to_add, 6)))
-            elif words[0] == "fund_usm":
-                # "fund_usm B 1000" -> user B returns (burns) 1000 USM to the pool, getting back a corresponding amount of newly-created FUM (based on the current FUM price).  This leaves total pool value unchanged - basically converting USM to FUM, deceasing debt ratio.
-                user, usm_to_convert = words[1], float(words[2])
-                fum_created = create_fum_from_usm(user, usm_to_convert)
+            return fum_created
+        elif words[0] == "fund_usm":
+            # "fund_usm B 1000" -> user B returns (burns) 1000 USM to the pool, getting back a corresponding amount of newly-created FUM (based on the current FUM price).  This leaves total pool value unchanged - basically converting USM to FUM, deceasing debt ratio.
+            user, usm_to_convert = words[1], float(words[2])
+            fum_created = self.create_fum_from_usm(user, usm_to_convert)
+            if verbose:
                 print("Created {:,} new FUM for {} from {:,} USM.".format(round(fum_created, 4), user, round(usm_to_convert, 4)))
-            elif words[0] == "defund":
-                # "defund B 1000" -> user B redeems 1,000 of their FUM, getting back a corresponding amount of ETH (based on the current FUM price)
-                user, fum_to_redeem = words[1], float(words[2])
-                eth_removed = redeem_fum(user, fum_to_redeem)
-                print("Redeemed {:,} of {}'s FUM for ${:,} each, yielding {:,} ETH.".format(round(fum_to_redeem, 4), user, round(eth_removed * eth_price / fum_to_redeem, 6), round(eth_removed, 6)))
+            return fum_created
+        elif words[0] == "defund":
+            # "defund B 1000" -> user B redeems 1,000 of their FUM, getting back a corresponding amount of ETH (based on the current FUM price)
+            user, fum_to_redeem = words[1], float(words[2])
+            eth_removed = self.redeem_fum(user, fum_to_redeem)
+            if verbose:
+                print("Redeemed {:,} of {}'s FUM for ${:,} each, yielding {:,} ETH.".format(round(fum_to_redeem, 4), user, round(eth_removed * self.eth_price / fum_to_redeem, 6), round(eth_removed, 6)))
+            return eth_removed
+        elif words[0] == "wait":
+            # "wait 300" -> nothing: this model has no clock (no fees decay), but takes the command so it can replay the same traces as usm_constproduct.py
+            float(words[1])                                                 # Still rejects a malformed "wait", as usm_constproduct.py does
+        else:
+            raise ValueError("Unrecognized command: '{}'".format(words))
+
+    def status_summary(self):
+        min_fum_buy_price_string = "" if self.min_fum_buy_price_in_eth == 0 else " (min {:,} ETH = ${:,})".format(round(self.min_fum_buy_price_in_eth, 6), round(self.min_fum_buy_price_in_eth * self.eth_price, 8))
+        return "{:,} ETH at ${:,} = ${:,} pool value, {:,} USM outstanding, buffer = ${:,}, debt ratio = {:.2%}, {:,} FUM outstanding, FUM price = ${:,}/${:,}{}\nUSM holdings: {}\nFUM holdings: {}".format(
+            round(self.pool_eth, 6), round(self.eth_price, 4), round(self.pool_value(), 2), round(self.usm_outstanding(), 4), round(self.buffer_value(), 2), self.debt_ratio(), round(self.fum_outstanding(), 4), round(self.fum_price(SELL), 6), round(self.fum_price(BUY), 6), min_fum_buy_price_string, self.usm_holdings, self.fum_holdings)
+
+
+    # State-modifying operations:
+
+    def reset_state(self):
+        # Put every state variable back to its initial value (INITIAL_STATE), so we can run another simulation from scratch in the same pool:
+        for name, value in copy.deepcopy(self.INITIAL_STATE).items():
+            setattr(self, name, value)
+        self.forks.clear()
+
+    def change_eth_price(self, new_price):
+        self.save_for_rollback('eth_price')
+        self.eth_price = new_price
+        if self.min_fum_buy_price_in_eth == 0 and self.debt_ratio() > self.MAX_DEBT_RATIO and self.fum_outstanding() > 0:
+            # Need to set the min FUM buy price (in ETH), to the FUM price in ETH as of the ETH price point where the debt ratio exceeded MAX_DEBT_RATIO.  Eg, suppose pool_eth = 400 and fum_outstanding() = 1,000.  Then, at the moment we exceed MAX_DEBT_RATIO = 0.8, the buffer must contain
+            # 400 * (1 - 0.8) = 80 ETH, and therefore the FUM price in ETH is 80 / 1,000 = 0.08.  Eg, suppose USM outstanding = 40,000: then we cross 0.8 at ETH = $125, when total pool value = $50,000, buffer = $10,000, and FUM price = $10,000 / 1,000 = $10 = ($10 / $125) = 0.08 ETH.
+            fum_price_in_eth_at_which_we_crossed_max_debt_ratio = (self.pool_eth * (1 - self.MAX_DEBT_RATIO)) / self.fum_outstanding()
+            self.set_min_fum_buy_price_in_eth(fum_price_in_eth_at_which_we_crossed_max_debt_ratio / (1 - self.FUM_CREATE_FEE))  # We want a buy price, so adjust for the fee
+
+    def mint_usm(self, user, eth_to_add):
+        usm_minted = (eth_to_add * self.eth_price) * (1 - self.USM_MINT_FEE)
+        self.change_pool_eth(eth_to_add)
+        self.change_usm_holding(user, usm_minted)
+
+        if self.min_fum_buy_price_in_eth == 0 and self.debt_ratio() > self.MAX_DEBT_RATIO and self.fum_outstanding() > 0:
+            # Need to set the min FUM buy price (in ETH), to the FUM price in ETH as of the point during this mint op where the debt ratio exceeded MAX_DEBT_RATIO.  Without fees this would be trivial, since minting affects neither the number of ETH in the buffer, nor the number of FUM
+            # outstanding: so we could just divide them!  But, because the fees from minting slightly increase the buffer as we go, the math gets much more hairy...  Just trust me for now (or verify on an example) that this formula gives the correct FUM price in ETH at the crossing point:
+            eth_in_buffer = self.buffer_value() / self.eth_price
+            usm_value_in_eth = self.usm_outstanding() / self.eth_price
+            fum_price_in_eth_at_which_we_crossed_max_debt_ratio = ((self.pool_eth +
+                                                                    (self.MAX_DEBT_RATIO * eth_in_buffer - (1 - self.MAX_DEBT_RATIO) * usm_value_in_eth) / (1 - self.MAX_DEBT_RATIO - self.USM_MINT_FEE))
+                                                                   * (1 - self.MAX_DEBT_RATIO) / self.fum_outstanding())
+            self.set_min_fum_buy_price_in_eth(fum_price_in_eth_at_which_we_crossed_max_debt_ratio / (1 - self.FUM_CREATE_FEE))  # We want a buy price, so adjust for the fee
+            # Note that minting never pulls us *below* MAX_DEBT_RATIO, since it always moves debt ratio closer to 1.  If debt ratio starts > 1, it stays > 1; if it starts < 1 and > MAX_DEBT_RATIO, it stays > MAX_DEBT_RATIO.
+
+        return usm_minted
+
+    def burn_usm(self, user, usm_to_burn, burn_fee=None, check_debt_ratio=True):
+        # Note that burning never pushes us over MAX_DEBT_RATIO (which is < 1), since it always moves debt ratio further from 1.  It can pull us *below* MAX_DEBT_RATIO, but if so the top-level call to clear_min_fum_buy_price_if_obsolete() will take care of it once this op is done.
+        if burn_fee is None:
+            burn_fee = self.USM_BURN_FEE                                    # Looked up at call time, not as a default argument, so that changing USM_BURN_FEE (eg, in a parameter sweep) takes effect
+        assert usm_to_burn <= self.usm_holdings.get(user, 0), "{} doesn't own that many USM".format(user)
+        eth_removed = (usm_to_burn / self.eth_price) * (1 - burn_fee)
+        assert eth_removed <= self.pool_eth, "Not enough ETH in the pool"
+        if check_debt_ratio:
+            assert self.debt_ratio(self.pool_eth - eth_removed, self.usm_outstanding() - usm_to_burn) <= 1, "Burning {:,} USM would leave the debt ratio above 100%".format(usm_to_burn)
+        self.change_usm_holding(user, -usm_to_burn)
+        self.change_pool_eth(-eth_removed)
+        return eth_removed
+
+    def create_fum_from_eth(self, user, eth_to_add):
+        # Fund operations never push us over MAX_DEBT_RATIO either - they reduce debt ratio.  However, they *can* bring us back under MAX_DEBT_RATIO, so we have to handle that case here.
+        if self.debt_ratio() > self.MAX_DEBT_RATIO:
+            eth_add_that_would_bring_us_to_max_dr = (self.usm_outstanding() / self.eth_price) / self.MAX_DEBT_RATIO - self.pool_eth
+            eth_to_add_above_max_dr = max(0, min(eth_to_add, eth_add_that_would_bring_us_to_max_dr))
+            fum_created_above_max_dr = (eth_to_add_above_max_dr * self.eth_price) / self.fum_price(BUY)
+            self.change_pool_eth(eth_to_add_above_max_dr)
+            self.change_fum_holding(user, fum_created_above_max_dr)
+
+            eth_to_add -= eth_to_add_above_max_dr
+            if eth_to_add > 0:
+                self.clear_min_fum_buy_price_if_obsolete(True)              # eth_to_add was enough to bring us back below MAX_DEBT_RATIO (ie, exceeds eth_add_that_would_bring_us_to_max_dr), so we need to clear the min FUM buy price before processing the remaining eth_to_add
+        else:
+            fum_created_above_max_dr = 0
+
+        fum_created_below_max_dr = (eth_to_add * self.eth_price) / self.fum_price(BUY)
+        self.change_pool_eth(eth_to_add)
+        self.change_fum_holding(user, fum_created_below_max_dr)
+        if self.debt_ratio() > self.MAX_DEBT_RATIO and self.min_fum_buy_price_in_eth == 0:
+            self.set_min_fum_buy_price_in_eth(self.fum_price(BUY) / self.eth_price)  # We need this for the particular case where debt ratio was already > max, but we had no FUM outstanding yet until this fund operation
+        return fum_created_above_max_dr + fum_created_below_max_dr
+
+    def create_fum_from_usm(self, user, usm_to_convert):
+        # To avoid duplication, just implement this as a call to burn_usm() (with 0 fee, and bypassing the debt ratio check), followed by a call to create_fum_from_eth().  These run in one transaction, so if we die on an error with half the operation complete, the burn is rolled back too:
+        with self.transaction():
+            eth_converted = self.burn_usm(user, usm_to_convert, 0, False)
+            self.clear_min_fum_buy_price_if_obsolete()                      # Important so that, if the preceding burn brought us below MAX_DEBT_RATIO, we clear the min FUM buy price before starting the fund operation
+            return self.create_fum_from_eth(user, eth_converted)
+
+    def redeem_fum(self, user, fum_to_redeem):
+        assert fum_to_redeem <= self.fum_holdings.get(user, 0), "{} doesn't own that many FUM".format(user)
+        eth_removed = (fum_to_redeem * self.fum_price(SELL)) / self.eth_price
+        assert self.debt_ratio(self.pool_eth - eth_removed) <= self.MAX_DEBT_RATIO, "Redeeming {:,} FUM would leave the debt ratio above {:.0%}".format(fum_to_redeem, self.MAX_DEBT_RATIO)
+        # Since we've disallowed redeem operations that would push us over MAX_DEBT_RATIO, we don't need to handle that case.  And a redeem can never pull us under MAX_DEBT_RATIO either, because it increases debt ratio.
+        self.change_fum_holding(user, -fum_to_redeem)
+        self.change_pool_eth(-eth_removed)
+        return eth_removed
+
+    def change_pool_eth(self, eth_change):
+        self.save_for_rollback('pool_eth')
+        self.pool_eth += eth_change
+
+    def change_usm_holding(self, user, usm_change):
+        # All changes to USM holdings should go through here (or change_fum_holding() below), so that usm_supply stays in sync with usm_holdings:
+        self.save_for_rollback('usm_supply')
+        self.save_holding_for_rollback('usm_holdings', user)
+        self.usm_holdings[user] = self.usm_holdings.get(user, 0) + usm_change
+        self.usm_supply += usm_change
+
+    def change_fum_holding(self, user, fum_change):
+        self.save_for_rollback('fum_supply')
+        self.save_holding_for_rollback('fum_holdings', user)
+        self.fum_holdings[user] = self.fum_holdings.get(user, 0) + fum_change
+        self.fum_supply += fum_change
+
+    def set_min_fum_buy_price_in_eth(self, price_in_eth):
+        self.save_for_rollback('min_fum_buy_price_in_eth')
+        if self.verbose:
+            print("* Setting min FUM buy price to ${:,} = {:,} ETH, since debt ratio {:.2%} has risen above {:.0%}.".format(round(price_in_eth * self.eth_price, 6), round(price_in_eth, 8), self.debt_ratio(), self.MAX_DEBT_RATIO))
+        self.min_fum_buy_price_in_eth = price_in_eth
+
+    def clear_min_fum_buy_price_if_obsolete(self, bypass_debt_ratio_check=False):
+        if self.min_fum_buy_price_in_eth != 0 and (bypass_debt_ratio_check or self.debt_ratio() <= self.MAX_DEBT_RATIO):
+            self.save_for_rollback('min_fum_buy_price_in_eth')
+            if self.verbose:
+                print("* Resetting min FUM buy price to $0, since debt ratio {:.2%} is back below {:.0%}.".format(self.debt_ratio(), self.MAX_DEBT_RATIO))
+            self.min_fum_buy_price_in_eth = 0
+
+
+    # Transactions:
+
+    # fork() starts a journal, rather than copying the state: from then on, the first change to each state variable or holding saves its old value, so rollback() can put back just what was touched,
+    # and commit() can just drop the journal.  So a fork costs O(1), and a rollback O(changes made in the fork).  Forks nest: committing an inner fork folds its journal into the outer one.
+
+    NOT_HELD = object()     # Journal value for a holder who wasn't in the holdings dict before the fork
+
+    def fork(self):
+        self.forks.append({})
+
+    def commit(self):
+        journal = self.forks.pop()
+        if self.forks:
+            outer_journal = self.forks[-1]
+            for key, value in journal.items():
+                outer_journal.setdefault(key, value)                        # If the outer fork had already touched this, its older value is the one to keep
+
+    def rollback(self):
+        for key, value in self.forks.pop().items():
+            if isinstance(key, tuple):
+                holdings_name, user = key
+                if value is self.NOT_HELD:
+                    del getattr(self, holdings_name)[user]
+                else:
+                    getattr(self, holdings_name)[user] = value
             else:
-                raise ValueError("Unrecognized command: '{}'".format(words))
-        except:
-            print("Error:", sys.exc_info())
+                setattr(self, key, value)
 
-def status_summary():
-    min_fum_buy_price_string = "" if min_fum_buy_price_in_eth == 0 else " (min {:,} ETH = ${:,})".format(round(min_fum_buy_price_in_eth, 6), round(min_fum_buy_price_in_eth * eth_price, 8))
-    return "{:,} ETH at ${:,} = ${:,} pool value, {:,} USM outstanding, buffer = ${:,}, debt ratio = {:.2%}, {:,} FUM outstanding, FUM price = ${:,}/${:,}{}\nUSM holdings: {}\nFUM holdings: {}".format(
-        round(pool_eth, 6), round(eth_price, 4), round(pool_value(), 2), round(usm_outstanding(), 4), round(buffer_value(), 2), debt_ratio(), round(fum_outstanding(), 4), round(fum_price(SELL), 6), round(fum_price(BUY), 6), min_fum_buy_price_string, usm_holdings, fum_holdings)
-
-
-# State-modifying operations:
-
-def change_eth_price(new_price):
-    global eth_price
-    eth_price = new_price
-    if min_fum_buy_price_in_eth == 0 and debt_ratio() > MAX_DEBT_RATIO and fum_outstanding() > 0:
-        # Need to set the min FUM buy price (in ETH), to the FUM price in ETH as of the ETH price point where the debt ratio exceeded MAX_DEBT_RATIO.  Eg, suppose pool_eth = 400 and fum_outstanding() = 1,000.  Then, at the moment we exceed MAX_DEBT_RATIO = 0.8, the buffer must contain
-        # 400 * (1 - 0.8) = 80 ETH, and therefore the FUM price in ETH is 80 / 1,000 = 0.08.  Eg, suppose USM outstanding = 40,000: then we cross 0.8 at ETH = $125, when total pool value = $50,000, buffer = $10,000, and FUM price = $10,000 / 1,000 = $10 = ($10 / $125) = 0.08 ETH.
-        fum_price_in_eth_at_which_we_crossed_max_debt_ratio = (pool_eth * (1 - MAX_DEBT_RATIO)) / fum_outstanding()
-        set_min_fum_buy_price_in_eth(fum_price_in_eth_at_which_we_crossed_max_debt_ratio / (1 - FUM_CREATE_FEE))    # We want a buy price, so adjust for the fee
-
-def mint_usm(user, eth_to_add):
-    global pool_eth
-    usm_minted = (eth_to_add * eth_price) * (1 - USM_MINT_FEE)
-    pool_eth += eth_to_add
-    usm_holdings[user] = usm_holdings.get(user, 0) + usm_minted
-
-    if min_fum_buy_price_in_eth == 0 and debt_ratio() > MAX_DEBT_RATIO and fum_outstanding() > 0:
-        # Need to set the min FUM buy price (in ETH), to the FUM price in ETH as of the point during this mint op where the debt ratio exceeded MAX_DEBT_RATIO.  Without fees this would be trivial, since minting affects neither the number of ETH in the buffer, nor the number of FUM
-        # outstanding: so we could just divide them!  But, because the fees from minting slightly increase the buffer as we go, the math gets much more hairy...  Just trust me for now (or verify on an example) that this formula gives the correct FUM price in ETH at the crossing point:
-        eth_in_buffer = buffer_value() / eth_price
-        usm_value_in_eth = usm_outstanding() / eth_price
-        fum_price_in_eth_at_which_we_crossed_max_debt_ratio = ((pool_eth +
-                                                                (MAX_DEBT_RATIO * eth_in_buffer - (1 - MAX_DEBT_RATIO) * usm_value_in_eth) / (1 - MAX_DEBT_RATIO - USM_MINT_FEE))
-                                                               * (1 - MAX_DEBT_RATIO) / fum_outstanding())
-        set_min_fum_buy_price_in_eth(fum_price_in_eth_at_which_we_crossed_max_debt_ratio / (1 - FUM_CREATE_FEE))    # We want a buy price, so adjust for the fee
-        # Note that minting never pulls us *below* MAX_DEBT_RATIO, since it always moves debt ratio closer to 1.  If debt ratio starts > 1, it stays > 1; if it starts < 1 and > MAX_DEBT_RATIO, it stays > MAX_DEBT_RATIO.
-
-    return usm_minted
-
-def burn_usm(user, usm_to_burn, burn_fee=USM_BURN_FEE, check_debt_ratio=True):
-    # Note that burning never pushes us over MAX_DEBT_RATIO (which is < 1), since it always moves debt ratio further from 1.  It can pull us *below* MAX_DEBT_RATIO, but if so the top-level call to clear_min_fum_buy_price_if_obsolete() will take care of it once this op is done.
-    global pool_eth
-    assert usm_to_burn <= usm_holdings.get(user, 0), "{} doesn't own that many USM".format(user)
-    eth_removed = (usm_to_burn / eth_price) * (1 - burn_fee)
-    assert eth_removed <= pool_eth, "Not enough ETH in the pool"
-    if check_debt_ratio:
-        assert debt_ratio(pool_eth - eth_removed, usm_outstanding() - usm_to_burn) <= 1, "Burning {:,} USM would leave the debt ratio above 100%".format(usm_to_burn)
-    usm_holdings[user] -= usm_to_burn
-    pool_eth -= eth_removed
-    return eth_removed
-
-def create_fum_from_eth(user, eth_to_add):
-    # Fund operations never push us over MAX_DEBT_RATIO either - they reduce debt ratio.  However, they *can* bring us back under MAX_DEBT_RATIO, so we have to handle that case here.
-    global pool_eth
-    if debt_ratio() > MAX_DEBT_RATIO:
-        eth_add_that_would_bring_us_to_max_dr = (usm_outstanding() / eth_price) / MAX_DEBT_RATIO - pool_eth
-        eth_to_add_above_max_dr = max(0, min(eth_to_add, eth_add_that_would_bring_us_to_max_dr))
-        fum_created_above_max_dr = (eth_to_add_above_max_dr * eth_price) / fum_price(BUY)
-        pool_eth += eth_to_add_above_max_dr
-        fum_holdings[user] = fum_holdings.get(user, 0) + fum_created_above_max_dr
-
-        eth_to_add -= eth_to_add_above_max_dr
-        if eth_to_add > 0:
-            clear_min_fum_buy_price_if_obsolete(True)                   # eth_to_add was enough to bring us back below MAX_DEBT_RATIO (ie, exceeds eth_add_that_would_bring_us_to_max_dr), so we need to clear the min FUM buy price before processing the remaining eth_to_add
-    else:
-        fum_created_above_max_dr = 0
-
-    fum_created_below_max_dr = (eth_to_add * eth_price) / fum_price(BUY)
-    pool_eth += eth_to_add
-    fum_holdings[user] = fum_holdings.get(user, 0) + fum_created_below_max_dr
-    if debt_ratio() > MAX_DEBT_RATIO and min_fum_buy_price_in_eth == 0:
-        set_min_fum_buy_price_in_eth(fum_price(BUY) / eth_price)        # We need this for the particular case where debt ratio was already > max, but we had no FUM outstanding yet until this fund operation
-    return fum_created_above_max_dr + fum_created_below_max_dr
-
-def create_fum_from_usm(user, usm_to_convert):
-    # To avoid duplication, just implement this as a call to burn_usm() (with 0 fee, and bypassing the debt ratio check), followed by a call to create_fum_from_eth().  This is a bit hazardous because we could die on an error with half the operation complete, but good enough for govt work:
-    eth_converted = burn_usm(user, usm_to_convert, 0, False)
-    clear_min_fum_buy_price_if_obsolete()                               # Important so that, if the preceding burn brought us below MAX_DEBT_RATIO, we clear the min FUM buy price before starting the fund operation
-    return create_fum_from_eth(user, eth_converted)
-
-def redeem_fum(user, fum_to_redeem):
-    global pool_eth
-    assert fum_to_redeem <= fum_holdings.get(user, 0), "{} doesn't own that many FUM".format(user)
-    eth_removed = (fum_to_redeem * fum_price(SELL)) / eth_price
-    assert debt_ratio(pool_eth - eth_removed) <= MAX_DEBT_RATIO, "Redeeming {:,} FUM would leave the debt ratio above {:.0%}".format(fum_to_redeem, MAX_DEBT_RATIO)
-    # Since we've disallowed redeem operations that would push us over MAX_DEBT_RATIO, we don't need to handle that case.  And a redeem can never pull us under MAX_DEBT_RATIO either, because it increases debt ratio.
-    fum_holdings[user] -= fum_to_redeem
-    pool_eth -= eth_removed
-    return eth_removed
-
-def set_min_fum_buy_price_in_eth(price_in_eth):
-    global min_fum_buy_price_in_eth
-    print("* Setting min FUM buy price to ${:,} = {:,} ETH, since debt ratio {:.2%} has risen above {:.0%}.".format(round(price_in_eth * eth_price, 6), round(price_in_eth, 8), debt_ratio(), MAX_DEBT_RATIO))
-    min_fum_buy_price_in_eth = price_in_eth
-
-def clear_min_fum_buy_price_if_obsolete(bypass_debt_ratio_check=False):
-    global min_fum_buy_price_in_eth
-    if min_fum_buy_price_in_eth != 0 and (bypass_debt_ratio_check or debt_ratio() <= MAX_DEBT_RATIO):
-        print("* Resetting min FUM buy price to $0, since debt ratio {:.2%} is back below {:.0%}.".format(debt_ratio(), MAX_DEBT_RATIO))
-        min_fum_buy_price_in_eth = 0
-
-
-# Informational utility functions:
-
-def usm_outstanding():
-    return sum(usm_holdings.values())
-
-def fum_outstanding():
-    return sum(fum_holdings.values())
-
-def pool_value(eth=None):
-    if eth is None:
-        eth = pool_eth
-    return eth * eth_price
-
-def buffer_value():
-    return pool_value() - usm_outstanding()
-
-def debt_ratio(eth=None, usm=None):
-    if eth is None:
-        eth = pool_eth
-    if usm is None:
-        usm = usm_outstanding()
-    if pool_value(eth) == 0:
-        return 0
-    else:
-        return usm / pool_value(eth)
+    @contextlib.contextmanager
+    def transaction(self):
+        # with transaction(): ... - commits if the block completes, rolls back (and re-raises) if it fails, eg on an assertion.
+        self.fork()
+        try:
+            yield
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    @contextlib.contextmanager
+    def quiet(self):
+        # with quiet(): ... - no min FUM buy price messages inside the block (replay() runs in one, and tools that drive a pool silently can too).
+        verbose, self.verbose = self.verbose, False
+        try:
+            yield
+        finally:
+            self.verbose = verbose
+
+    def what_if(self, op, *args):
+        # Returns what op(*args) would return (eg, what_if(burn_usm, 'A', 1000)), and leaves the state as it was.  Raises whatever the op raises.
+        self.fork()
+        try:
+            with self.quiet():                                                                  # Nothing it does sticks, so don't announce any min FUM buy price change
+                return op(*args)
+        finally:
+            self.rollback()
+
+    def save_for_rollback(self, *names):
+        # Called by every setter of a state variable, just before it changes:
+        if self.forks:
+            journal = self.forks[-1]
+            for name in names:
+                if name not in journal:
+                    journal[name] = getattr(self, name)
+
+    def save_holding_for_rollback(self, holdings_name, user):
+        if self.forks:
+            journal = self.forks[-1]
+            key = (holdings_name, user)
+            if key not in journal:
+                journal[key] = getattr(self, holdings_name).get(user, self.NOT_HELD)
+
+
+    # Read-only quotes:
+
+    # What each op would return for each of an array of sizes, from the current state, without changing it: the same formulas as the ops, evaluated with NumPy over all sizes at once.  Each returns
+    # a Quote of arrays: output (eg, USM minted), price (input paid per unit of output), the debt ratio the op would leave, and rejected - True where the op would fail one of its assertions (eg,
+    # MAX_DEBT_RATIO), instead of raising.  Pass user to also check their balance.  NumPy is imported by the quotes themselves, rather than at the top, so importing this module doesn't pay for it.
+
+    def quote_debt_ratio(self, eth, usm):
+        import numpy as np
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(eth * self.eth_price == 0, 0, usm / (eth * self.eth_price))
+
+    def quote_mint_usm(self, eth_sizes):
+        import numpy as np
+        eth_sizes = np.asarray(eth_sizes, dtype=float)
+        usm_minted = (eth_sizes * self.eth_price) * (1 - self.USM_MINT_FEE)
+        return make_quote(eth_sizes, usm_minted, self.quote_debt_ratio(self.pool_eth + eth_sizes, self.usm_outstanding() + usm_minted), np.zeros(eth_sizes.shape, dtype=bool))
+
+    def quote_burn_usm(self, usm_sizes, user=None):
+        import numpy as np
+        usm_sizes = np.asarray(usm_sizes, dtype=float)
+        eth_removed = (usm_sizes / self.eth_price) * (1 - self.USM_BURN_FEE)
+        debt_ratio_after = self.quote_debt_ratio(self.pool_eth - eth_removed, self.usm_outstanding() - usm_sizes)
+        rejected = (usm_sizes > (self.usm_outstanding() if user is None else self.usm_holdings.get(user, 0))) | (eth_removed > self.pool_eth) | (debt_ratio_after > 1)
+        return make_quote(usm_sizes, eth_removed, debt_ratio_after, rejected)
+
+    def quote_create_fum_from_eth(self, eth_sizes):
+        import numpy as np
+        eth_sizes = np.asarray(eth_sizes, dtype=float)
+        fum_created = self.quote_fum_created(self.pool_eth, self.usm_outstanding(), self.min_fum_buy_price_in_eth, eth_sizes)
+        return make_quote(eth_sizes, fum_created, self.quote_debt_ratio(self.pool_eth + eth_sizes, self.usm_outstanding()), ~np.isfinite(fum_created))
+
+    def quote_create_fum_from_usm(self, usm_sizes, user=None):
+        # Like create_fum_from_usm(): a 0-fee burn, then (once clear_min_fum_buy_price_if_obsolete() has had its say) a fund with the ETH it yields, priced from the state the burn leaves:
+        import numpy as np
+        usm_sizes = np.asarray(usm_sizes, dtype=float)
+        eth_converted = usm_sizes / self.eth_price
+        pool_eth_after_burn, usm_after_burn = self.pool_eth - eth_converted, self.usm_outstanding() - usm_sizes
+        min_fum_buy_price_after_burn = np.where(self.quote_debt_ratio(pool_eth_after_burn, usm_after_burn) <= self.MAX_DEBT_RATIO, 0, self.min_fum_buy_price_in_eth)
+        fum_created = self.quote_fum_created(pool_eth_after_burn, usm_after_burn, min_fum_buy_price_after_burn, eth_converted)
+        rejected = (usm_sizes > (self.usm_outstanding() if user is None else self.usm_holdings.get(user, 0))) | (eth_converted > self.pool_eth) | ~np.isfinite(fum_created)
+        return make_quote(usm_sizes, fum_created, self.quote_debt_ratio(self.pool_eth, usm_after_burn), rejected)
+
+    def quote_redeem_fum(self, fum_sizes, user=None):
+        import numpy as np
+        fum_sizes = np.asarray(fum_sizes, dtype=float)
+        eth_removed = (fum_sizes * self.fum_price(SELL)) / self.eth_price
+        debt_ratio_after = self.quote_debt_ratio(self.pool_eth - eth_removed, self.usm_outstanding())
+        rejected = (fum_sizes > (self.fum_outstanding() if user is None else self.fum_holdings.get(user, 0))) | ~(debt_ratio_after <= self.MAX_DEBT_RATIO)  # ~(<=), so a NaN (no FUM yet) is rejected too
+        return make_quote(fum_sizes, eth_removed, debt_ratio_after, rejected)
+
+    def quote_fum_created(self, eth, usm, min_fum_buy_price, eth_sizes):
+        # FUM that create_fum_from_eth() would create for eth_sizes, if the pool held eth and usm (which may be arrays, one state per size), with the given min FUM buy price.  Like the op, this has to
+        # split each size into the part that brings debt ratio down to MAX_DEBT_RATIO, bought at the current FUM buy price (incl. the min FUM buy price), and the rest, bought after the min is cleared:
+        import numpy as np
+        eth, usm, eth_sizes = np.broadcast_arrays(np.asarray(eth, dtype=float), np.asarray(usm, dtype=float), eth_sizes)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            above_max_dr = self.quote_debt_ratio(eth, usm) > self.MAX_DEBT_RATIO
+            eth_add_that_would_bring_us_to_max_dr = (usm / self.eth_price) / self.MAX_DEBT_RATIO - eth
+            eth_to_add_above_max_dr = np.where(above_max_dr, np.maximum(0, np.minimum(eth_sizes, eth_add_that_would_bring_us_to_max_dr)), 0)
+            fum_created_above_max_dr = np.where(above_max_dr, (eth_to_add_above_max_dr * self.eth_price) / self.quote_fum_buy_price(eth, usm, self.fum_outstanding(), min_fum_buy_price), 0)
+            eth_to_add_below_max_dr = eth_sizes - eth_to_add_above_max_dr
+            min_fum_buy_price_below_max_dr = np.where(above_max_dr & (eth_to_add_below_max_dr > 0), 0, min_fum_buy_price)     # See clear_min_fum_buy_price_if_obsolete(True) in create_fum_from_eth()
+            fum_buy_price_below_max_dr = self.quote_fum_buy_price(eth + eth_to_add_above_max_dr, usm, self.fum_outstanding() + fum_created_above_max_dr, min_fum_buy_price_below_max_dr)
+            fum_created_below_max_dr = (eth_to_add_below_max_dr * self.eth_price) / fum_buy_price_below_max_dr
+        return fum_created_above_max_dr + fum_created_below_max_dr
+
+    def quote_fum_buy_price(self, eth, usm, fum, min_fum_buy_price):
+        # fum_price(BUY), for a pool holding eth, usm and fum:
+        import numpy as np
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(fum == 0, 1, np.maximum(((eth * self.eth_price - usm) / fum) / (1 - self.FUM_CREATE_FEE), min_fum_buy_price * self.eth_price))
 
-def fum_price(side):
-    if fum_outstanding() == 0:
-        if side == BUY:
-            return 1        # Pricing our first FUM purchase, so just price them at $1
+
+    # Exact-output solvers:
+
+    # The inverses of the ops: the input needed to get exactly a given output, from the current state, in O(1) rather than by searching over repeated forward calls.  Passing the result to the forward
+    # op gets back the requested output, to within float rounding.  (No solver for create_fum_from_usm(): its fund half is priced from the state its burn half leaves.)
+
+    def eth_to_mint_usm(self, usm_to_mint):
+        return usm_to_mint / self.eth_price / (1 - self.USM_MINT_FEE)
+
+    def usm_to_burn_for_eth(self, eth_to_remove):
+        return eth_to_remove * self.eth_price / (1 - self.USM_BURN_FEE)
+
+    def eth_to_create_fum(self, fum_to_create):
+        # The inverse of create_fum_from_eth()'s split: if we're above MAX_DEBT_RATIO, the first FUM cost the current FUM buy price (incl. the min FUM buy price), up to the amount that brings debt
+        # ratio back down to MAX_DEBT_RATIO; any more cost the FUM buy price from there on, with the min FUM buy price cleared.
+        if self.debt_ratio() > self.MAX_DEBT_RATIO:
+            eth_add_that_would_bring_us_to_max_dr = (self.usm_outstanding() / self.eth_price) / self.MAX_DEBT_RATIO - self.pool_eth
+            fum_created_above_max_dr = (eth_add_that_would_bring_us_to_max_dr * self.eth_price) / self.fum_price(BUY)
+            if fum_to_create <= fum_created_above_max_dr:
+                return fum_to_create * self.fum_price(BUY) / self.eth_price
+            buffer_value_at_max_dr = (self.pool_eth + eth_add_that_would_bring_us_to_max_dr) * self.eth_price - self.usm_outstanding()
+            fum_price_at_max_dr = max((buffer_value_at_max_dr / (self.fum_outstanding() + fum_created_above_max_dr)) / (1 - self.FUM_CREATE_FEE), 0)  # fum_price(BUY), once the min is cleared
+            return eth_add_that_would_bring_us_to_max_dr + (fum_to_create - fum_created_above_max_dr) * fum_price_at_max_dr / self.eth_price
+        return fum_to_create * self.fum_price(BUY) / self.eth_price
+
+    def fum_to_redeem_for_eth(self, eth_to_remove):
+        assert self.fum_price(SELL) > 0, "FUM can't be redeemed at a sell price of {}".format(self.fum_price(SELL))
+        return eth_to_remove * self.eth_price / self.fum_price(SELL)
+
+
+    # Informational utility functions:
+
+    def usm_outstanding(self):
+        return self.usm_supply
+
+    def fum_outstanding(self):
+        return self.fum_supply
+
+    def check_supply_totals(self):
+        # Slow (sums over every holder), so only for debugging: catches any drift between the running totals and the actual holdings, beyond float rounding error.
+        usm_recount, fum_recount = math.fsum(self.usm_holdings.values()), math.fsum(self.fum_holdings.values())
+        assert math.isclose(self.usm_supply, usm_recount, rel_tol=1e-9, abs_tol=1e-9), "usm_supply {} has drifted from recount {}".format(self.usm_supply, usm_recount)
+        assert math.isclose(self.fum_supply, fum_recount, rel_tol=1e-9, abs_tol=1e-9), "fum_supply {} has drifted from recount {}".format(self.fum_supply, fum_recount)
+
+    def pool_value(self, eth=None):
+        if eth is None:
+            eth = self.pool_eth
+        return eth * self.eth_price
+
+    def buffer_value(self):
+        return self.pool_value() - self.usm_outstanding()
+
+    def debt_ratio(self, eth=None, usm=None):
+        if eth is None:
+            eth = self.pool_eth
+        if usm is None:
+            usm = self.usm_outstanding()
+        if self.pool_value(eth) == 0:
+            return 0
         else:
-            return math.nan
-    else:
-        price = buffer_value() / fum_outstanding()
-        if side == BUY:
-            return max(price / (1 - FUM_CREATE_FEE), min_fum_buy_price_in_eth * eth_price)
-        elif side == SELL:
-            return max(price * (1 - FUM_REDEEM_FEE), 0)
+            return usm / self.pool_value(eth)
+
+    def fum_price(self, side):
+        if self.fum_outstanding() == 0:
+            if side == BUY:
+                return 1        # Pricing our first FUM purchase, so just price them at $1
+            else:
+                return math.nan
         else:
-            return price
+            price = self.buffer_value() / self.fum_outstanding()
+            if side == BUY:
+                return max(price / (1 - self.FUM_CREATE_FEE), self.min_fum_buy_price_in_eth * self.eth_price)
+            elif side == SELL:
+                return max(price * (1 - self.FUM_REDEEM_FEE), 0)
+            else:
+                return price
+
+
+# Quote helper (for the quote_*() methods above):
+
+def make_quote(sizes, output, debt_ratio_after, rejected):
+    import numpy as np
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return Quote(output, sizes / output, debt_ratio_after, rejected)
 
-main()
+if __name__ == '__main__':
+    main()
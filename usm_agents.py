@@ -0,0 +1,411 @@
+import abc
+import argparse
+import collections
+import contextlib
+import importlib
+import itertools
+import math
+import os
+from time import perf_counter
+
+import numpy as np
+
+import usm_feed
+import usm_metrics
+import usm_recorder
+
+# Stress-tests a model with populations of automated agents, each population following one strategy: arbitrageurs trading the pool against an external market price (which the oracle only
+# reports after a lag), panic redeemers who dump their USM/FUM once the debt ratio or the ETH price crosses their threshold, and FUM dip-buyers who buy FUM once it's cheap enough relative to
+# its recent price (which, while the min FUM buy price is set, means waiting for that floor to decay), and sell once it's recovered.  Eg:
+#   python usm_agents.py usm_constproduct --blocks 2000 --crash 0.5 --crash-block 500 --crash-blocks 100
+# Each simulated block: the external price moves, the oracle reports (the external price from --oracle-lag blocks ago), and every agent decides what to do, against one cached snapshot of the
+# pool's prices.  Each strategy decides for all its agents at once, with NumPy over arrays of their balances and thresholds, pricing any orders it's considering with the model's vectorized
+# quote_*() functions; only the resulting orders are run one at a time through the ops, in a random order, each against the state the previous one left (so eg the first arbitrageur to mint
+# gets the best price, and the ones after it pay the adjustment it caused).  At the end, reports each strategy's PnL and the stress the pool was under.
+
+BLOCK_SECONDS = 13
+DAY = 24 * 60 * 60
+GENESIS = 'genesis'                                                                 # Mints all the USM and funds all the FUM the agents start with, then transfers it to them
+
+OPS = {'mint': ('mint_usm', 'eth', 'usm'), 'burn': ('burn_usm', 'usm', 'eth'),     # Op -> (model function, balance it takes from, balance it pays into)
+       'fund': ('create_fum_from_eth', 'eth', 'fum'), 'defund': ('redeem_fum', 'fum', 'eth')}
+QUOTES = {'mint': 'quote_mint_usm', 'burn': 'quote_burn_usm', 'fund': 'quote_create_fum_from_eth', 'defund': 'quote_redeem_fum'}
+
+Snapshot = collections.namedtuple('Snapshot', 'block time market_price eth_price usm_bid usm_ask fum_bid fum_ask fum_mid debt_ratio min_fum_buy_price_in_eth')
+
+def take_snapshot(model, block, market_price):
+    # The pool's prices (in USD) at the start of a block, computed once for all the agents deciding against them:
+    return Snapshot(block, usm_metrics.sim_time(model), market_price, usm_metrics.eth_mid_price(model), *usm_metrics.usm_bid_ask(model), *usm_metrics.fum_bid_ask(model),
+                    usm_metrics.fum_mid_price(model), model.debt_ratio(), usm_metrics.min_fum_buy_price_in_eth(model))
+
+# ________________________________________ Strategies ________________________________________
+
+class Strategy(abc.ABC):
+    """n agents following one strategy.  Their external wallets (ETH, at the market price) and their USM and FUM balances (mirroring the model's holdings, and kept in sync by filled()) are
+    arrays indexed by agent, as are any per-agent parameters, so decide() can look at every agent at once.  Each agent's parameters are drawn at random, so the population isn't in lockstep.
+    Subclasses must define allocation() and decide(): one missing either can't be instantiated, so it fails when the population is built, not mid-simulation."""
+
+    name = None
+
+    def __init__(self, n, rng):
+        self.n = n
+        self.rng = rng
+        self.users = ['{}{}'.format(self.name, i) for i in range(n)]
+        self.eth = np.zeros(n)
+        self.usm = np.zeros(n)
+        self.fum = np.zeros(n)
+        self.initial = None                                                         # (eth, usm, fum) once the simulation starts, for pnl()
+        self.trades = np.zeros(n, dtype=np.int64)                                   # Orders filled, by agent
+        self.counts = collections.Counter()                                         # (op, 'orders'/'rejected'/'blocked') -> count: blocked orders weren't placed, since the quote said they'd be rejected
+        self.volume = collections.Counter()                                         # op -> total input filled (eg, ETH for mints)
+
+    @abc.abstractmethod
+    def allocation(self, capital):
+        # The (eth, usm, fum) each agent starts with, given their capital in USD: the USM and FUM are transferred to them by the genesis account, and fum is in USD, converted at the FUM
+        # price once it exists.
+        pass
+
+    @abc.abstractmethod
+    def decide(self, snapshot, model):
+        # Returns this block's orders, as a list of (op, agent indices, amounts).
+        pass
+
+    def start(self):
+        self.initial = (self.eth.copy(), self.usm.copy(), self.fum.copy())
+
+    def filled(self, agent, op, amount, result):
+        _, source, destination = OPS[op]
+        getattr(self, source)[agent] -= amount
+        getattr(self, destination)[agent] += result
+        self.trades[agent] += 1
+        self.volume[op] += amount
+
+    def value(self, market_price, fum_price, holdings=None):
+        # Each agent's mark-to-market value in USD: ETH at the market price, USM at $1, FUM at the pool's mid price.
+        eth, usm, fum = (self.eth, self.usm, self.fum) if holdings is None else holdings
+        return eth * market_price + usm + (0 if math.isnan(fum_price) else fum * fum_price)       # (No FUM price, ie NaN, if the pool has no FUM left)
+
+    def pnl(self, market_price, fum_price):
+        # Each agent's value now, minus what their starting balances would be worth now if they'd just held them: so trading profit, net of the market moving under everyone.
+        return self.value(market_price, fum_price) - self.value(market_price, fum_price, self.initial)
+
+class Arbitrageur(Strategy):
+    """Trades the pool against the external market, where USM is worth $1 and ETH the market price: mints when the pool pays more USM per ETH than the market (eg, the market has dropped but
+    the oracle hasn't caught up yet), burns when it pays more ETH per USM.  Each agent looks at the pool each block with probability reaction, trades trade_fraction of the relevant balance,
+    and only if the quoted fill beats the market by at least min_edge."""
+
+    name = 'arb'
+
+    def __init__(self, n, rng):
+        super().__init__(n, rng)
+        self.min_edge = rng.uniform(0.001, 0.01, n)
+        self.reaction = rng.uniform(0.05, 0.5, n)
+        self.trade_fraction = rng.uniform(0.1, 0.5, n)
+
+    def allocation(self, capital):
+        return capital / 2, capital / 2, 0
+
+    def decide(self, snapshot, model):
+        orders = []
+        looking = self.rng.random(self.n) < self.reaction
+        minting = np.zeros(self.n, dtype=bool)
+        agents = np.flatnonzero(looking & (self.eth > 0))
+        if len(agents):
+            sizes = self.eth[agents] * self.trade_fraction[agents]
+            quote = model.quote_mint_usm(sizes)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                edge = quote.output / (sizes * snapshot.market_price) - 1
+            go = ~quote.rejected & (edge > self.min_edge[agents])
+            orders.append(('mint', agents[go], sizes[go]))
+            minting[agents[go]] = True
+        agents = np.flatnonzero(looking & ~minting & (self.usm > 0))
+        if len(agents):
+            sizes = self.usm[agents] * self.trade_fraction[agents]
+            quote = model.quote_burn_usm(sizes)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                edge = quote.output * snapshot.market_price / sizes - 1
+            go = ~quote.rejected & (edge > self.min_edge[agents])
+            orders.append(('burn', agents[go], sizes[go]))
+        return orders
+
+class PanicRedeemer(Strategy):
+    """Holds USM and FUM, and panics once the debt ratio rises above its panic_debt_ratio, or the market price falls panic_drawdown below its peak so far.  From then on, with probability
+    reaction each block, it burns sell_fraction of its USM and redeems sell_fraction of its FUM (all of what's left, once that's small), at whatever price it gets.  It only checks the
+    quotes to see whether the pool would reject the order (eg, a redeem once the debt ratio is above MAX_DEBT_RATIO): if so it's counted as blocked, and the agent tries again next block."""
+
+    name = 'panic'
+
+    def __init__(self, n, rng):
+        super().__init__(n, rng)
+        self.panic_debt_ratio = rng.uniform(0.65, 0.95, n)
+        self.panic_drawdown = rng.uniform(0.1, 0.5, n)
+        self.reaction = rng.uniform(0.2, 1, n)
+        self.sell_fraction = rng.uniform(0.25, 1, n)
+        self.panicked = np.zeros(n, dtype=bool)
+        self.peak_price = 0
+
+    def allocation(self, capital):
+        return 0, capital * 0.8, capital * 0.2
+
+    def decide(self, snapshot, model):
+        self.peak_price = max(self.peak_price, snapshot.market_price)
+        self.panicked |= (snapshot.debt_ratio > self.panic_debt_ratio) | (snapshot.market_price < self.peak_price * (1 - self.panic_drawdown))
+        acting = self.panicked & (self.rng.random(self.n) < self.reaction)
+        orders = []
+        for op, balances, dust in (('burn', self.usm, 1), ('defund', self.fum, 1e-3)):
+            agents = np.flatnonzero(acting & (balances > 0))
+            if len(agents):
+                sizes = balances[agents] * self.sell_fraction[agents]
+                sizes = np.where(balances[agents] - sizes < dust, balances[agents], sizes)
+                rejected = getattr(model, QUOTES[op])(sizes).rejected
+                self.counts[(op, 'blocked')] += int(rejected.sum())
+                orders.append((op, agents[~rejected], sizes[~rejected]))
+        return orders
+
+class DipBuyer(Strategy):
+    """Holds ETH, and buys FUM once its quoted fill price (in ETH) is dip below the FUM's reference price: an average of the pool's FUM mid price (in ETH) over the last
+    REFERENCE_HALF_LIFE or so.  Since the FUM buy price includes the min FUM buy price, after a crash the dip-buyers wait for that floor to decay, and the ones with the smallest dip
+    thresholds are the first to buy as it does.  Sells all its FUM once their quoted proceeds are take_profit above what it paid.  Looks at the pool each block with probability reaction."""
+
+    name = 'dip'
+    REFERENCE_HALF_LIFE = 6 * 60 * 60
+
+    def __init__(self, n, rng):
+        super().__init__(n, rng)
+        self.dip = rng.uniform(0.05, 0.3, n)
+        self.take_profit = rng.uniform(0.05, 0.5, n)
+        self.reaction = rng.uniform(0.05, 0.3, n)
+        self.trade_fraction = rng.uniform(0.2, 1, n)
+        self.cost = np.zeros(n)                                                     # ETH paid for the FUM each agent holds
+        self.reference_price = None
+        self.reference_time = None
+
+    def allocation(self, capital):
+        return capital, 0, 0
+
+    def decide(self, snapshot, model):
+        orders = []
+        fum_mid_in_eth = snapshot.fum_mid / snapshot.eth_price
+        if self.reference_price is None or math.isnan(self.reference_price):
+            self.reference_price, self.reference_time = fum_mid_in_eth, snapshot.time
+        looking = self.rng.random(self.n) < self.reaction
+        targets = self.reference_price * (1 - self.dip)
+        agents = np.flatnonzero(looking & (self.eth > 0) & (self.fum == 0) & (snapshot.fum_ask / snapshot.eth_price <= targets))    # The ask is the best price: skip quoting anyone it's already above
+        if len(agents):
+            sizes = self.eth[agents] * self.trade_fraction[agents]
+            quote = model.quote_create_fum_from_eth(sizes)
+            go = ~quote.rejected & (quote.price <= targets[agents])
+            orders.append(('fund', agents[go], sizes[go]))
+        agents = np.flatnonzero(looking & (self.fum > 0))
+        if len(agents):
+            quote = model.quote_redeem_fum(self.fum[agents])
+            go = ~quote.rejected & (quote.output >= self.cost[agents] * (1 + self.take_profit[agents]))
+            orders.append(('defund', agents[go], self.fum[agents][go]))
+        if not math.isnan(fum_mid_in_eth) and snapshot.time > self.reference_time:
+            weight = 0.5 ** ((snapshot.time - self.reference_time) / self.REFERENCE_HALF_LIFE)
+            self.reference_price = weight * self.reference_price + (1 - weight) * fum_mid_in_eth
+            self.reference_time = snapshot.time
+        return orders
+
+    def filled(self, agent, op, amount, result):
+        if op == 'fund':
+            self.cost[agent] += amount
+        elif op == 'defund':
+            self.cost[agent] *= 1 - amount / self.fum[agent]
+        super().filled(agent, op, amount, result)
+
+STRATEGIES = {strategy.name: strategy for strategy in (Arbitrageur, PanicRedeemer, DipBuyer)}
+
+# ________________________________________ Simulation ________________________________________
+
+def random_walk_prices(price, blocks, rng, volatility=0.05, block_seconds=BLOCK_SECONDS, crash=0, crash_block=0, crash_blocks=1):
+    # External ETH prices, one per block: a lognormal random walk with the given daily volatility, plus (if crash) a drop by that fraction, spread evenly over crash_blocks from crash_block.
+    sigma = volatility * math.sqrt(block_seconds / DAY)
+    log_returns = rng.normal(-sigma**2 / 2, sigma, blocks)
+    if crash:
+        log_returns[crash_block:crash_block + crash_blocks] += math.log(1 - crash) / crash_blocks
+    return price * np.exp(np.cumsum(log_returns))
+
+def tick_file_prices(path, blocks=None):
+    # External ETH prices from a tick file (see usm_feed.py), one tick per block: the mid of each tick's sell and buy prices.
+    return ((sell_price + buy_price) / 2 for _, sell_price, buy_price in itertools.islice(usm_feed.read_ticks(path), blocks))
+
+class Simulation:
+    def __init__(self, model, strategies, rng, block_seconds=BLOCK_SECONDS, oracle_lag=5, oracle_spread=0.002, recorder=None):
+        self.model = model
+        self.strategies = strategies
+        self.rng = rng
+        self.block_seconds = block_seconds
+        self.oracle_spread = oracle_spread
+        self.recent_prices = collections.deque(maxlen=oracle_lag + 1)              # The oracle reports the oldest of these
+        self.recorder = recorder
+        self.constproduct = usm_metrics.is_constproduct(model)
+        self.block = 0
+        self.market_price = None
+        self.stress = []                                                            # Per block: STRESS_COLUMNS
+        self.elapsed = 0
+
+    STRESS_COLUMNS = ('market_price', 'eth_price', 'debt_ratio', 'min_fum_buy_price_in_eth', 'mint_burn_adjustment', 'fund_defund_adjustment', 'orders', 'rejected')
+
+    def set_oracle_price(self, price):
+        sell_price, buy_price = price * (1 - self.oracle_spread / 2), price * (1 + self.oracle_spread / 2)
+        if self.constproduct:
+            self.model.set_oracle_eth_price(sell_price, buy_price)
+        else:
+            self.model.change_eth_price((sell_price + buy_price) / 2)
+
+    def setup(self, price, capital, debt_ratio):
+        # Starts the pool from scratch, at the given market price: the genesis account mints all the USM the agents start with, and funds enough FUM to bring the debt ratio down to
+        # debt_ratio, then transfers each agent its allocation (see Strategy.allocation()).  Each agent's capital in USD is drawn from a lognormal distribution with mean capital.
+        model = self.model
+        model.reset_state()
+        self.market_price = price
+        self.recent_prices.append(price)
+        self.set_oracle_price(price)
+        allocations = []
+        for strategy in self.strategies:
+            capitals = self.rng.lognormal(math.log(capital) - 0.5, 1, strategy.n)
+            allocations.append([np.broadcast_to(np.asarray(amount, dtype=float), (strategy.n,)) for amount in strategy.allocation(capitals)])
+        total_usm = sum(usm.sum() for _, usm, _ in allocations)
+        total_fum_value = sum(fum.sum() for _, _, fum in allocations)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            model.prepare_for_next_command()
+            model.mint_usm(GENESIS, model.eth_to_mint_usm(total_usm))                # The pool's very first ETH, so minted at the oracle price, with no adjustment
+            model.prepare_for_next_command()
+            model.create_fum_from_eth(GENESIS, max(total_usm / (debt_ratio * usm_metrics.eth_mid_price(model)) - model.pool_eth, total_fum_value / usm_metrics.eth_mid_price(model)))
+            model.prepare_for_next_command()
+        usm_scale = min(1, model.usm_holdings[GENESIS] / total_usm) if total_usm else 1                                    # (Eg, usm.py's mint fee may leave a hair less than asked for)
+        fum_price = usm_metrics.fum_mid_price(model)
+        fum_scale = min(1, model.fum_holdings[GENESIS] * fum_price / total_fum_value) if total_fum_value else 1
+        for strategy, (eth, usm, fum) in zip(self.strategies, allocations):
+            strategy.eth[:] = eth / price
+            for agent, user in enumerate(strategy.users):
+                if usm[agent]:
+                    strategy.usm[agent] = transfer(model.change_usm_holding, GENESIS, user, usm[agent] * usm_scale)
+                if fum[agent]:
+                    strategy.fum[agent] = transfer(model.change_fum_holding, GENESIS, user, fum[agent] / fum_price * fum_scale)
+            strategy.start()
+
+    def step(self, market_price):
+        model = self.model
+        start = perf_counter()
+        self.block += 1
+        self.market_price = market_price
+        self.recent_prices.append(market_price)
+        model.prepare_for_next_command()
+        if self.constproduct:
+            model.set_time(model.time + self.block_seconds)
+        self.set_oracle_price(self.recent_prices[0])
+        model.prepare_for_next_command()
+
+        snapshot = take_snapshot(model, self.block, market_price)
+        orders = [(strategy, op, agents, amounts) for strategy in self.strategies for op, agents, amounts in strategy.decide(snapshot, model)]
+        orders = [(strategy, op, agent, amount) for strategy, op, agents, amounts in orders for agent, amount in zip(agents.tolist(), amounts.tolist())]
+        rejected = 0
+        for i in self.rng.permutation(len(orders)):                                # A random order each block, so no strategy (or agent) always goes first
+            strategy, op, agent, amount = orders[i]
+            strategy.counts[(op, 'orders')] += 1
+            model.prepare_for_next_command()
+            try:
+                result = getattr(model, OPS[op][0])(strategy.users[agent], amount)
+            except Exception:
+                strategy.counts[(op, 'rejected')] += 1
+                rejected += 1
+            else:
+                strategy.filled(agent, op, amount, result)
+        model.prepare_for_next_command()
+
+        self.stress.append((market_price, usm_metrics.eth_mid_price(model), model.debt_ratio(), usm_metrics.min_fum_buy_price_in_eth(model))
+                           + usm_metrics.adjustment_factors(model) + (len(orders), rejected))
+        if self.recorder is not None:
+            self.recorder.record()
+        self.elapsed += perf_counter() - start
+
+    def run(self, prices):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):     # Silence the min FUM buy price messages
+            for price in prices:
+                self.step(float(price))
+
+    def report(self):
+        model = self.model
+        fum_price = usm_metrics.fum_mid_price(model)
+        agents = sum(strategy.n for strategy in self.strategies)
+        lines = ["{:<8} {:>7} {:>7} {:>9} {:>9} {:>9} {:>14} {:>11} {:>11} {:>11} {:>11} {:>7}".format(
+            "strategy", "agents", "traded", "orders", "rejected", "blocked", "total PnL $", "mean $", "p5 $", "median $", "p95 $", "% up")]
+        for strategy in self.strategies:
+            pnl = strategy.pnl(self.market_price, fum_price)
+            totals = collections.Counter()
+            for (_, kind), count in strategy.counts.items():
+                totals[kind] += count
+            p5, median, p95 = np.percentile(pnl, [5, 50, 95]) if strategy.n else (0, 0, 0)
+            lines.append("{:<8} {:>7,} {:>7,} {:>9,} {:>9,} {:>9,} {:>14,.0f} {:>11,.2f} {:>11,.2f} {:>11,.2f} {:>11,.2f} {:>6.1%}".format(
+                strategy.name, strategy.n, int((strategy.trades > 0).sum()), totals['orders'], totals['rejected'], totals['blocked'], pnl.sum(), pnl.mean() if strategy.n else 0,
+                p5, median, p95, (pnl > 0).mean() if strategy.n else 0))
+        for strategy in self.strategies:
+            ops = ", ".join("{} {:,} ({:,} rejected, {:,} blocked, {:,.2f} {} filled)".format(
+                op, strategy.counts[(op, 'orders')], strategy.counts[(op, 'rejected')], strategy.counts[(op, 'blocked')], strategy.volume[op], OPS[op][1].upper())
+                for op in OPS if strategy.counts[(op, 'orders')] or strategy.counts[(op, 'blocked')])
+            lines.append("{}: {}".format(strategy.name, ops or "no orders"))
+
+        stress = np.array(self.stress).reshape(-1, len(self.STRESS_COLUMNS))
+        market_price, eth_price, debt_ratio, min_fum_buy_price, mint_burn_adjustment, fund_defund_adjustment, orders, rejected = stress.T
+        if len(stress):
+            lines.append("")
+            lines.append("Pool stress over {:,} blocks: debt ratio peak {:.2%} (final {:.2%}), above MAX_DEBT_RATIO for {:,} blocks, min FUM buy price set for {:,} blocks".format(
+                len(stress), debt_ratio.max(), model.debt_ratio(), int((debt_ratio > model.MAX_DEBT_RATIO).sum()), int((min_fum_buy_price > 0).sum())))
+            lines.append("Oracle vs market: max deviation {:.2%}; adjustments: mint/burn {:.4f} to {:.4f}, fund/defund {:.4f} to {:.4f}".format(
+                np.abs(eth_price / market_price - 1).max(), mint_burn_adjustment.min(), mint_burn_adjustment.max(), fund_defund_adjustment.min(), fund_defund_adjustment.max()))
+            lines.append("Orders: {:,} ({:,} rejected), busiest block {:,}; market ETH ${:,.2f} -> ${:,.2f}; pool {:,.2f} ETH, {:,.2f} USM, {:,.2f} FUM".format(
+                int(orders.sum()), int(rejected.sum()), int(orders.max()), market_price[0], market_price[-1], model.pool_eth, model.usm_outstanding(), model.fum_outstanding()))
+            lines.append("{:,} agents x {:,} blocks in {:.3f}s = {:,.0f} agent-steps/sec, {:,.0f} orders/sec".format(
+                agents, len(stress), self.elapsed, agents * len(stress) / self.elapsed if self.elapsed > 0 else math.inf, orders.sum() / self.elapsed if self.elapsed > 0 else math.inf))
+        return "\n".join(lines)
+
+def transfer(change_holding, from_user, to_user, amount):
+    # Moves amount of USM or FUM (whichever holdings change_holding updates) between holders, leaving the supply unchanged.  Returns the amount, for the caller's own records.
+    change_holding(from_user, -amount)
+    change_holding(to_user, amount)
+    return amount
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate populations of arbitrageurs, panic redeemers and FUM dip-buyers trading against the pool, and report their PnL and the pool's stress.")
+    parser.add_argument('model', choices=['usm', 'usm_constproduct'])
+    parser.add_argument('--arbitrageurs', type=int, default=2000)
+    parser.add_argument('--panic-redeemers', type=int, default=6000)
+    parser.add_argument('--dip-buyers', type=int, default=2000)
+    parser.add_argument('--capital', type=float, default=10000, help="mean starting capital per agent, in USD")
+    parser.add_argument('--debt-ratio', type=float, default=0.6, help="the pool's debt ratio at the start")
+    parser.add_argument('--blocks', type=int, default=1000)
+    parser.add_argument('--block-seconds', type=float, default=BLOCK_SECONDS)
+    parser.add_argument('--price', type=float, default=200, help="starting market price of ETH")
+    parser.add_argument('--volatility', type=float, default=0.05, help="daily volatility of the market price")
+    parser.add_argument('--crash', type=float, default=0, metavar='FRACTION', help="drop the market price by this fraction...")
+    parser.add_argument('--crash-block', type=int, default=0, help="...starting at this block...")
+    parser.add_argument('--crash-blocks', type=int, default=1, help="...spread over this many blocks")
+    parser.add_argument('--ticks', metavar='FILE', help="take market prices from this tick file (see usm_feed.py), one tick per block, instead of a random walk")
+    parser.add_argument('--oracle-lag', type=int, default=5, metavar='BLOCKS', help="the oracle reports the market price from this many blocks ago")
+    parser.add_argument('--oracle-spread', type=float, default=0.002, help="spread between the oracle's buy and sell prices")
+    parser.add_argument('--record', metavar='FILE', help="record the pool's metrics every block (see usm_recorder.py)")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    model = importlib.import_module(args.model).Pool()
+    rng = np.random.default_rng(args.seed)
+    strategies = [strategy_class(n, rng) for strategy_class, n in ((Arbitrageur, args.arbitrageurs), (PanicRedeemer, args.panic_redeemers), (DipBuyer, args.dip_buyers))]
+    if args.ticks:
+        prices = tick_file_prices(args.ticks, args.blocks)
+        price = next(tick_file_prices(args.ticks, 1))
+    else:
+        prices = random_walk_prices(args.price, args.blocks, rng, args.volatility, args.block_seconds, args.crash, args.crash_block, args.crash_blocks)
+        price = args.price
+    with contextlib.ExitStack() as stack:
+        recorder = stack.enter_context(usm_recorder.Recorder(model, args.record)) if args.record else None
+        simulation = Simulation(model, strategies, rng, args.block_seconds, args.oracle_lag, args.oracle_spread, recorder)
+        simulation.setup(price, args.capital, args.debt_ratio)
+        simulation.run(prices)
+    print(model.status_summary().split('\n')[0])
+    print()
+    print(simulation.report())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import argparse
+
+import numpy as np
+
+import usm
+import usm_constproduct
+import usm_diff
+import usm_metrics
+
+# Checks each model's read-only quotes and exact-output solvers against the ops themselves: replays a random trace (usm_diff.random_trace()) through a pool of each model, and every --every
+# commands, for each user:
+# - quotes each op for a range of sizes, and runs the op at each size on a fork (what_if()), asserting that the two agree: the same sizes rejected, and the rest's outputs within --tolerance;
+# - solves for the input that gives each of the quoted outputs, runs the op on that input on a fork, and asserts that it gives back that output, within --tolerance.  Above MAX_DEBT_RATIO, the
+#   fund sizes also straddle the point where the fund would bring debt ratio back down to it, since usm.py's create_fum_from_eth() (and eth_to_create_fum()) split the fund there.
+# Eg:
+#   python usm_check.py --seed 0 --commands 20000
+#   python usm_check.py --approximate-to-save-gas
+
+MODELS = {'usm': usm, 'usm_constproduct': usm_constproduct}
+
+QUOTED_OPS = {                                                                      # Command -> (quote, op, holdings its sizes are drawn from, or None for the ETH-in ops, which size off pool_eth)
+    'mint':     ('quote_mint_usm', 'mint_usm', None),
+    'burn':     ('quote_burn_usm', 'burn_usm', 'usm_holdings'),
+    'fund_eth': ('quote_create_fum_from_eth', 'create_fum_from_eth', None),
+    'fund_usm': ('quote_create_fum_from_usm', 'create_fum_from_usm', 'usm_holdings'),
+    'defund':   ('quote_redeem_fum', 'redeem_fum', 'fum_holdings'),
+}
+SIZE_FRACTIONS = (1e-4, 0.01, 0.1, 0.5, 1, 1.5)                                     # Sizes checked, as fractions of the user's holding (or pool_eth): 1.5 should be rejected for the holdings ops
+
+SOLVERS = {                                                                         # Command -> (solver, op).  The outputs solved for are the op's quoted outputs, so they're known to be reachable
+    'mint':     ('eth_to_mint_usm', 'mint_usm'),
+    'burn':     ('usm_to_burn_for_eth', 'burn_usm'),
+    'fund_eth': ('eth_to_create_fum', 'create_fum_from_eth'),
+    'defund':   ('fum_to_redeem_for_eth', 'redeem_fum'),
+}
+SOLVE_FRACTIONS = (1e-4, 0.01, 0.1, 0.5, 0.9)                                       # Like SIZE_FRACTIONS, but short of the whole holding, which a solved input a rounding error over would exceed
+SPLIT_FRACTIONS = (0.5, 0.999, 1.001, 2)                                            # Fund sizes checked above MAX_DEBT_RATIO, as fractions of the ETH that would bring debt ratio back down to it
+
+def relative_difference(a, b):
+    return 0 if a == b else abs(a - b) / max(abs(a), abs(b))
+
+def sizes_for(pool, user, holdings_name, fractions):
+    # fractions of the user's holding (or of pool_eth, for the ETH-in ops), or None if there's nothing to size off:
+    base = getattr(pool, holdings_name).get(user, 0) if holdings_name else (pool.pool_eth or 1)
+    return np.array(fractions) * base if base > 0 else None
+
+def quote_sizes(pool, command, sizes, user):
+    quote_name, _, holdings_name = QUOTED_OPS[command]
+    return getattr(pool, quote_name)(sizes, user) if holdings_name else getattr(pool, quote_name)(sizes)
+
+def eth_to_bring_debt_ratio_to_max(pool):
+    # The fund size at which usm.py's create_fum_from_eth() splits: the ETH that brings debt ratio down to MAX_DEBT_RATIO (0 if it's already there or below).
+    return max(0, (pool.usm_outstanding() / usm_metrics.eth_mid_price(pool)) / pool.MAX_DEBT_RATIO - pool.pool_eth)
+
+def check_quotes(pool, user, tolerance):
+    # Checks every QUOTED_OPS quote for user against the op, from pool's current state.  Returns (sizes checked, max relative deviation of a quoted output from the op's).
+    checked, max_deviation = 0, 0
+    for command, (quote_name, op_name, holdings_name) in QUOTED_OPS.items():
+        sizes = sizes_for(pool, user, holdings_name, SIZE_FRACTIONS)
+        if sizes is None:
+            continue
+        quote = quote_sizes(pool, command, sizes, user)
+        for size, output, rejected in zip(sizes.tolist(), quote.output.tolist(), quote.rejected.tolist()):
+            try:
+                actual = pool.what_if(getattr(pool, op_name), user, size)
+            except Exception:
+                actual = None
+            assert rejected == (actual is None), "{} {} {}: {} says {}, but the op {}".format(
+                command, user, size, quote_name, "rejected" if rejected else "accepted ({})".format(output), "failed" if actual is None else "returned {}".format(actual))
+            if actual is not None:
+                deviation = relative_difference(output, actual)
+                assert deviation <= tolerance, "{} {} {}: {} gives {}, but the op returned {}".format(command, user, size, quote_name, output, actual)
+                max_deviation = max(max_deviation, deviation)
+            checked += 1
+    return checked, max_deviation
+
+def check_solvers(pool, user, tolerance):
+    # Checks every SOLVERS solver for user: solves for each output the op is quoted to give, and runs the op on the solved input.  Returns (outputs checked, how many of those were fund sizes
+    # straddling the MAX_DEBT_RATIO split, max relative deviation of the op's output from the one solved for).
+    checked = split_checked = 0
+    max_deviation = 0
+    for command, (solver_name, op_name) in SOLVERS.items():
+        sizes = sizes_for(pool, user, QUOTED_OPS[command][2], SOLVE_FRACTIONS)
+        if sizes is None:
+            continue
+        split_sizes = 0
+        if command == 'fund_eth' and pool.debt_ratio() > pool.MAX_DEBT_RATIO:
+            sizes = np.append(sizes, np.array(SPLIT_FRACTIONS) * eth_to_bring_debt_ratio_to_max(pool))
+            split_sizes = len(SPLIT_FRACTIONS)
+        quote = quote_sizes(pool, command, sizes, user)
+        for i, (target, rejected) in enumerate(zip(quote.output.tolist(), quote.rejected.tolist())):
+            if rejected or not target > 0:
+                continue
+            solved = getattr(pool, solver_name)(target)
+            try:
+                actual = pool.what_if(getattr(pool, op_name), user, solved)
+            except Exception as err:
+                raise AssertionError("{} {}: {}({}) = {}, which the op rejects: {!r}".format(command, user, solver_name, target, solved, err))
+            deviation = relative_difference(actual, target)
+            assert deviation <= tolerance, "{} {}: {}({}) = {}, but the op on that returns {}".format(command, user, solver_name, target, solved, actual)
+            max_deviation = max(max_deviation, deviation)
+            checked += 1
+            split_checked += i >= len(sizes) - split_sizes
+    return checked, split_checked, max_deviation
+
+def run_checks(model_name, lines, every, tolerance, approximate_to_save_gas=False):
+    # Replays lines through a fresh pool of model_name, checking every user's quotes and solvers every every commands.  Returns counts of what was checked, and the max relative deviations.
+    params = {'APPROXIMATE_TO_SAVE_GAS': True} if approximate_to_save_gas and model_name == 'usm_constproduct' else {}
+    pool = MODELS[model_name].Pool(**params)
+    stats = dict.fromkeys(('states', 'quotes', 'quote_max_deviation', 'solves', 'split_solves', 'solve_max_deviation'), 0)
+    with pool.quiet():
+        for step, line in enumerate(lines):
+            words = line.split()
+            pool.prepare_for_next_command()
+            if step % every == 0:
+                for user in usm_diff.USERS:
+                    quotes, quote_max_deviation = check_quotes(pool, user, tolerance)
+                    solves, split_solves, solve_max_deviation = check_solvers(pool, user, tolerance)
+                    stats['quotes'] += quotes
+                    stats['solves'] += solves
+                    stats['split_solves'] += split_solves
+                    stats['quote_max_deviation'] = max(stats['quote_max_deviation'], quote_max_deviation)
+                    stats['solve_max_deviation'] = max(stats['solve_max_deviation'], solve_max_deviation)
+                stats['states'] += 1
+            try:
+                pool.apply_command(words, verbose=False)
+            except Exception:
+                pass
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Check each model's quotes and exact-output solvers against its ops, over the states of a random trace.")
+    parser.add_argument('--model', choices=sorted(MODELS), action='append', help="model to check (repeatable; default: both)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--commands', type=int, default=20000)
+    parser.add_argument('--every', type=int, default=100, metavar='N', help="check every N commands")
+    parser.add_argument('--tolerance', type=float, default=1e-9, help="max relative deviation allowed between a quote or solved-for output and the op's")
+    parser.add_argument('--approximate-to-save-gas', action='store_true', help="check usm_constproduct with APPROXIMATE_TO_SAVE_GAS on")
+    args = parser.parse_args()
+
+    lines = usm_diff.random_trace(args.seed, args.commands)
+    for model_name in args.model or sorted(MODELS):
+        stats = run_checks(model_name, lines, args.every, args.tolerance, args.approximate_to_save_gas)
+        print("{}, over {:,} states:".format(model_name, stats['states']))
+        print("  quotes:  {:,} sizes checked against the ops, max relative deviation {:.3g}".format(stats['quotes'], stats['quote_max_deviation']))
+        print("  solvers: {:,} outputs round-tripped through the ops ({:,} of them fund sizes around the MAX_DEBT_RATIO split), max relative deviation {:.3g}".format(
+            stats['solves'], stats['split_solves'], stats['solve_max_deviation']))
+
+if __name__ == '__main__':
+    main()
@@ -1,324 +1,882 @@
+import collections
+import contextlib
+import copy
 from datetime import datetime, timezone
 import math
 import sys
-import traceback
+from time import perf_counter
 
 # ________________________________________ Constants ________________________________________
 
-# Parameters:
-MAX_DEBT_RATIO                      = 0.8                   # Eg, if 1,000,000 USM are outstanding, users won't be able to redeem FUM unless the ETH pool's (mid) value is >= $1,000,000 / 0.8 = $1,250,000
-BUY_SELL_ADJUSTMENTS_HALF_LIFE      = 60                    # Decay rate of our bid/ask related to recent buy/sell activity (eg, rate of buy price, pushed up by buys, dropping back towards oracle buy price): 1.5 -> 1.2247 -> 1.1067
-MIN_FUM_BUY_PRICE_HALF_LIFE         = 24 * 60 * 60          # min_fum_buy_price_in_eth() drops by 50% every day
-
 # Price side constants:
 MID                                 = 'mid'
 BUY                                 = 'buy'
 SELL                                = 'sell'
 
 # Gas-saving approximation constants:
-APPROXIMATE_TO_SAVE_GAS             = False                 # Switch to True for less accurate, but (hopefully) more gas-efficient calculations
 SHIFT                               = 18                    # Number of decimal digits by which fixed-decimal inputs & outputs are shifted.
 ONE_SHIFTED                         = 10**SHIFT
 ONE_TENTH_SHIFTED                   = ONE_SHIFTED // 10
 HALF_TO_THE_ONE_TENTH_SHIFTED       = 933032991536807416    # Basically round(0.5**0.1 * ONE_SHIFTED), except Python doesn't calc that quite precisely so why not hardcode it here (using good old wolframalpha.com)
+HALF_EXP_TABLE_MAX_BITS             = 32                    # Most bits half_exp_table_approx() (and so Pool.HALF_EXP_TABLE_BITS) can use
+HALF_TO_THE_HALF_TO_THE_K_SHIFTED   = None                  # [k] = round(0.5**(1/2**k) * ONE_SHIFTED): filled in by half_exp_table() the first time it's needed, rather than on every import
 
-
-# ________________________________________ State variables ________________________________________
-
-time                                = datetime(2020, 8, 1, tzinfo=timezone.utc).timestamp()
-oracle_eth_buy_price                = 202
-oracle_eth_sell_price               = 198
-pool_eth                            = 0
-usm_holdings                        = {}
-fum_holdings                        = {}
-mint_burn_adjustment_stored         = 1                     # Price multiplier based on recent mint/burn activity.  Eg, if A just did mint ops driving the ETH sell price down by 0.7x, and B just burned pushing ETH buy price up 1.2x, this factor will be 0.84.  Decays towards 1 over time.
-mint_burn_adjustment_timestamp      = 0
-fund_defund_adjustment_stored       = 1                     # Same as above, but for funds (increases factor)/defunds (decreases factor).
-fund_defund_adjustment_timestamp    = 0
-min_fum_buy_price_in_eth_stored     = 0                     # Note that this price is in terms of ETH, not USD/USM.
-min_fum_buy_price_timestamp         = 0
+Quote = collections.namedtuple('Quote', 'output price debt_ratio rejected')                                          # What the quote_*() methods return: see "Read-only quotes" below
 
 
 # ________________________________________ Main loop ________________________________________
 
 def main():
-    input_loop()
+    import argparse                                         # The front end's imports are done here, not at the top, so that importing the module just for Pool is fast
+    parser = argparse.ArgumentParser(description="Simulate the USM/FUM pool.  With no arguments, runs an interactive command loop.")
+    parser.add_argument('--replay', metavar='TRACE', help="apply the commands in TRACE (one per line, '-' for stdin) at full speed, instead of prompting for them")
+    parser.add_argument('--summary-every', metavar='N', type=int, default=0, help="while replaying, print the status summary every N commands, not just at the end")
+    parser.add_argument('--batch', action='store_true', help="while replaying, apply each run of ops that share a timestamp as one netted batch (see execute_batch())")
+    args = parser.parse_args()
+    pool = Pool()
+    if args.replay is None:
+        input_loop(pool)
+    elif args.replay == '-':
+        pool.replay(sys.stdin, args.summary_every, args.batch)
+    else:
+        with open(args.replay) as trace:
+            pool.replay(trace, args.summary_every, args.batch)
 
-def input_loop():
+def input_loop(pool):
+    import traceback
     while True:
-        set_min_fum_buy_price_in_eth_if_needed()            # The price calculation here technically may not quite right, because the theoretical FUM price increases (slightly) *during* many ops, as we collect fees...  But #letskeepitsimple
-        clear_min_fum_buy_price_if_obsolete()
-        print(status_summary())
+        pool.prepare_for_next_command()
+        print(pool.status_summary())
         print()
         line = input("> ")
         words = line.split()
         try:
-            if words[0] == "price":
-                # "price 150" -> change the current ETH price (buy and sell) in our simulation to $150, or "price 150/160" -> sell price $150, buy price $160
-                prices = map(float, words[1].split('/'))
-                set_oracle_eth_price(*prices)
-            elif words[0] == "mint":
-                # "mint A 10" -> user A adds 10 ETH to the pool, getting back 10 * eth_sell_price newly-minted USM (minus fees)
-                user, eth_to_add = words[1], float(words[2])
-                usm_minted = mint_usm(user, eth_to_add)
-                print("Minted {:,} new USM for {} from {:,} ETH, for {:,} ETH (~${:,}) each.".format(round(usm_minted, 4), user, round(eth_to_add, 6), round(eth_to_add / usm_minted, 8), round(eth_to_add / usm_minted * calc_eth_price(MID), 6)))
-            elif words[0] == "burn":
-                # "burn A 1000" -> user A burns 1,000 of their USM, getting back (1,000 / eth_buy_price) ETH (minus fees)
-                user, usm_to_burn = words[1], float(words[2])
-                eth_removed = burn_usm(user, usm_to_burn)
-                print("Burned {:,} of {}'s USM for {:,} ETH (~${:,}) each, yielding {:,} ETH.".format(round(usm_to_burn, 4), user, round(eth_removed / usm_to_burn, 8), round(eth_removed / usm_to_burn * calc_eth_price(MID), 6), round(eth_removed, 6)))
-            elif words[0] == "fund_eth":
-                # "fund_eth B 5" -> user B adds 5 ETH to the pool, getting back a corresponding amount of newly-created FUM (based on the current FUM price, roughly buffer_value() / fum_outstanding())
-                user, eth_to_add = words[1], float(words[2])
-                fum_created = create_fum_from_eth(user, eth_to_add)
-                print("Created {:,} new FUM for {} from {:,} ETH, for {:,} ETH (~${:,}) each.".format(round(fum_created, 4), user, round(eth_to_add, 6), round(eth_to_add / fum_created, 8), round(eth_to_add / fum_created * calc_eth_price(MID), 6)))
-            elif words[0] == "fund_usm":
-                # "fund_usm B 1000" -> user B returns (burns) 1000 USM to the pool, getting back a corresponding amount of newly-created FUM (based on the current FUM price).  This leaves total pool value unchanged - basically converting USM to FUM, deceasing debt ratio.
-                user, usm_to_convert = words[1], float(words[2])
-                fum_created = create_fum_from_usm(user, usm_to_convert)
-                print("Created {:,} new FUM for {} from {:,} USM, for {:,} USM (~${:,}) each.".format(round(fum_created, 4), user, round(usm_to_convert, 4), round(usm_to_convert / fum_created, 6), round(usm_to_convert / fum_created, 6)))
-            elif words[0] == "defund":
-                # "defund B 1000" -> user B redeems 1,000 of their FUM, getting back a corresponding amount of ETH (based on the current FUM price)
-                user, fum_to_redeem = words[1], float(words[2])
-                eth_removed = redeem_fum(user, fum_to_redeem)
-                print("Redeemed {:,} of {}'s FUM for {:,} ETH (~${:,}) each, yielding {:,} ETH.".format(round(fum_to_redeem, 4), user, round(eth_removed / fum_to_redeem, 8), round(eth_removed / fum_to_redeem * calc_eth_price(MID), 6), round(eth_removed, 6)))
-            elif words[0] == "wait":
-                # "wait 300" -> wait 300 seconds (5 minutes)
-                wait = float(words[1])
-                set_time(time + wait)
-            else:
-                raise ValueError("Unrecognized command: '{}'".format(words))
+            pool.apply_command(words)
         except Exception as err:
             print("Error:", sys.exc_info())
             traceback.print_tb(err.__traceback__)
 
-def status_summary():
-    time_string = datetime.utcfromtimestamp(time).strftime('%Y/%m/%d %H:%M:%S')
-    min_fum_buy_price_string = "" if min_fum_buy_price_in_eth() == 0 else ", min {:,} ETH (~${:,})".format(round(min_fum_buy_price_in_eth(), 8), round(min_fum_buy_price_in_eth() * calc_eth_price(MID), 6))
-    return "{}: {:,} ETH at ${:,} (${:,}/${:,}) = ${:,} pool value, {:,} USM outstanding (${:,}/${:,}, adj {}), buffer = ${:,}, debt ratio = {:.2%}, {:,} FUM outstanding (${:,}/${:,}{}, adj {})\nUSM holdings: {}\nFUM holdings: {}".format(
-        time_string, round(pool_eth, 6), round(calc_eth_price(MID), 4), round(oracle_eth_sell_price, 4), round(oracle_eth_buy_price, 4), round(pool_value(), 2), round(usm_outstanding(), 4), round(calc_usm_price(SELL), 6), round(calc_usm_price(BUY), 6), round(mint_burn_adjustment(), 6),
-        round(buffer_value(), 2), debt_ratio(), round(fum_outstanding(), 4), round(calc_fum_price(SELL), 6), round(calc_fum_price(BUY), 6), min_fum_buy_price_string, round(fund_defund_adjustment(), 6), usm_holdings, fum_holdings)
-
-
-# ________________________________________ State-modifying operations ________________________________________
-
-def set_time(new_time):
-    global time
-    time = new_time
-
-def set_oracle_eth_price(new_price, new_buy_price=None):
-    global oracle_eth_sell_price, oracle_eth_buy_price
-    oracle_eth_sell_price = new_price
-    oracle_eth_buy_price = new_buy_price if new_buy_price is not None else new_price
-
-    if min_fum_buy_price_needs_setting():
-        # Set the min FUM buy price (in ETH), to the FUM price in ETH as of the ETH price point where the debt ratio exceeded MAX_DEBT_RATIO.  Eg, suppose pool_eth = 400 and fum_outstanding() = 1,000.  Then, at the moment we exceed MAX_DEBT_RATIO = 0.8, the buffer must contain
-        # 400 * (1 - 0.8) = 80 ETH, and therefore the FUM price in ETH is 80 / 1,000 = 0.08.  Eg, suppose USM outstanding = 40,000: then we cross 0.8 at ETH = $125, when total pool value = $50,000, buffer = $10,000, and FUM price = $10,000 / 1,000 = $10 = ($10 / $125) = 0.08 ETH.
-        fum_price_in_eth_at_which_we_crossed_max_debt_ratio = (pool_eth * (1 - MAX_DEBT_RATIO)) / fum_outstanding()
-        set_min_fum_buy_price_in_eth_if_needed(fum_price_in_eth_at_which_we_crossed_max_debt_ratio)
-
-def mint_usm(user, eth_to_add):
-    # Note that minting never pulls us *below* MAX_DEBT_RATIO, since it always moves debt ratio closer to 1.  If debt ratio starts > 1, it stays > 1; if it starts < 1 and > MAX_DEBT_RATIO, it stays > MAX_DEBT_RATIO.
-    global pool_eth
-    initial_eth_price = calc_eth_price(SELL)
-    if pool_eth == 0:
-        # This is our very first ETH in the pool, so need to special-case it (otherwise the division below blows up):
-        usm_minted = eth_to_add * initial_eth_price
-    else:
-        # Mint at a sliding-down ETH price (ie, buy USM at a sliding-up USM price).  **BASIC RULE:** anytime pool_eth changes by factor k, eth_price changes by factor 1/k**2.  (Earlier versions of this logic scaled price by 1/k, not 1/k**2; but that results in calls to log()/exp().)
-        pool_eth_growth_factor = (pool_eth + eth_to_add) / pool_eth
-        usm_minted = pool_eth * initial_eth_price * (1 - 1 / pool_eth_growth_factor)                                # Math: this is an integral - sum of all USM minted at a sliding-down ETH price
-        set_mint_burn_adjustment(mint_burn_adjustment() / pool_eth_growth_factor**2)
-    pool_eth += eth_to_add
-    usm_holdings[user] = usm_holdings.get(user, 0) + usm_minted
-    return usm_minted
-
-def burn_usm(user, usm_to_burn, check_debt_ratio=True):
-    # Note that burning never pushes us over MAX_DEBT_RATIO (which is < 1), since it always moves debt ratio further from 1.  It can pull us *below* MAX_DEBT_RATIO, but if so the top-level call to clear_min_fum_buy_price_if_obsolete() will take care of it once this op is done.
-    global pool_eth
-    assert usm_to_burn <= usm_holdings.get(user, 0), "{} doesn't own that many USM".format(user)
-    initial_eth_price = calc_eth_price(BUY)
-    # Burn at a sliding-up price:
-    eth_removed = usm_to_burn / (initial_eth_price + usm_to_burn / pool_eth)                                        # Math: this is an integral - sum of all USM burned at a sliding price.  Follows the same mathematical invariant as above: if pool_eth *= k, eth_price *= 1/k**2.
-    assert eth_removed <= pool_eth, "Not enough ETH in the pool"
-    if check_debt_ratio:
-        assert debt_ratio(eth=pool_eth - eth_removed, usm=usm_outstanding() - usm_to_burn) <= 1, "Burning {:,} USM would leave the debt ratio above 100%".format(usm_to_burn)   # Note: the risk is not this burn op pushing us over 100%, but that a previous price drop might have done so!
-    pool_eth_shrink_factor = (pool_eth - eth_removed) / pool_eth
-    set_mint_burn_adjustment(mint_burn_adjustment() / pool_eth_shrink_factor**2)
-    usm_holdings[user] -= usm_to_burn
-    pool_eth -= eth_removed
-    return eth_removed
-
-def create_fum_from_eth(user, eth_to_add):
-    # Fund operations never push us over MAX_DEBT_RATIO: they reduce debt ratio.  However, they *can* bring us back *under* MAX_DEBT_RATIO, which means the naive logic here may overcharge an op that pulls debt ratio below MAX_DEBT_RATIO midway through...  But oh well, #letskeepitsimple
-    global pool_eth
-    if fum_outstanding() == 0:
-        # This is our very first FUM created, so need to special-case it (otherwise the division below blows up):
-        fum_created = eth_to_add * calc_eth_price(MID)                                                              # No need for any adjustment: the FUM price only matters relative to an existing FUM price, so we can just price the first FUM units at $1
-    else:
-        # Create at a sliding-up price:
-        initial_fum_price = calc_fum_price(BUY)
-        initial_eth_price_in_fum = calc_eth_price(MID) / initial_fum_price                                          # Don't apply adjustment to the ETH price - the adjustment should only be applied as the last step in a transaction, not when used indirectly for pricing as here.
-        pool_eth_growth_factor = (pool_eth + eth_to_add) / pool_eth
-        fum_created = pool_eth * initial_eth_price_in_fum * (1 - 1 / pool_eth_growth_factor)                        # Math: see closely analogous comment in mint_usm() above
-        set_fund_defund_adjustment(fund_defund_adjustment() * pool_eth_growth_factor**2)
-    pool_eth += eth_to_add
-    fum_holdings[user] = fum_holdings.get(user, 0) + fum_created
-    return fum_created
-
-def create_fum_from_usm(user, usm_to_convert):
-    # To avoid duplication, just implement this as a call to burn_usm() (bypassing the debt ratio check), followed by a call to create_fum_from_eth().  This is a bit hazardous because we could die on an error with half the operation complete, but good enough for govt work:
-    eth_converted = burn_usm(user, usm_to_convert, check_debt_ratio=False)
-    clear_min_fum_buy_price_if_obsolete()                                                                           # Important so that, if the preceding burn brought us below MAX_DEBT_RATIO, we clear the min FUM buy price before starting the fund operation
-    return create_fum_from_eth(user, eth_converted)
-
-def redeem_fum(user, fum_to_redeem):
-    global pool_eth
-    assert fum_to_redeem <= fum_holdings.get(user, 0), "{} doesn't own that many FUM".format(user)
-    initial_fum_price = calc_fum_price(SELL)
-    initial_eth_price_in_fum = calc_eth_price(MID) / initial_fum_price                                              # Don't apply adjustment to the ETH price - see similar comment above.
-    eth_removed = fum_to_redeem / (initial_eth_price_in_fum + fum_to_redeem / pool_eth)                             # Math: see closely analogous comment in burn_usm() above
-    assert debt_ratio(eth=pool_eth - eth_removed) <= MAX_DEBT_RATIO, "Redeeming {:,} FUM would leave the debt ratio above {:.0%}".format(fum_to_redeem, MAX_DEBT_RATIO)
-    # Since we've disallowed redeem operations that would push us over MAX_DEBT_RATIO, we don't need to handle that case.  And a redeem can never pull us under MAX_DEBT_RATIO either, because it increases debt ratio.
-    pool_eth_shrink_factor = (pool_eth - eth_removed) / pool_eth
-    set_fund_defund_adjustment(fund_defund_adjustment() * pool_eth_shrink_factor**2)
-    fum_holdings[user] -= fum_to_redeem
-    pool_eth -= eth_removed
-    return eth_removed
-
-def set_min_fum_buy_price_in_eth_if_needed(price_in_eth=None):
-    global min_fum_buy_price_in_eth_stored, min_fum_buy_price_timestamp
-    if min_fum_buy_price_needs_setting():
-        eth_price = calc_eth_price(MID)
-        if price_in_eth is None:
-            # If no price is passed in, set it to the current theoretical FUM price (without adjustments), in ETH:
-            price_in_usd = calc_fum_price(BUY, adjusted=False, mfbp=False)
-            price_in_eth = price_in_usd / eth_price
+
+# ________________________________________ Pool ________________________________________
+
+class Pool:
+    """One USM/FUM pool: its parameters and its state, and the ops on them.  Pools are independent of each other, so one process can run any number of them side by side.  The parameters
+    below are every pool's defaults: override them for one pool by passing them in, eg Pool(MAX_DEBT_RATIO=0.9), or by setting them on it (then call invalidate_derived_state())."""
+
+    # Parameters:
+    MAX_DEBT_RATIO                      = 0.8                   # Eg, if 1,000,000 USM are outstanding, users won't be able to redeem FUM unless the ETH pool's (mid) value is >= $1,000,000 / 0.8 = $1,250,000
+    BUY_SELL_ADJUSTMENTS_HALF_LIFE      = 60                    # Decay rate of our bid/ask related to recent buy/sell activity (eg, rate of buy price, pushed up by buys, dropping back towards oracle buy price): 1.5 -> 1.2247 -> 1.1067
+    MIN_FUM_BUY_PRICE_HALF_LIFE         = 24 * 60 * 60          # min_fum_buy_price_in_eth() drops by 50% every day
+
+    # Debugging:
+    CHECK_SUPPLY_TOTALS                 = False                 # Switch to True to verify, after every command, that usm_supply/fum_supply still match a full recount of the holdings
+
+    # Derived-state cache:
+    CACHE_DERIVED_STATE                 = False                 # Switch to True to compute each adjustment/price at most once per state change (see decayed() and cached() below): a win for read-heavy use (quotes, status_summary()), not for replaying ops, which change the state every command.  If you change a parameter mid-simulation, call invalidate_derived_state()
+
+    # Gas-saving approximation:
+    APPROXIMATE_TO_SAVE_GAS             = False                 # Switch to True for less accurate, but (hopefully) more gas-efficient calculations
+    USE_HALF_EXP_TABLE                  = False                 # Switch to True to make those calcs round power to the nearest 1/2**HALF_EXP_TABLE_BITS, rather than the nearest 1/10 (see half_exp_table_approx())
+    HALF_EXP_TABLE_BITS                 = 16                    # Eg, 16 -> power is rounded to the nearest 1/65,536, at a cost of at most 16 multiplications
+
+    PARAMETERS                          = ('MAX_DEBT_RATIO', 'BUY_SELL_ADJUSTMENTS_HALF_LIFE', 'MIN_FUM_BUY_PRICE_HALF_LIFE', 'CHECK_SUPPLY_TOTALS', 'CACHE_DERIVED_STATE', 'APPROXIMATE_TO_SAVE_GAS',
+                                           'USE_HALF_EXP_TABLE', 'HALF_EXP_TABLE_BITS')
+    MID, BUY, SELL                      = MID, BUY, SELL        # So code holding just a pool can name the price sides
+
+    # State variables, and the values a new pool (or reset_state()) starts them at:
+    INITIAL_STATE = {
+        'time':                             datetime(2020, 8, 1, tzinfo=timezone.utc).timestamp(),
+        'oracle_eth_buy_price':             202,
+        'oracle_eth_sell_price':            198,
+        'pool_eth':                         0,
+        'usm_holdings':                     {},
+        'fum_holdings':                     {},
+        'usm_supply':                       0,                  # Running total of usm_holdings.values(), so usm_outstanding() doesn't have to sum over every holder
+        'fum_supply':                       0,                  # Same for fum_holdings
+        'mint_burn_adjustment_stored':      1,                  # Price multiplier based on recent mint/burn activity.  Eg, if A just did mint ops driving the ETH sell price down by 0.7x, and B just burned pushing ETH buy price up 1.2x, this factor will be 0.84.  Decays towards 1 over time.
+        'mint_burn_adjustment_timestamp':   0,
+        'fund_defund_adjustment_stored':    1,                  # Same as above, but for funds (increases factor)/defunds (decreases factor).
+        'fund_defund_adjustment_timestamp': 0,
+        'min_fum_buy_price_in_eth_stored':  0,                  # Note that this price is in terms of ETH, not USD/USM.
+        'min_fum_buy_price_timestamp':      0,
+    }
+    STATE_VARIABLES                     = tuple(INITIAL_STATE)
+
+    def __init__(self, **params):
+        for name in params:
+            if name not in self.PARAMETERS:
+                raise TypeError("{} is not a parameter of {}.Pool".format(name, __name__))
+        for name in self.PARAMETERS:
+            setattr(self, name, params.get(name, getattr(self, name)))     # Set on the pool even if it's the default: looking it up there is faster than on the class
+        self.decay_cache = {}                                   # {function name: (state it was computed from, decayed adjustment/min FUM buy price)}: one entry per function, checked against the current state (see decayed())
+        self.price_cache = {}                                   # Prices, keyed by function, args and the approximation flags.  Cleared by every state change, since they depend on all of it (see invalidate_prices())
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.forks = []                                         # Open forks of the state, innermost last: each a journal of {state variable name, or (holdings name, user): value before the fork touched it}.  See fork()
+        self.verbose = True                                     # Print the min FUM buy price messages?  See quiet()
+        self.reset_state()
+
+    # ________________________________________ Commands ________________________________________
+
+    def replay(self, lines, summary_every=0, batch=False):
+        # Like input_loop(), but reads commands from lines (eg, an open trace file, read lazily) rather than prompting, and only prints the status summary every summary_every commands (if nonzero) and at the end - formatting it after every command would dominate the runtime.
+        # With batch, each run of consecutive mint/burn/fund_eth/defund commands (ie, all the ops between two "wait"s or "price"s, which see the same timestamp and oracle prices) is applied as one batch by execute_batch(), rather than one op at a time.
+        commands = errors = 0
+        pending = []                                                                    # (line number, op) for each op of the batch being collected
+        start = perf_counter()
+
+        def flush_batch():
+            nonlocal commands, errors
+            for (line_number, _), result in zip(pending, self.execute_batch([op for _, op in pending])):
+                if isinstance(result, Exception):
+                    errors += 1
+                    print("Error on line {}: {!r}".format(line_number, result), file=sys.stderr)
+                commands += 1
+                if summary_every and commands % summary_every == 0:
+                    print(self.status_summary())
+                    print()
+            pending.clear()
+
+        with self.quiet():                                                                  # The min FUM buy price messages would swamp the output: status_summary() shows the price
+            for line_number, line in enumerate(lines, 1):
+                words = line.split()
+                if not words or words[0].startswith('#'):
+                    continue
+                if batch:
+                    if words[0] in self.BATCH_COMMANDS and len(words) == 3:
+                        try:
+                            pending.append((line_number, (words[0], words[1], float(words[2]))))
+                            continue
+                        except ValueError:
+                            pass                                                            # Let apply_command() report it, as usual
+                    flush_batch()
+                try:
+                    self.prepare_for_next_command()                                         # Inside the try, so eg a CHECK_SUPPLY_TOTALS failure is reported against this line, not fatal
+                    self.apply_command(words, verbose=False)
+                except Exception as err:
+                    errors += 1
+                    print("Error on line {}: {!r}".format(line_number, err), file=sys.stderr)
+                commands += 1
+                if summary_every and commands % summary_every == 0:
+                    print(self.status_summary())
+                    print()
+            flush_batch()
+            self.prepare_for_next_command()
+        elapsed = perf_counter() - start
+        print(self.status_summary())
+        print()
+        print("Replayed {:,} commands ({:,} errors) in {:.3f}s = {:,.0f} ops/sec.".format(commands, errors, elapsed, commands / elapsed if elapsed > 0 else math.inf))
+        return commands
+
+    def prepare_for_next_command(self):
+        if self.CHECK_SUPPLY_TOTALS:
+            self.check_supply_totals()
+        self.set_min_fum_buy_price_in_eth_if_needed()       # The price calculation here technically may not quite right, because the theoretical FUM price increases (slightly) *during* many ops, as we collect fees...  But #letskeepitsimple
+        self.clear_min_fum_buy_price_if_obsolete()
+
+    def apply_command(self, words, verbose=True):
+        if words[0] == "price":
+            # "price 150" -> change the current ETH price (buy and sell) in our simulation to $150, or "price 150/160" -> sell price $150, buy price $160
+            prices = map(float, words[1].split('/'))
+            self.set_oracle_eth_price(*prices)
+        elif words[0] == "mint":
+            # "mint A 10" -> user A adds 10 ETH to the pool, getting back 10 * eth_sell_price newly-minted USM (minus fees)
+            user, eth_to_add = words[1], float(words[2])
+            usm_minted = self.mint_usm(user, eth_to_add)
+            if verbose:
+                print("Minted {:,} new USM for {} from {:,} ETH, for {:,} ETH (~${:,}) each.".format(round(usm_minted, 4), user, round(eth_to_add, 6), round(eth_to_add / usm_minted, 8), round(eth_to_add / usm_minted * self.calc_eth_price(MID), 6)))
+            return usm_minted
+        elif words[0] == "burn":
+            # "burn A 1000" -> user A burns 1,000 of their USM, getting back (1,000 / eth_buy_price) ETH (minus fees)
+            user, usm_to_burn = words[1], float(words[2])
+            eth_removed = self.burn_usm(user, usm_to_burn)
+            if verbose:
+                print("Burned {:,} of {}'s USM for {:,} ETH (~${:,}) each, yielding {:,} ETH.".format(round(usm_to_burn, 4), user, round(eth_removed / usm_to_burn, 8), round(eth_removed / usm_to_burn * self.calc_eth_price(MID), 6), round(eth_removed, 6)))
+            return eth_removed
+        elif words[0] == "fund_eth":
+            # "fund_eth B 5" -> user B adds 5 ETH to the pool, getting back a corresponding amount of newly-created FUM (based on the current FUM price, roughly buffer_value() / fum_outstanding())
+            user, eth_to_add = words[1], float(words[2])
+            fum_created = self.create_fum_from_eth(user, eth_to_add)
+            if verbose:
+                print("Created {:,} new FUM for {} from {:,} ETH, for {:,} ETH (~${:,}) each.".format(round(fum_created, 4), user, round(eth_to_add, 6), round(eth_to_add / fum_created, 8), round(eth_to_add / fum_created * self.calc_eth_price(MID), 6)))
+            return fum_created
+        elif words[0] == "fund_usm":
+            # "fund_usm B 1000" -> user B returns (burns) 1000 USM to the pool, getting back a corresponding amount of newly-created FUM (based on the current FUM price).  This leaves total pool value unchanged - basically converting USM to FUM, deceasing debt ratio.
+            user, usm_to_convert = words[1], float(words[2])
+            fum_created = self.create_fum_from_usm(user, usm_to_convert)
+            if verbose:
+                print("Created {:,} new FUM for {} from {:,} USM, for {:,} USM (~${:,}) each.".format(round(fum_created, 4), user, round(usm_to_convert, 4), round(usm_to_convert / fum_created, 6), round(usm_to_convert / fum_created, 6)))
+            return fum_created
+        elif words[0] == "defund":
+            # "defund B 1000" -> user B redeems 1,000 of their FUM, getting back a corresponding amount of ETH (based on the current FUM price)
+            user, fum_to_redeem = words[1], float(words[2])
+            eth_removed = self.redeem_fum(user, fum_to_redeem)
+            if verbose:
+                print("Redeemed {:,} of {}'s FUM for {:,} ETH (~${:,}) each, yielding {:,} ETH.".format(round(fum_to_redeem, 4), user, round(eth_removed / fum_to_redeem, 8), round(eth_removed / fum_to_redeem * self.calc_eth_price(MID), 6), round(eth_removed, 6)))
+            return eth_removed
+        elif words[0] == "wait":
+            # "wait 300" -> wait 300 seconds (5 minutes)
+            wait = float(words[1])
+            self.set_time(self.time + wait)
         else:
-            price_in_usd = price_in_eth * eth_price
-        print("* Setting min FUM buy price to {:,} ETH (~${:,}), since debt ratio {:.2%} is above {:.0%}.".format(round(price_in_eth, 8), round(price_in_usd, 6), debt_ratio(), MAX_DEBT_RATIO))
-        min_fum_buy_price_in_eth_stored = price_in_eth
-        min_fum_buy_price_timestamp = time
-
-def clear_min_fum_buy_price_if_obsolete():
-    global min_fum_buy_price_in_eth_stored, min_fum_buy_price_timestamp
-    if min_fum_buy_price_in_eth() != 0 and debt_ratio() <= MAX_DEBT_RATIO:
-        print("* Resetting min FUM buy price to $0, since debt ratio {:.2%} is back below {:.0%}.".format(debt_ratio(), MAX_DEBT_RATIO))
-        min_fum_buy_price_in_eth_stored = 0
-        min_fum_buy_price_timestamp = None
-
-def set_mint_burn_adjustment(adjustment_factor):
-    global mint_burn_adjustment_stored, mint_burn_adjustment_timestamp
-    mint_burn_adjustment_stored = adjustment_factor
-    mint_burn_adjustment_timestamp = time
-
-def set_fund_defund_adjustment(adjustment_factor):
-    global fund_defund_adjustment_stored, fund_defund_adjustment_timestamp
-    fund_defund_adjustment_stored = adjustment_factor
-    fund_defund_adjustment_timestamp = time
-
-
-# ________________________________________ Informational USM/FUM utility functions ________________________________________
-
-def usm_outstanding():
-    return sum(usm_holdings.values())
-
-def fum_outstanding():
-    return sum(fum_holdings.values())
-
-def pool_value(eth=None, eth_price=None):
-    if eth is None:
-        eth = pool_eth
-    if eth_price is None:
-        eth_price = calc_eth_price(MID)
-    return eth * eth_price
-
-def buffer_value(eth_price=None):
-    if eth_price is None:
-        eth_price = calc_eth_price(MID)
-    return pool_value(eth_price=eth_price) - usm_outstanding()
-
-def debt_ratio(eth=None, usm=None):
-    if eth is None:
-        eth = pool_eth
-    if usm is None:
-        usm = usm_outstanding()
-    if pool_value(eth=eth) == 0:
-        return 0
-    else:
-        return usm / pool_value(eth=eth)
-
-def calc_eth_price(side, adjusted=True):
-    assert side in (MID, BUY, SELL)
-    if side == BUY:
-        price = oracle_eth_buy_price
-        if adjusted:
-            price *= max(1, mint_burn_adjustment()) * max(1, fund_defund_adjustment())
-    elif side == SELL:
-        price = oracle_eth_sell_price
-        if adjusted:
-            price *= min(1, mint_burn_adjustment()) * min(1, fund_defund_adjustment())
-    else:
-        price = (oracle_eth_sell_price + oracle_eth_buy_price) / 2
-    return price
+            raise ValueError("Unrecognized command: '{}'".format(words))
+
+    def status_summary(self):
+        time_string = datetime.utcfromtimestamp(self.time).strftime('%Y/%m/%d %H:%M:%S')
+        min_fum_buy_price_string = "" if self.min_fum_buy_price_in_eth() == 0 else ", min {:,} ETH (~${:,})".format(round(self.min_fum_buy_price_in_eth(), 8), round(self.min_fum_buy_price_in_eth() * self.calc_eth_price(MID), 6))
+        return "{}: {:,} ETH at ${:,} (${:,}/${:,}) = ${:,} pool value, {:,} USM outstanding (${:,}/${:,}, adj {}), buffer = ${:,}, debt ratio = {:.2%}, {:,} FUM outstanding (${:,}/${:,}{}, adj {})\nUSM holdings: {}\nFUM holdings: {}".format(
+            time_string, round(self.pool_eth, 6), round(self.calc_eth_price(MID), 4), round(self.oracle_eth_sell_price, 4), round(self.oracle_eth_buy_price, 4), round(self.pool_value(), 2), round(self.usm_outstanding(), 4), round(self.calc_usm_price(SELL), 6), round(self.calc_usm_price(BUY), 6), round(self.mint_burn_adjustment(), 6),
+            round(self.buffer_value(), 2), self.debt_ratio(), round(self.fum_outstanding(), 4), round(self.calc_fum_price(SELL), 6), round(self.calc_fum_price(BUY), 6), min_fum_buy_price_string, round(self.fund_defund_adjustment(), 6), self.usm_holdings, self.fum_holdings)
+
+
+    # ________________________________________ State-modifying operations ________________________________________
+
+    def reset_state(self):
+        # Put every state variable back to its initial value (INITIAL_STATE), so we can run another simulation from scratch in the same pool:
+        for name, value in copy.deepcopy(self.INITIAL_STATE).items():
+            setattr(self, name, value)
+        self.forks.clear()
+        self.invalidate_derived_state()
+
+    def set_time(self, new_time):
+        self.save_for_rollback('time')
+        self.time = new_time
+        self.invalidate_prices()
+
+    def set_oracle_eth_price(self, new_price, new_buy_price=None):
+        self.save_for_rollback('oracle_eth_sell_price', 'oracle_eth_buy_price')
+        self.oracle_eth_sell_price = new_price
+        self.oracle_eth_buy_price = new_buy_price if new_buy_price is not None else new_price
+        self.invalidate_prices()
+
+        if self.min_fum_buy_price_needs_setting():
+            # Set the min FUM buy price (in ETH), to the FUM price in ETH as of the ETH price point where the debt ratio exceeded MAX_DEBT_RATIO.  Eg, suppose pool_eth = 400 and fum_outstanding() = 1,000.  Then, at the moment we exceed MAX_DEBT_RATIO = 0.8, the buffer must contain
+            # 400 * (1 - 0.8) = 80 ETH, and therefore the FUM price in ETH is 80 / 1,000 = 0.08.  Eg, suppose USM outstanding = 40,000: then we cross 0.8 at ETH = $125, when total pool value = $50,000, buffer = $10,000, and FUM price = $10,000 / 1,000 = $10 = ($10 / $125) = 0.08 ETH.
+            fum_price_in_eth_at_which_we_crossed_max_debt_ratio = (self.pool_eth * (1 - self.MAX_DEBT_RATIO)) / self.fum_outstanding()
+            self.set_min_fum_buy_price_in_eth_if_needed(fum_price_in_eth_at_which_we_crossed_max_debt_ratio)
+
+    def mint_usm(self, user, eth_to_add):
+        # Note that minting never pulls us *below* MAX_DEBT_RATIO, since it always moves debt ratio closer to 1.  If debt ratio starts > 1, it stays > 1; if it starts < 1 and > MAX_DEBT_RATIO, it stays > MAX_DEBT_RATIO.
+        initial_eth_price = self.calc_eth_price(SELL)
+        if self.pool_eth == 0:
+            # This is our very first ETH in the pool, so need to special-case it (otherwise the division below blows up):
+            usm_minted = eth_to_add * initial_eth_price
+        else:
+            # Mint at a sliding-down ETH price (ie, buy USM at a sliding-up USM price).  **BASIC RULE:** anytime pool_eth changes by factor k, eth_price changes by factor 1/k**2.  (Earlier versions of this logic scaled price by 1/k, not 1/k**2; but that results in calls to log()/exp().)
+            pool_eth_growth_factor = (self.pool_eth + eth_to_add) / self.pool_eth
+            usm_minted = amount_out_for_eth_in(self.pool_eth, initial_eth_price, eth_to_add)                            # Math: this is an integral - sum of all USM minted at a sliding-down ETH price
+            self.set_mint_burn_adjustment(self.mint_burn_adjustment() / pool_eth_growth_factor**2)
+        self.change_pool_eth(eth_to_add)
+        self.change_usm_holding(user, usm_minted)
+        return usm_minted
+
+    def burn_usm(self, user, usm_to_burn, check_debt_ratio=True):
+        # Note that burning never pushes us over MAX_DEBT_RATIO (which is < 1), since it always moves debt ratio further from 1.  It can pull us *below* MAX_DEBT_RATIO, but if so the top-level call to clear_min_fum_buy_price_if_obsolete() will take care of it once this op is done.
+        assert usm_to_burn <= self.usm_holdings.get(user, 0), "{} doesn't own that many USM".format(user)
+        initial_eth_price = self.calc_eth_price(BUY)
+        # Burn at a sliding-up price:
+        eth_removed = eth_out_for_amount_in(self.pool_eth, initial_eth_price, usm_to_burn)                              # Math: this is an integral - sum of all USM burned at a sliding price.  Follows the same mathematical invariant as above: if pool_eth *= k, eth_price *= 1/k**2.
+        assert eth_removed <= self.pool_eth, "Not enough ETH in the pool"
+        if check_debt_ratio:
+            assert self.debt_ratio(eth=self.pool_eth - eth_removed, usm=self.usm_outstanding() - usm_to_burn) <= 1, "Burning {:,} USM would leave the debt ratio above 100%".format(usm_to_burn)  # Note: the risk is not this burn op pushing us over 100%, but that a previous price drop might have done so!
+        pool_eth_shrink_factor = (self.pool_eth - eth_removed) / self.pool_eth
+        self.set_mint_burn_adjustment(self.mint_burn_adjustment() / pool_eth_shrink_factor**2)
+        self.change_usm_holding(user, -usm_to_burn)
+        self.change_pool_eth(-eth_removed)
+        return eth_removed
+
+    def create_fum_from_eth(self, user, eth_to_add):
+        # Fund operations never push us over MAX_DEBT_RATIO: they reduce debt ratio.  However, they *can* bring us back *under* MAX_DEBT_RATIO, which means the naive logic here may overcharge an op that pulls debt ratio below MAX_DEBT_RATIO midway through...  But oh well, #letskeepitsimple
+        if self.fum_outstanding() == 0:
+            # This is our very first FUM created, so need to special-case it (otherwise the division below blows up):
+            fum_created = eth_to_add * self.calc_eth_price(MID)                                                         # No need for any adjustment: the FUM price only matters relative to an existing FUM price, so we can just price the first FUM units at $1
+        else:
+            # Create at a sliding-up price:
+            initial_fum_price = self.calc_fum_price(BUY)
+            initial_eth_price_in_fum = self.calc_eth_price(MID) / initial_fum_price                                     # Don't apply adjustment to the ETH price - the adjustment should only be applied as the last step in a transaction, not when used indirectly for pricing as here.
+            pool_eth_growth_factor = (self.pool_eth + eth_to_add) / self.pool_eth
+            fum_created = amount_out_for_eth_in(self.pool_eth, initial_eth_price_in_fum, eth_to_add)                    # Math: see closely analogous comment in mint_usm() above
+            self.set_fund_defund_adjustment(self.fund_defund_adjustment() * pool_eth_growth_factor**2)
+        self.change_pool_eth(eth_to_add)
+        self.change_fum_holding(user, fum_created)
+        return fum_created
+
+    def create_fum_from_usm(self, user, usm_to_convert):
+        # To avoid duplication, just implement this as a call to burn_usm() (bypassing the debt ratio check), followed by a call to create_fum_from_eth().  These run in one transaction, so if we die on an error with half the operation complete, the burn is rolled back too:
+        with self.transaction():
+            eth_converted = self.burn_usm(user, usm_to_convert, check_debt_ratio=False)
+            self.clear_min_fum_buy_price_if_obsolete()                                                                  # Important so that, if the preceding burn brought us below MAX_DEBT_RATIO, we clear the min FUM buy price before starting the fund operation
+            return self.create_fum_from_eth(user, eth_converted)
+
+    def redeem_fum(self, user, fum_to_redeem):
+        assert fum_to_redeem <= self.fum_holdings.get(user, 0), "{} doesn't own that many FUM".format(user)
+        initial_fum_price = self.calc_fum_price(SELL)
+        assert initial_fum_price > 0, "FUM can't be redeemed at a sell price of {}".format(initial_fum_price)             # Eg, a buffer at or below 0: the price below would divide by 0, or pay out negative ETH
+        initial_eth_price_in_fum = self.calc_eth_price(MID) / initial_fum_price                                         # Don't apply adjustment to the ETH price - see similar comment above.
+        eth_removed = eth_out_for_amount_in(self.pool_eth, initial_eth_price_in_fum, fum_to_redeem)                     # Math: see closely analogous comment in burn_usm() above
+        assert self.debt_ratio(eth=self.pool_eth - eth_removed) <= self.MAX_DEBT_RATIO, "Redeeming {:,} FUM would leave the debt ratio above {:.0%}".format(fum_to_redeem, self.MAX_DEBT_RATIO)
+        # Since we've disallowed redeem operations that would push us over MAX_DEBT_RATIO, we don't need to handle that case.  And a redeem can never pull us under MAX_DEBT_RATIO either, because it increases debt ratio.
+        pool_eth_shrink_factor = (self.pool_eth - eth_removed) / self.pool_eth
+        self.set_fund_defund_adjustment(self.fund_defund_adjustment() * pool_eth_shrink_factor**2)
+        self.change_fum_holding(user, -fum_to_redeem)
+        self.change_pool_eth(-eth_removed)
+        return eth_removed
+
+    def change_pool_eth(self, eth_change):
+        self.save_for_rollback('pool_eth')
+        self.pool_eth += eth_change
+        self.invalidate_prices()
+
+    def change_usm_holding(self, user, usm_change):
+        # All changes to USM holdings should go through here (or change_fum_holding() below), so that usm_supply stays in sync with usm_holdings:
+        self.save_for_rollback('usm_supply')
+        self.save_holding_for_rollback('usm_holdings', user)
+        self.usm_holdings[user] = self.usm_holdings.get(user, 0) + usm_change
+        self.usm_supply += usm_change
+        self.invalidate_prices()
+
+    def change_fum_holding(self, user, fum_change):
+        self.save_for_rollback('fum_supply')
+        self.save_holding_for_rollback('fum_holdings', user)
+        self.fum_holdings[user] = self.fum_holdings.get(user, 0) + fum_change
+        self.fum_supply += fum_change
+        self.invalidate_prices()
+
+    def set_min_fum_buy_price_in_eth_if_needed(self, price_in_eth=None):
+        if self.min_fum_buy_price_needs_setting():
+            eth_price = self.calc_eth_price(MID)
+            if price_in_eth is None:
+                # If no price is passed in, set it to the current theoretical FUM price (without adjustments), in ETH:
+                price_in_usd = self.calc_fum_price(BUY, adjusted=False, mfbp=False)
+                price_in_eth = price_in_usd / eth_price
+            else:
+                price_in_usd = price_in_eth * eth_price
+            self.save_for_rollback('min_fum_buy_price_in_eth_stored', 'min_fum_buy_price_timestamp')
+            if self.verbose:
+                print("* Setting min FUM buy price to {:,} ETH (~${:,}), since debt ratio {:.2%} is above {:.0%}.".format(round(price_in_eth, 8), round(price_in_usd, 6), self.debt_ratio(), self.MAX_DEBT_RATIO))
+            self.min_fum_buy_price_in_eth_stored = price_in_eth
+            self.min_fum_buy_price_timestamp = self.time
+            self.invalidate_prices()
+
+    def clear_min_fum_buy_price_if_obsolete(self):
+        if self.min_fum_buy_price_in_eth() != 0 and self.debt_ratio() <= self.MAX_DEBT_RATIO:
+            self.save_for_rollback('min_fum_buy_price_in_eth_stored', 'min_fum_buy_price_timestamp')
+            if self.verbose:
+                print("* Resetting min FUM buy price to $0, since debt ratio {:.2%} is back below {:.0%}.".format(self.debt_ratio(), self.MAX_DEBT_RATIO))
+            self.min_fum_buy_price_in_eth_stored = 0
+            self.min_fum_buy_price_timestamp = None
+            self.invalidate_prices()
+
+    def invalidate_derived_state(self):
+        # Drops everything cached.  Needed only after changing a parameter (eg a half-life) mid-simulation: state changes are covered by invalidate_prices() and the decay_cache checks.
+        self.decay_cache.clear()
+        self.price_cache.clear()
+
+    def invalidate_prices(self):
+        # Called by every state change, since the prices depend on all of the state.  The decayed values don't need clearing: decayed() checks each against the state it came from, so
+        # eg setting the mint/burn adjustment doesn't throw away the still-valid fund/defund one.
+        self.price_cache.clear()
+
+    def set_mint_burn_adjustment(self, adjustment_factor):
+        self.save_for_rollback('mint_burn_adjustment_stored', 'mint_burn_adjustment_timestamp')
+        self.mint_burn_adjustment_stored = adjustment_factor
+        self.mint_burn_adjustment_timestamp = self.time
+        self.invalidate_prices()
+
+    def set_fund_defund_adjustment(self, adjustment_factor):
+        self.save_for_rollback('fund_defund_adjustment_stored', 'fund_defund_adjustment_timestamp')
+        self.fund_defund_adjustment_stored = adjustment_factor
+        self.fund_defund_adjustment_timestamp = self.time
+        self.invalidate_prices()
+
+
+    # ________________________________________ Transactions ________________________________________
+
+    # fork() starts a journal, rather than copying the state: from then on, the first change to each state variable or holding saves its old value, so rollback() can put back just what was touched,
+    # and commit() can just drop the journal.  So a fork costs O(1), and a rollback O(changes made in the fork) - eg, what_if(mint_usm, 'A', 10) doesn't copy usm_holdings/fum_holdings however many
+    # holders they have.  Forks nest: committing an inner fork folds its journal into the outer one, so rolling back the outer fork still undoes everything.
+
+    NOT_HELD = object()                                                                                             # Journal value for a holder who wasn't in the holdings dict before the fork
+
+    def fork(self):
+        self.forks.append({})
+
+    def commit(self):
+        journal = self.forks.pop()
+        if self.forks:
+            outer_journal = self.forks[-1]
+            for key, value in journal.items():
+                outer_journal.setdefault(key, value)                                                                    # If the outer fork had already touched this, its older value is the one to keep
+
+    def rollback(self):
+        for key, value in self.forks.pop().items():
+            if isinstance(key, tuple):
+                holdings_name, user = key
+                if value is self.NOT_HELD:
+                    del getattr(self, holdings_name)[user]
+                else:
+                    getattr(self, holdings_name)[user] = value
+            else:
+                setattr(self, key, value)
+        self.invalidate_prices()
 
-def calc_fum_price(side, adjusted=True, mfbp=True):
-    assert side in (MID, BUY, SELL)
-    if fum_outstanding() == 0:
-        return 1 if side == BUY else math.nan                                       # If we're pricing our first FUM purchase, just price them at $1, skipping adjustment
-    else:
-        eth_price = calc_eth_price(side, adjusted=False)                            # adjusted=False because we apply that directly to the FUM price below, not to the ETH price used to calculate the buffer value - that would exaggerate the fee too much
-        price = buffer_value(eth_price=eth_price) / fum_outstanding()
-
-    if side == BUY:
-        if adjusted:
-            price *= max(1, mint_burn_adjustment()) * max(1, fund_defund_adjustment())
-        if mfbp:
-            price = max(price, min_fum_buy_price_in_eth() * calc_eth_price(MID))
-    elif side == SELL:
-        if adjusted:
-            price *= min(1, mint_burn_adjustment()) * min(1, fund_defund_adjustment())
-    return price
-
-def calc_usm_price(side, adjusted=True):
-    assert side in (MID, BUY, SELL)
-    eth_side = {BUY: SELL, SELL: BUY, MID: MID}[side]
-    return calc_eth_price(MID) / calc_eth_price(eth_side, adjusted=adjusted)
-
-def min_fum_buy_price_needs_setting():
-    return min_fum_buy_price_in_eth() == 0 and debt_ratio() > MAX_DEBT_RATIO and fum_outstanding() > 0
-
-def min_fum_buy_price_in_eth():
-    if min_fum_buy_price_timestamp is None:
-        return 0
-    elif APPROXIMATE_TO_SAVE_GAS:
-        return round(min_fum_buy_price_in_eth_stored * half_exp_approx(((time - min_fum_buy_price_timestamp) / MIN_FUM_BUY_PRICE_HALF_LIFE) * ONE_SHIFTED)) / ONE_SHIFTED
-    else:
-        return min_fum_buy_price_in_eth_stored * (0.5 ** ((time - min_fum_buy_price_timestamp) / MIN_FUM_BUY_PRICE_HALF_LIFE))
+    @contextlib.contextmanager
+    def transaction(self):
+        # with transaction(): ... - commits if the block completes, rolls back (and re-raises) if it fails, eg on an assertion.
+        self.fork()
+        try:
+            yield
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    @contextlib.contextmanager
+    def quiet(self):
+        # with quiet(): ... - no min FUM buy price messages inside the block (replay() runs in one, and tools that drive a pool silently can too).
+        verbose, self.verbose = self.verbose, False
+        try:
+            yield
+        finally:
+            self.verbose = verbose
 
-def mint_burn_adjustment():
-    if APPROXIMATE_TO_SAVE_GAS:
-        power_approx = half_exp_approx(((time - mint_burn_adjustment_timestamp) / BUY_SELL_ADJUSTMENTS_HALF_LIFE) * ONE_SHIFTED, max_power=10) / ONE_SHIFTED
-        # Here we use the idea that for  0 < b <= 1 and 0 <= p <= 1, we can crudely approximate b**p by 1 - (1-b)p.  Eg: 0.6**0.5 pulls 0.6 "about halfway" to 1 (0.8); 0.6**0.25 pulls 0.6 "about 3/4 of the way" to 1 (0.9).  So b**p =~ b + (1-p)(1-b) = b + 1 - b - p + bp = 1 - (1-b)p:
-        return 1 - (1 - mint_burn_adjustment_stored) * power_approx
-    else:
-        return mint_burn_adjustment_stored ** (0.5 ** ((time - mint_burn_adjustment_timestamp) / BUY_SELL_ADJUSTMENTS_HALF_LIFE))
+    def what_if(self, op, *args):
+        # Returns what op(*args) would return (eg, what_if(burn_usm, 'A', 1000)), and leaves the state as it was.  Raises whatever the op raises.
+        self.fork()
+        try:
+            with self.quiet():                                                                  # Nothing it does sticks, so don't announce any min FUM buy price change
+                return op(*args)
+        finally:
+            self.rollback()
+
+    def save_for_rollback(self, *names):
+        # Called by every setter of a state variable, just before it changes:
+        if self.forks:
+            journal = self.forks[-1]
+            for name in names:
+                if name not in journal:
+                    journal[name] = getattr(self, name)
+
+    def save_holding_for_rollback(self, holdings_name, user):
+        if self.forks:
+            journal = self.forks[-1]
+            key = (holdings_name, user)
+            if key not in journal:
+                journal[key] = getattr(self, holdings_name).get(user, self.NOT_HELD)
+
+
+    # ________________________________________ Batch execution ________________________________________
+
+    # An alternative to applying ops one at a time, for many ops at the same timestamp (eg, all the ops in one block): execute_batch() nets the batch's mints against its burns, and its funds
+    # against its defunds, and clears each pair at one uniform price, so every op in the batch gets the same price for its direction, whatever order they arrived in.  Only the net flow trades
+    # against the pool, through one sliding-price integral and one adjustment update (see batch_clearing_price()), and each op is then paid pro rata: a mint of e ETH gets e * price USM, a burn of
+    # u USM gets u / price ETH, and likewise for funds/defunds in FUM.  The adjustment update is the one the ops would have made one at a time: each multiplies (or for mints/burns, divides) the
+    # adjustment by (new pool_eth / old pool_eth)**2, which compounds to (pool_eth after / pool_eth before)**2 for the whole batch, in any order.
+    # Differences from applying the same ops one at a time: each op pays the batch's average price rather than its own place in the queue, and the mid-batch effects of the earlier ops (the
+    # adjustment they leave, the min FUM buy price being set/cleared between them) don't apply to the later ones.  A user's ops are checked against their holdings before the batch - so eg they
+    # can't burn USM minted earlier in the same batch.  Mints/burns clear first, then funds/defunds (priced from the state the mints/burns leave).
+
+    BATCH_COMMANDS = {'mint': 'mint_usm', 'burn': 'burn_usm', 'fund_eth': 'create_fum_from_eth', 'defund': 'redeem_fum'}
+
+    def execute_batch(self, ops):
+        # ops is a list of (command, user, amount), command being one of BATCH_COMMANDS.  Returns a list of what each op returns (eg, USM minted), or the exception it fails with.  If a pair can't
+        # clear as a whole (eg, a net burn that would leave the debt ratio above 100%, or the very first mint into an empty pool), its ops are applied one at a time instead, in order.
+        results = [None] * len(ops)
+        for eth_in_command, amount_in_command, holdings, clear in (('mint', 'burn', self.usm_holdings, self.clear_usm_batch), ('fund_eth', 'defund', self.fum_holdings, self.clear_fum_batch)):
+            eth_ins, amount_ins = [], []
+            spent = collections.Counter()
+            for i, (command, user, amount) in enumerate(ops):
+                if command == eth_in_command:
+                    eth_ins.append((i, user, amount))
+                elif command == amount_in_command:
+                    if spent[user] + amount > holdings.get(user, 0):
+                        results[i] = AssertionError("{} doesn't own that many {}".format(user, 'USM' if holdings is self.usm_holdings else 'FUM'))
+                    else:
+                        spent[user] += amount
+                        amount_ins.append((i, user, amount))
+            if not (eth_ins or amount_ins):
+                continue
+            self.prepare_for_next_command()
+            try:
+                with self.transaction():
+                    cleared = clear(eth_ins, amount_ins)
+            except Exception:
+                cleared = {}
+                for i, user, amount in sorted(eth_ins + amount_ins):
+                    self.prepare_for_next_command()
+                    try:
+                        cleared[i] = getattr(self, self.BATCH_COMMANDS[ops[i][0]])(user, amount)
+                    except Exception as err:
+                        cleared[i] = err
+            for i, result in cleared.items():
+                results[i] = result
+        return results
+
+    def clear_usm_batch(self, mints, burns):
+        # Clears a batch's mints (ETH in) against its burns (USM in): returns {op index: result}.  Raises (eg, an AssertionError), for execute_batch() to roll back, if the batch can't clear as a whole.
+        assert self.pool_eth > 0, "The very first mint into an empty pool has no price to slide from"
+        eth_in, usm_in = math.fsum(eth for _, _, eth in mints), math.fsum(usm for _, _, usm in burns)
+        price = batch_clearing_price(self.pool_eth, self.calc_eth_price(SELL), self.calc_eth_price(BUY), eth_in, usm_in)
+        cleared = {}
+        for i, user, eth in mints:
+            cleared[i] = eth * price
+            self.change_usm_holding(user, cleared[i])
+        for i, user, usm in burns:
+            cleared[i] = usm / price
+            self.change_usm_holding(user, -usm)
+        pool_eth_growth_factor = self.settle_batch_eth(eth_in, math.fsum(cleared[i] for i, _, _ in burns))
+        if burns:
+            assert self.debt_ratio() <= 1, "Burning {:,} USM would leave the debt ratio above 100%".format(usm_in)
+        self.set_mint_burn_adjustment(self.mint_burn_adjustment() / pool_eth_growth_factor**2)
+        return cleared
+
+    def clear_fum_batch(self, funds, defunds):
+        # The same for funds (ETH in) and defunds (FUM in), at FUM-per-ETH prices like create_fum_from_eth() and redeem_fum() use.
+        assert self.pool_eth > 0 and self.fum_outstanding() > 0, "The very first FUM have no price to slide from"
+        eth_in, fum_in = math.fsum(eth for _, _, eth in funds), math.fsum(fum for _, _, fum in defunds)
+        initial_fum_sell_price = self.calc_fum_price(SELL)
+        assert initial_fum_sell_price > 0 or not defunds, "FUM can't be redeemed at a sell price of {}".format(initial_fum_sell_price)   # As in redeem_fum(): execute_batch() then rejects each defund
+        eth_out_price = self.calc_eth_price(MID) / initial_fum_sell_price if defunds else math.nan                      # (Unused with no defunds, when the sell price may be 0)
+        price = batch_clearing_price(self.pool_eth, self.calc_eth_price(MID) / self.calc_fum_price(BUY), eth_out_price, eth_in, fum_in)
+        cleared = {}
+        for i, user, eth in funds:
+            cleared[i] = eth * price
+            self.change_fum_holding(user, cleared[i])
+        for i, user, fum in defunds:
+            cleared[i] = fum / price
+            self.change_fum_holding(user, -fum)
+        pool_eth_growth_factor = self.settle_batch_eth(eth_in, math.fsum(cleared[i] for i, _, _ in defunds))
+        if defunds:
+            assert self.debt_ratio() <= self.MAX_DEBT_RATIO, "Redeeming {:,} FUM would leave the debt ratio above {:.0%}".format(fum_in, self.MAX_DEBT_RATIO)
+        self.set_fund_defund_adjustment(self.fund_defund_adjustment() * pool_eth_growth_factor**2)
+        return cleared
+
+    def settle_batch_eth(self, eth_in, eth_out):
+        # Moves a batch's net ETH into (or out of) the pool, and returns the factor pool_eth grew by:
+        initial_pool_eth = self.pool_eth
+        assert eth_out <= initial_pool_eth + eth_in, "Not enough ETH in the pool"
+        self.change_pool_eth(eth_in - eth_out)
+        return self.pool_eth / initial_pool_eth
+
+
+    # ________________________________________ Read-only quotes ________________________________________
+
+    # What each op would return for each of an array of sizes, from the current state, without changing it.  These use the same integrals as the ops themselves (amount_out_for_eth_in() and
+    # eth_out_for_amount_in()), evaluated with NumPy over all sizes at once.  Each returns a Quote of arrays: output (eg, USM minted), price (input paid per unit of output), the debt ratio the
+    # op would leave, and rejected - True where the op would fail one of its assertions (eg, MAX_DEBT_RATIO), instead of raising.  Pass user to also check their balance.  NumPy is imported by the quotes themselves, rather than at the top, so importing this module doesn't pay for it.
+
+    def quote_debt_ratio(self, eth, usm):
+        import numpy as np
+        value = eth * self.calc_eth_price(MID)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(value == 0, 0, usm / value)
+
+    def quote_mint_usm(self, eth_sizes):
+        import numpy as np
+        eth_sizes = np.asarray(eth_sizes, dtype=float)
+        initial_eth_price = self.calc_eth_price(SELL)
+        if self.pool_eth == 0:
+            usm_minted = eth_sizes * initial_eth_price
+        else:
+            usm_minted = amount_out_for_eth_in(self.pool_eth, initial_eth_price, eth_sizes)
+        return make_quote(eth_sizes, usm_minted, self.quote_debt_ratio(self.pool_eth + eth_sizes, self.usm_outstanding() + usm_minted), np.zeros(eth_sizes.shape, dtype=bool))
+
+    def quote_burn_usm(self, usm_sizes, user=None):
+        import numpy as np
+        usm_sizes = np.asarray(usm_sizes, dtype=float)
+        if self.pool_eth == 0:
+            return make_quote(usm_sizes, np.full(usm_sizes.shape, np.nan), np.zeros(usm_sizes.shape), np.ones(usm_sizes.shape, dtype=bool))
+        eth_removed = eth_out_for_amount_in(self.pool_eth, self.calc_eth_price(BUY), usm_sizes)
+        debt_ratio_after = self.quote_debt_ratio(self.pool_eth - eth_removed, self.usm_outstanding() - usm_sizes)
+        rejected = (usm_sizes > (self.usm_outstanding() if user is None else self.usm_holdings.get(user, 0))) | (eth_removed > self.pool_eth) | (debt_ratio_after > 1)
+        return make_quote(usm_sizes, eth_removed, debt_ratio_after, rejected)
+
+    def quote_create_fum_from_eth(self, eth_sizes):
+        import numpy as np
+        eth_sizes = np.asarray(eth_sizes, dtype=float)
+        fum_created = self.quote_fum_created(self.pool_eth, self.usm_outstanding(), self.mint_burn_adjustment(), self.min_fum_buy_price_in_eth(), eth_sizes)
+        rejected = ~np.isfinite(fum_created) | (self.fum_outstanding() != 0 and self.pool_eth == 0)
+        return make_quote(eth_sizes, fum_created, self.quote_debt_ratio(self.pool_eth + eth_sizes, self.usm_outstanding()), rejected)
+
+    def quote_create_fum_from_usm(self, usm_sizes, user=None):
+        # Like create_fum_from_usm(): a burn (without the debt ratio check), then a fund with the ETH it yields.  But since each size leaves a different state after its burn, the fund half
+        # has to be priced from that state, rather than from the current one like quote_create_fum_from_eth():
+        import numpy as np
+        usm_sizes = np.asarray(usm_sizes, dtype=float)
+        if self.pool_eth == 0:
+            return make_quote(usm_sizes, np.full(usm_sizes.shape, np.nan), np.zeros(usm_sizes.shape), np.ones(usm_sizes.shape, dtype=bool))
+        eth_converted = eth_out_for_amount_in(self.pool_eth, self.calc_eth_price(BUY), usm_sizes)
+        pool_eth_after_burn, usm_after_burn = self.pool_eth - eth_converted, self.usm_outstanding() - usm_sizes
+        mint_burn_adjustment_after_burn = self.mint_burn_adjustment() / (pool_eth_after_burn / self.pool_eth)**2
+        if self.APPROXIMATE_TO_SAVE_GAS:
+            # What mint_burn_adjustment() will return for the value the burn sets, 0 seconds later: its approximate formula, which rounds differently from the exact one (which just gives back the value)
+            mint_burn_adjustment_after_burn = 1 - (1 - mint_burn_adjustment_after_burn) * (self.half_exp(0, max_power=10) / ONE_SHIFTED)
+        min_fum_buy_price_after_burn = np.where(self.quote_debt_ratio(pool_eth_after_burn, usm_after_burn) <= self.MAX_DEBT_RATIO, 0, self.min_fum_buy_price_in_eth())  # See clear_min_fum_buy_price_if_obsolete()
+        fum_created = self.quote_fum_created(pool_eth_after_burn, usm_after_burn, mint_burn_adjustment_after_burn, min_fum_buy_price_after_burn, eth_converted)
+        rejected = (usm_sizes > (self.usm_outstanding() if user is None else self.usm_holdings.get(user, 0))) | (eth_converted > self.pool_eth) | ~np.isfinite(fum_created)
+        return make_quote(usm_sizes, fum_created, self.quote_debt_ratio(self.pool_eth, usm_after_burn), rejected)
+
+    def quote_redeem_fum(self, fum_sizes, user=None):
+        import numpy as np
+        fum_sizes = np.asarray(fum_sizes, dtype=float)
+        initial_fum_price = self.calc_fum_price(SELL)
+        if self.pool_eth == 0 or not initial_fum_price > 0:                                                           # Rejected, as by redeem_fum(): including a negative (or NaN) sell price
+            return make_quote(fum_sizes, np.full(fum_sizes.shape, np.nan), np.zeros(fum_sizes.shape), np.ones(fum_sizes.shape, dtype=bool))
+        eth_removed = eth_out_for_amount_in(self.pool_eth, self.calc_eth_price(MID) / initial_fum_price, fum_sizes)
+        debt_ratio_after = self.quote_debt_ratio(self.pool_eth - eth_removed, self.usm_outstanding())
+        rejected = (fum_sizes > (self.fum_outstanding() if user is None else self.fum_holdings.get(user, 0))) | (debt_ratio_after > self.MAX_DEBT_RATIO)
+        return make_quote(fum_sizes, eth_removed, debt_ratio_after, rejected)
+
+    def quote_fum_created(self, eth, usm, mint_burn_adjustment_factor, min_fum_buy_price, eth_sizes):
+        # FUM that create_fum_from_eth() would create for eth_sizes, if the pool held eth and usm (which may be arrays, one state per size), with the given mint/burn adjustment and min FUM buy price:
+        import numpy as np
+        if self.fum_outstanding() == 0:
+            return eth_sizes * self.calc_eth_price(MID)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            initial_fum_price = (eth * self.calc_eth_price(BUY, adjusted=False) - usm) / self.fum_outstanding()        # See calc_fum_price()
+            initial_fum_price = initial_fum_price * (np.maximum(1, mint_burn_adjustment_factor) * max(1, self.fund_defund_adjustment()))
+            initial_fum_price = np.maximum(initial_fum_price, min_fum_buy_price * self.calc_eth_price(MID))
+            return amount_out_for_eth_in(eth, self.calc_eth_price(MID) / initial_fum_price, eth_sizes)
+
+
+    # ________________________________________ Exact-output solvers ________________________________________
+
+    # The inverses of the ops: the input needed to get exactly a given output, from the current state.  Each just inverts the op's integral (see eth_in_for_amount_out() and amount_in_for_eth_out()),
+    # so it's O(1) - no searching over repeated forward calls.  Passing the result to the forward op gets back the requested output, to within float rounding.  (No solver for
+    # create_fum_from_usm(): its fund half is priced from the state its burn half leaves, which depends on the input we're solving for.)
+
+    def eth_to_mint_usm(self, usm_to_mint):
+        # ETH that mint_usm() needs to mint exactly usm_to_mint USM:
+        initial_eth_price = self.calc_eth_price(SELL)
+        if self.pool_eth == 0:
+            return usm_to_mint / initial_eth_price
+        return eth_in_for_amount_out(self.pool_eth, initial_eth_price, usm_to_mint)
+
+    def usm_to_burn_for_eth(self, eth_to_remove):
+        # USM that burn_usm() needs to burn to yield exactly eth_to_remove ETH:
+        return amount_in_for_eth_out(self.pool_eth, self.calc_eth_price(BUY), eth_to_remove)
+
+    def eth_to_create_fum(self, fum_to_create):
+        # ETH that create_fum_from_eth() needs to create exactly fum_to_create FUM:
+        if self.fum_outstanding() == 0:
+            return fum_to_create / self.calc_eth_price(MID)
+        return eth_in_for_amount_out(self.pool_eth, self.calc_eth_price(MID) / self.calc_fum_price(BUY), fum_to_create)
+
+    def fum_to_redeem_for_eth(self, eth_to_remove):
+        # FUM that redeem_fum() needs to redeem to yield exactly eth_to_remove ETH:
+        initial_fum_price = self.calc_fum_price(SELL)
+        assert initial_fum_price > 0, "FUM can't be redeemed at a sell price of {}".format(initial_fum_price)
+        return amount_in_for_eth_out(self.pool_eth, self.calc_eth_price(MID) / initial_fum_price, eth_to_remove)
+
+
+    # ________________________________________ Informational USM/FUM utility functions ________________________________________
+
+    def usm_outstanding(self):
+        return self.usm_supply
+
+    def fum_outstanding(self):
+        return self.fum_supply
+
+    def check_supply_totals(self):
+        # Slow (sums over every holder), so only for debugging: catches any drift between the running totals and the actual holdings, beyond float rounding error.
+        usm_recount, fum_recount = math.fsum(self.usm_holdings.values()), math.fsum(self.fum_holdings.values())
+        assert math.isclose(self.usm_supply, usm_recount, rel_tol=1e-9, abs_tol=1e-9), "usm_supply {} has drifted from recount {}".format(self.usm_supply, usm_recount)
+        assert math.isclose(self.fum_supply, fum_recount, rel_tol=1e-9, abs_tol=1e-9), "fum_supply {} has drifted from recount {}".format(self.fum_supply, fum_recount)
+
+    def pool_value(self, eth=None, eth_price=None):
+        if eth is None:
+            eth = self.pool_eth
+        if eth_price is None:
+            eth_price = self.calc_eth_price(MID)
+        return eth * eth_price
+
+    def buffer_value(self, eth_price=None):
+        if eth_price is None:
+            eth_price = self.calc_eth_price(MID)
+        return self.pool_value(eth_price=eth_price) - self.usm_outstanding()
+
+    def debt_ratio(self, eth=None, usm=None):
+        if eth is None:
+            eth = self.pool_eth
+        if usm is None:
+            usm = self.usm_outstanding()
+        if self.pool_value(eth=eth) == 0:
+            return 0
+        else:
+            return usm / self.pool_value(eth=eth)
+
+    def calc_eth_price(self, side, adjusted=True):
+        assert side in (MID, BUY, SELL)
+        if side == BUY:
+            price = self.oracle_eth_buy_price
+            if adjusted:
+                price *= max(1, self.mint_burn_adjustment()) * max(1, self.fund_defund_adjustment())
+        elif side == SELL:
+            price = self.oracle_eth_sell_price
+            if adjusted:
+                price *= min(1, self.mint_burn_adjustment()) * min(1, self.fund_defund_adjustment())
+        else:
+            price = (self.oracle_eth_sell_price + self.oracle_eth_buy_price) / 2
+        return price
+
+    def calc_fum_price(self, side, adjusted=True, mfbp=True):
+        return self.cached('calc_fum_price', self.calc_fum_price_uncached, side, adjusted, mfbp)
+
+    def calc_fum_price_uncached(self, side, adjusted, mfbp):
+        assert side in (MID, BUY, SELL)
+        if self.fum_outstanding() == 0:
+            return 1 if side == BUY else math.nan                                       # If we're pricing our first FUM purchase, just price them at $1, skipping adjustment
+        else:
+            eth_price = self.calc_eth_price(side, adjusted=False)                       # adjusted=False because we apply that directly to the FUM price below, not to the ETH price used to calculate the buffer value - that would exaggerate the fee too much
+            price = self.buffer_value(eth_price=eth_price) / self.fum_outstanding()
+
+        if side == BUY:
+            if adjusted:
+                price *= max(1, self.mint_burn_adjustment()) * max(1, self.fund_defund_adjustment())
+            if mfbp:
+                price = max(price, self.min_fum_buy_price_in_eth() * self.calc_eth_price(MID))
+        elif side == SELL:
+            if adjusted:
+                price *= min(1, self.mint_burn_adjustment()) * min(1, self.fund_defund_adjustment())
+        return price
+
+    def calc_usm_price(self, side, adjusted=True):
+        return self.cached('calc_usm_price', self.calc_usm_price_uncached, side, adjusted)
+
+    def calc_usm_price_uncached(self, side, adjusted):
+        assert side in (MID, BUY, SELL)
+        eth_side = {BUY: SELL, SELL: BUY, MID: MID}[side]
+        return self.calc_eth_price(MID) / self.calc_eth_price(eth_side, adjusted=adjusted)
+
+    def min_fum_buy_price_needs_setting(self):
+        return self.min_fum_buy_price_in_eth() == 0 and self.debt_ratio() > self.MAX_DEBT_RATIO and self.fum_outstanding() > 0
+
+    def min_fum_buy_price_in_eth(self):
+        if self.min_fum_buy_price_in_eth_stored == 0:
+            return 0                                                                    # The usual case, and nothing to decay, so skip the cache
+        return self.decayed('min_fum_buy_price_in_eth', 'min_fum_buy_price_in_eth_stored', 'min_fum_buy_price_timestamp', self.min_fum_buy_price_in_eth_uncached)
+
+    def min_fum_buy_price_in_eth_uncached(self):
+        if self.min_fum_buy_price_timestamp is None:
+            return 0
+        elif self.APPROXIMATE_TO_SAVE_GAS:
+            return round(self.min_fum_buy_price_in_eth_stored * self.half_exp(((self.time - self.min_fum_buy_price_timestamp) / self.MIN_FUM_BUY_PRICE_HALF_LIFE) * ONE_SHIFTED)) / ONE_SHIFTED
+        else:
+            return self.min_fum_buy_price_in_eth_stored * (0.5 ** ((self.time - self.min_fum_buy_price_timestamp) / self.MIN_FUM_BUY_PRICE_HALF_LIFE))
+
+    def mint_burn_adjustment(self):
+        return self.decayed('mint_burn_adjustment', 'mint_burn_adjustment_stored', 'mint_burn_adjustment_timestamp', self.mint_burn_adjustment_uncached)
+
+    def mint_burn_adjustment_uncached(self):
+        if self.APPROXIMATE_TO_SAVE_GAS:
+            power_approx = self.half_exp(((self.time - self.mint_burn_adjustment_timestamp) / self.BUY_SELL_ADJUSTMENTS_HALF_LIFE) * ONE_SHIFTED, max_power=10) / ONE_SHIFTED
+            # Here we use the idea that for  0 < b <= 1 and 0 <= p <= 1, we can crudely approximate b**p by 1 - (1-b)p.  Eg: 0.6**0.5 pulls 0.6 "about halfway" to 1 (0.8); 0.6**0.25 pulls 0.6 "about 3/4 of the way" to 1 (0.9).  So b**p =~ b + (1-p)(1-b) = b + 1 - b - p + bp = 1 - (1-b)p:
+            return 1 - (1 - self.mint_burn_adjustment_stored) * power_approx
+        else:
+            return self.mint_burn_adjustment_stored ** (0.5 ** ((self.time - self.mint_burn_adjustment_timestamp) / self.BUY_SELL_ADJUSTMENTS_HALF_LIFE))
+
+    def fund_defund_adjustment(self):
+        return self.decayed('fund_defund_adjustment', 'fund_defund_adjustment_stored', 'fund_defund_adjustment_timestamp', self.fund_defund_adjustment_uncached)
+
+    def fund_defund_adjustment_uncached(self):
+        if self.APPROXIMATE_TO_SAVE_GAS:
+            power_approx = self.half_exp(((self.time - self.fund_defund_adjustment_timestamp) / self.BUY_SELL_ADJUSTMENTS_HALF_LIFE) * ONE_SHIFTED, max_power=10) / ONE_SHIFTED
+            # See parallel comment above:
+            return 1 - (1 - self.fund_defund_adjustment_stored) * power_approx
+        else:
+            return self.fund_defund_adjustment_stored ** (0.5 ** ((self.time - self.fund_defund_adjustment_timestamp) / self.BUY_SELL_ADJUSTMENTS_HALF_LIFE))
+
+    def half_exp(self, power_shifted, max_power=math.inf):
+        # half_exp_approx(), or with USE_HALF_EXP_TABLE, half_exp_table_approx() at HALF_EXP_TABLE_BITS: the approximation this pool's APPROXIMATE_TO_SAVE_GAS calcs use.
+        if self.USE_HALF_EXP_TABLE:
+            return half_exp_table_approx(power_shifted, self.HALF_EXP_TABLE_BITS, max_power)
+        return half_exp_approx(power_shifted, max_power)
+
+    def decayed(self, name, stored_name, timestamp_name, compute):
+        # Returns compute(), computing it only if decay_cache's entry for name wasn't computed from the same state (time, the stored value and timestamp named, and the approximation settings,
+        # so toggling APPROXIMATE_TO_SAVE_GAS or USE_HALF_EXP_TABLE, or changing HALF_EXP_TABLE_BITS, can't return a stale value).  This saves re-raising the same numbers to the same fractional powers over and over within
+        # one timestamp.  The state is read here, rather than passed in, so that usm_gas.py (which doesn't trace this) only counts the reads compute() makes.
+        if self.CACHE_DERIVED_STATE:
+            state = (self.time, getattr(self, stored_name), getattr(self, timestamp_name), self.APPROXIMATE_TO_SAVE_GAS, self.USE_HALF_EXP_TABLE, self.HALF_EXP_TABLE_BITS)
+            entry = self.decay_cache.get(name)
+            if entry is not None and entry[0] == state:
+                self.cache_hits += 1
+                return entry[1]
+            self.cache_misses += 1
+            value = compute()
+            self.decay_cache[name] = (state, value)
+            return value
+        return compute()
+
+    def cached(self, name, compute, *args):
+        # Returns compute(*args), computing it only if price_cache (which every state change clears: see invalidate_prices()) has no entry for name, args and the approximation settings.
+        if self.CACHE_DERIVED_STATE:
+            cache = self.price_cache
+            key = (name, self.APPROXIMATE_TO_SAVE_GAS, self.USE_HALF_EXP_TABLE, self.HALF_EXP_TABLE_BITS) + args
+            value = cache.get(key, cache)                                               # cache itself is just a sentinel meaning "not found", since NaN is a legit value
+            if value is not cache:
+                self.cache_hits += 1
+                return value
+            self.cache_misses += 1
+            value = cache[key] = compute(*args)
+            return value
+        return compute(*args)
+
+    def cache_stats(self):
+        return {'hits': self.cache_hits, 'misses': self.cache_misses, 'size': len(self.decay_cache) + len(self.price_cache)}
 
-def fund_defund_adjustment():
-    if APPROXIMATE_TO_SAVE_GAS:
-        power_approx = half_exp_approx(((time - fund_defund_adjustment_timestamp) / BUY_SELL_ADJUSTMENTS_HALF_LIFE) * ONE_SHIFTED, max_power=10) / ONE_SHIFTED
-        # See parallel comment above:
-        return 1 - (1 - fund_defund_adjustment_stored) * power_approx
-    else:
-        return fund_defund_adjustment_stored ** (0.5 ** ((time - fund_defund_adjustment_timestamp) / BUY_SELL_ADJUSTMENTS_HALF_LIFE))
 
 # ________________________________________ General-purpose utility functions ________________________________________
 
+def make_quote(sizes, output, debt_ratio_after, rejected):
+    import numpy as np
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return Quote(output, sizes / output, debt_ratio_after, rejected)
+
+def amount_out_for_eth_in(pool_eth, initial_price, eth_in):
+    # Adding eth_in ETH to a pool of pool_eth, at a price (in units of the output token per ETH) that slides from initial_price by 1/k**2 as pool_eth grows by factor k: the integral of that price
+    # over the ETH added.  Used by mint_usm() and create_fum_from_eth(), and by their quotes (so any of these args can be NumPy arrays).
+    pool_eth_growth_factor = (pool_eth + eth_in) / pool_eth
+    return pool_eth * initial_price * (1 - 1 / pool_eth_growth_factor)
+
+def eth_out_for_amount_in(pool_eth, initial_price, amount_in):
+    # The reverse: ETH removed from the pool in exchange for amount_in units of a token, at a price (in tokens per ETH) that slides from initial_price under the same invariant.  Used by burn_usm()
+    # and redeem_fum(), and by their quotes.
+    return amount_in / (initial_price + amount_in / pool_eth)
+
+def batch_clearing_price(pool_eth, eth_in_price, eth_out_price, eth_in, amount_in):
+    # The uniform price (in tokens per ETH) at which eth_in ETH of buys (eg, mints), starting from eth_in_price, and amount_in tokens of sells (eg, USM burned), starting from eth_out_price, clear
+    # against each other and a pool of pool_eth.  Whichever side is bigger trades its excess against the pool, at the average price amount_out_for_eth_in() or eth_out_for_amount_in() gives for
+    # it, and the rest of the batch is filled from the other side at that same price:
+    # 1. Buys outweigh sells (amount_in <= eth_in * eth_in_price): the pool takes in the net eth_in - amount_in / price ETH, at the average price eth_in_price * pool_eth / (pool_eth + net ETH in).
+    #    Solving that for price gives (eth_in_price * pool_eth + amount_in) / (pool_eth + eth_in).
+    # 2. Sells outweigh buys (amount_in > eth_in * eth_out_price): the pool takes in the net amount_in - eth_in * price tokens, at the average price eth_out_price + net tokens in / pool_eth,
+    #    which solves to (eth_out_price * pool_eth + amount_in) / (pool_eth + eth_in).
+    # 3. Otherwise, the two sides cross entirely, at amount_in / eth_in (which is between eth_in_price and eth_out_price), and the pool doesn't trade.
+    # The three meet at the boundaries, so the price is continuous in the flows.  With no sells, 1 is just amount_out_for_eth_in() / eth_in; with no buys, 2 is eth_out_for_amount_in()'s price.
+    if amount_in <= eth_in * eth_in_price:
+        return (eth_in_price * pool_eth + amount_in) / (pool_eth + eth_in)
+    elif amount_in > eth_in * eth_out_price:
+        return (eth_out_price * pool_eth + amount_in) / (pool_eth + eth_in)
+    return amount_in / eth_in
+
+def eth_in_for_amount_out(pool_eth, initial_price, amount_out):
+    # Inverse of amount_out_for_eth_in(): amount_out = pool_eth * initial_price * eth_in / (pool_eth + eth_in), solved for eth_in.  Since the price slides towards 0 as ETH is added, no amount of ETH
+    # gets out pool_eth * initial_price or more:
+    assert amount_out < pool_eth * initial_price, "No amount of ETH gets {:,} out: the sliding price caps it below {:,}".format(amount_out, pool_eth * initial_price)
+    return amount_out * pool_eth / (pool_eth * initial_price - amount_out)
+
+def amount_in_for_eth_out(pool_eth, initial_price, eth_out):
+    # Inverse of eth_out_for_amount_in(): eth_out = amount_in / (initial_price + amount_in / pool_eth), solved for amount_in.  Only defined for eth_out < pool_eth:
+    assert eth_out < pool_eth, "Not enough ETH in the pool"
+    return eth_out * initial_price * pool_eth / (pool_eth - eth_out)
+
 def half_exp_approx(power_shifted, max_power=math.inf):
     """Returns a loose but "gas-efficient" approximation of 0.5**power, where:
     1. Both input and output are in fixed-point format, shifted by SHIFT decimal digits.  Eg, input power_shifted = 1400000000000000000 represents power = 1400000000000000000 / 10**18 = 1.4, so returns approx (0.5**1.4) * 10**18 = 378929141627599521
     2. power is rounded to the nearest 10th: power = 0.462 is treated as power = 0.5
-    3. Large values of power (> max_power) just return 0, since 0.5**large_power =~ 0"""
+    3. Large values of power (> max_power) just return 0, since 0.5**large_power =~ 0
+    Pools with USE_HALF_EXP_TABLE set use half_exp_table_approx() instead, which rounds power more finely: see Pool.half_exp()."""
     assert power_shifted >= 0
     power_in_tenths = (power_shifted + (ONE_TENTH_SHIFTED // 2)) // ONE_TENTH_SHIFTED   # After this, power_in_tenths must be a non-negative integer
     if power_in_tenths > 10 * max_power:
@@ -337,5 +895,34 @@ def half_to_the_one_tenth_exp_approx(power):
             result = (result * HALF_TO_THE_ONE_TENTH_SHIFTED) // ONE_SHIFTED
         return result
 
-
-main()
+def half_exp_table_approx(power_shifted, bits, max_power=math.inf):
+    """Like half_exp_approx(), but rounds power to the nearest 1/2**bits (eg, a pool's HALF_EXP_TABLE_BITS) rather than the nearest 1/10, and needs no recursion: split the rounded power into
+    its whole part w and its binary fraction 0.b1 b2 ... bn, so that 0.5**power = 0.5**w * product of 0.5**(1/2**k) for each bit bk that's set.  The 0.5**(1/2**k) factors come from the
+    precomputed HALF_TO_THE_HALF_TO_THE_K_SHIFTED table, and 0.5**w is just a division by 2**w.  So that's at most bits multiplications, however large power is."""
+    assert power_shifted >= 0 and 0 <= bits <= HALF_EXP_TABLE_MAX_BITS
+    power_in_units = int((power_shifted * (1 << bits) + ONE_SHIFTED // 2) // ONE_SHIFTED)     # power rounded to the nearest 1/2**bits, as a (non-negative) integer number of 1/2**bits units
+    if power_in_units > max_power * (1 << bits):
+        return 0
+    whole, fraction = power_in_units >> bits, power_in_units & ((1 << bits) - 1)
+    table = half_exp_table()
+    result = ONE_SHIFTED
+    k = bits
+    while fraction:
+        if fraction & 1:
+            result = (result * table[k]) // ONE_SHIFTED
+        fraction >>= 1
+        k -= 1
+    return result >> whole
+
+def half_exp_table():
+    # HALF_TO_THE_HALF_TO_THE_K_SHIFTED, computing it the first time:
+    global HALF_TO_THE_HALF_TO_THE_K_SHIFTED
+    if HALF_TO_THE_HALF_TO_THE_K_SHIFTED is None:
+        import decimal
+        with decimal.localcontext() as context:
+            context.prec = 40                                   # Unlike floats, Decimal calcs these to full precision, so no need to hardcode them all from wolframalpha
+            HALF_TO_THE_HALF_TO_THE_K_SHIFTED = [None] + [int((decimal.Decimal('0.5') ** (decimal.Decimal(1) / 2**k) * ONE_SHIFTED).to_integral_value()) for k in range(1, HALF_EXP_TABLE_MAX_BITS + 1)]
+    return HALF_TO_THE_HALF_TO_THE_K_SHIFTED
+
+if __name__ == '__main__':
+    main()
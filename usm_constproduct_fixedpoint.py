@@ -0,0 +1,544 @@
+import argparse
+import contextlib
+import io
+import math
+import sys
+from time import perf_counter
+
+import usm_constproduct
+
+# ________________________________________ Fixed-point arithmetic ________________________________________
+
+# Every amount, price, adjustment and ratio is a non-negative integer number of 1/10**18ths ("WAD" fixed point, as usm_constproduct.half_exp_approx() already uses), ie what a uint256 holds
+# on-chain.  Products and quotients are computed at full width and rounded once, like OpenZeppelin's Math.mulDiv(): only the result has to fit in 256 bits, and if it doesn't (or a
+# subtraction would go below 0), we raise OverflowError, as a contract would revert.  Each call site names its rounding direction, and the rule is that every rounding favors the pool:
+# 1. Amounts paid out (USM minted, ETH removed, FUM created) round down.
+# 2. Buy prices round up, sell prices down.  Debt ratios round up, so checks against MAX_DEBT_RATIO err on the side of rejecting; the min FUM buy price (a floor on the buy price) rounds up.
+# 3. Adjustment factors round away from 1 - up if they're above 1, down if below - so they decay back towards 1 no faster than the exact value.
+
+WAD                 = usm_constproduct.ONE_SHIFTED
+UINT256_MAX         = 2**256 - 1
+GUARD               = 10**18                                # Extra digits that ln_precise()/exp_precise() work with internally, so that rounding their results to WAD once gets the direction right
+PRECISE             = WAD * GUARD                           # 1 in ln_precise()/exp_precise() units.  (PRECISE**2 = 1e72 still fits in 256 bits, so a contract could do the same.)
+LN2_PRECISE         = 693147180559945309417232121458176568  # ln(2) * PRECISE, to the nearest unit
+SQRT2_PRECISE       = 1414213562373095048801688724209698079 # sqrt(2) * PRECISE, to the nearest unit
+EXP_MAX_SHIFT       = 256                                   # exp_precise() of anything needing a bigger power of 2 than this overflows
+EXP_TABLE_STEPS     = 64                                    # exp_precise() looks up e**(j / EXP_TABLE_STEPS) for whole j, leaving its series only |r| <= 1/128 to sum: ~12 terms, not ~25
+EXP_TABLE           = None                                  # {j: e**(j / EXP_TABLE_STEPS) * PRECISE}: filled in by exp_table() the first time it's needed
+
+def checked(value):
+    if value > UINT256_MAX:
+        raise OverflowError("uint256 overflow: {}".format(value))
+    return value
+
+def sub(a, b):
+    if b > a:
+        raise OverflowError("uint256 underflow: {} - {}".format(a, b))
+    return a - b
+
+# WAD multiply/divide, and full-width a * b / c, each rounded down or up.  (The overflow check is inlined, not a call to checked(): these run many times per op.)
+
+def mul_down(a, b):
+    result = a * b // WAD
+    if result > UINT256_MAX:
+        raise OverflowError("uint256 overflow: {}".format(result))
+    return result
+
+def mul_up(a, b):
+    result = -(-a * b // WAD)
+    if result > UINT256_MAX:
+        raise OverflowError("uint256 overflow: {}".format(result))
+    return result
+
+def div_down(a, b):
+    result = a * WAD // b
+    if result > UINT256_MAX:
+        raise OverflowError("uint256 overflow: {}".format(result))
+    return result
+
+def div_up(a, b):
+    result = -(-a * WAD // b)
+    if result > UINT256_MAX:
+        raise OverflowError("uint256 overflow: {}".format(result))
+    return result
+
+def mul_div_down(a, b, c):
+    result = a * b // c
+    if result > UINT256_MAX:
+        raise OverflowError("uint256 overflow: {}".format(result))
+    return result
+
+def mul_div_up(a, b, c):
+    result = -(-a * b // c)
+    if result > UINT256_MAX:
+        raise OverflowError("uint256 overflow: {}".format(result))
+    return result
+
+def round_away_from_one(numerator, denominator):
+    # numerator / denominator as a WAD adjustment factor, rounded away from 1 (see rule 3 above):
+    quotient, remainder = divmod(numerator, denominator)
+    return checked(quotient + 1 if remainder and quotient >= WAD else quotient)
+
+def ln_precise(x):
+    # ln(x / PRECISE) * PRECISE, for x > 0: halve or double x into [1/sqrt(2), sqrt(2)), then sum the series ln(y) = 2 * (z + z**3/3 + z**5/5 + ...), where z = (y - 1) / (y + 1), which has
+    # |z| < 0.172, and is tiny for the y near 1 that adjustment factors usually are - so only a few terms are needed.
+    shift = x.bit_length() - PRECISE.bit_length()
+    y = x >> shift if shift >= 0 else x << -shift
+    while y >= SQRT2_PRECISE:
+        y >>= 1
+        shift += 1
+    while 2 * y < SQRT2_PRECISE:
+        y <<= 1
+        shift -= 1
+    negative = y < PRECISE
+    z = abs(y - PRECISE) * PRECISE // (y + PRECISE)
+    z_squared = z * z // PRECISE
+    term = total = z
+    n = 1
+    while term:
+        term = term * z_squared // PRECISE
+        n += 2
+        total += term // n
+    return (-2 * total if negative else 2 * total) + shift * LN2_PRECISE
+
+def exp_precise(x):
+    # e**(x / PRECISE) * PRECISE, for any x (positive or negative): split off a power of 2 and a table entry, e**x = 2**k * e**(j / EXP_TABLE_STEPS) * e**r with |r| <= 1/128, and
+    # sum the Taylor series for e**r.
+    k = (x + LN2_PRECISE // 2) // LN2_PRECISE
+    if k > EXP_MAX_SHIFT:
+        raise OverflowError("uint256 overflow: exp({})".format(x / PRECISE))
+    if k < -EXP_MAX_SHIFT:
+        return 0
+    r = x - k * LN2_PRECISE
+    j = (r * EXP_TABLE_STEPS + PRECISE // 2) // PRECISE
+    total = exp_series(r - j * (PRECISE // EXP_TABLE_STEPS)) * exp_table()[j] // PRECISE
+    return total << k if k >= 0 else total >> -k
+
+def exp_series(r):
+    # e**(r / PRECISE) * PRECISE by its Taylor series, for small |r|.  Negative r is done as 1 / e**|r|, so every term is positive and the sum stops when they round to 0:
+    r_abs = abs(r)
+    term = total = PRECISE
+    n = 0
+    while term:
+        n += 1
+        term = term * r_abs // (n * PRECISE)
+        total += term
+    return PRECISE * PRECISE // total if r < 0 else total
+
+def exp_table():
+    # EXP_TABLE, computing it the first time, for every j exp_precise() can need (|r| <= ln(2)/2 there, so |j| <= 23).  The entries come from exp_series() too, just with more terms:
+    global EXP_TABLE
+    if EXP_TABLE is None:
+        limit = (LN2_PRECISE // 2 * EXP_TABLE_STEPS) // PRECISE + 1
+        EXP_TABLE = {j: exp_series(j * (PRECISE // EXP_TABLE_STEPS)) for j in range(-limit, limit + 1)}
+    return EXP_TABLE
+
+def half_pow_precise(elapsed, half_life):
+    # 0.5**(elapsed / half_life) * PRECISE, for integer seconds:
+    return exp_precise(-(elapsed * LN2_PRECISE // half_life))
+
+def to_wad(value):
+    # A float or int (eg a parameter, or a float engine output) -> WAD, to the nearest unit.  Via the float's exact ratio, since value * WAD in floats would itself be off by ~1e-16:
+    numerator, denominator = value.as_integer_ratio()
+    return (2 * numerator * WAD + denominator) // (2 * denominator)
+
+def parse_wad(text):
+    # A decimal string from a command, eg "0.5176" -> 517600000000000000, exactly (digits past the 18th are dropped, ie rounded down).  Only falls back to Decimal for unusual input,
+    # eg "1e3".
+    whole, _, fraction = text.partition('.')
+    if whole.isdigit() and (fraction.isdigit() or not fraction):
+        return checked(int(whole) * WAD + (int(fraction[:18].ljust(18, '0')) if fraction else 0))
+    import decimal
+    value = decimal.Decimal(text)
+    assert value.is_finite() and value >= 0, "{} isn't a uint256 amount".format(text)
+    return checked(int(value.scaleb(18)))
+
+def from_wad(value):
+    return value / WAD                                      # int / int is correctly rounded, so this is the nearest float
+
+
+# ________________________________________ Fixed-point pool ________________________________________
+
+class FixedPointPool:
+    """Runs the usm_constproduct.py mechanics entirely in WAD fixed point: every pricing and state-update path (the sliding-price integrals, adjustments and their decay, debt ratio, FUM
+    price, min FUM buy price) computes what a uint256 contract would, rounding as above, so simulations can predict on-chain rounding.  Parameters are the same as a
+    usm_constproduct.Pool's, and are passed in the same (float) units, but are held as WADs (and the half-lives as integer seconds).  Differences from usm_constproduct.Pool:
+    1. Time is whole seconds, like a block timestamp: "wait" amounts are rounded down.
+    2. A negative buffer prices FUM at 0, not below (a uint256 can't go negative).  The float engine's negative FUM prices only ever matter where the min FUM buy price overrides them.
+    3. The min FUM buy price is set/cleared silently, and there are no forks, caches or quotes: just the state, so each op allocates next to nothing."""
+
+    PARAMETERS                          = ('MAX_DEBT_RATIO', 'BUY_SELL_ADJUSTMENTS_HALF_LIFE', 'MIN_FUM_BUY_PRICE_HALF_LIFE', 'APPROXIMATE_TO_SAVE_GAS')
+    MID, BUY, SELL                      = usm_constproduct.MID, usm_constproduct.BUY, usm_constproduct.SELL
+    STATE_VARIABLES                     = usm_constproduct.Pool.STATE_VARIABLES
+
+    def __init__(self, **params):
+        for name in params:
+            if name not in self.PARAMETERS:
+                raise TypeError("{} is not a parameter of {}.FixedPointPool".format(name, __name__))
+        params = {name: params.get(name, getattr(usm_constproduct.Pool, name)) for name in self.PARAMETERS}
+        self.MAX_DEBT_RATIO = to_wad(params['MAX_DEBT_RATIO'])
+        self.BUY_SELL_ADJUSTMENTS_HALF_LIFE = round(params['BUY_SELL_ADJUSTMENTS_HALF_LIFE'])
+        self.MIN_FUM_BUY_PRICE_HALF_LIFE = round(params['MIN_FUM_BUY_PRICE_HALF_LIFE'])
+        self.APPROXIMATE_TO_SAVE_GAS = params['APPROXIMATE_TO_SAVE_GAS']
+        self.reset_state()
+
+    # ________________________________________ Commands ________________________________________
+
+    def replay(self, lines):
+        # Like usm_constproduct.Pool.replay(), without the status summaries.  Returns (commands, errors).
+        commands = errors = 0
+        for line_number, line in enumerate(lines, 1):
+            words = line.split()
+            if not words or words[0].startswith('#'):
+                continue
+            self.prepare_for_next_command()
+            try:
+                self.apply_command(words)
+            except Exception as err:
+                errors += 1
+                print("Error on line {}: {!r}".format(line_number, err), file=sys.stderr)
+            commands += 1
+        self.prepare_for_next_command()
+        return commands, errors
+
+    def prepare_for_next_command(self):
+        self.set_min_fum_buy_price_in_eth_if_needed()
+        self.clear_min_fum_buy_price_if_obsolete()
+
+    def apply_command(self, words):
+        # Same commands as usm_constproduct.Pool.apply_command(), and returns the same outputs, as WADs:
+        command = words[0]
+        if command == "price":
+            self.set_oracle_eth_price(*map(parse_wad, words[1].split('/')))
+        elif command == "mint":
+            return self.mint_usm(words[1], parse_wad(words[2]))
+        elif command == "burn":
+            return self.burn_usm(words[1], parse_wad(words[2]))
+        elif command == "fund_eth":
+            return self.create_fum_from_eth(words[1], parse_wad(words[2]))
+        elif command == "fund_usm":
+            return self.create_fum_from_usm(words[1], parse_wad(words[2]))
+        elif command == "defund":
+            return self.redeem_fum(words[1], parse_wad(words[2]))
+        elif command == "wait":
+            self.set_time(self.time + parse_wad(words[1]) // WAD)
+        else:
+            raise ValueError("Unrecognized command: '{}'".format(words))
+
+    def status_summary(self):
+        return "{:,} ETH at ${:,} = ${:,} pool value, {:,} USM outstanding, debt ratio = {:.2%}, {:,} FUM outstanding (${:,}/${:,}, min {:,} ETH), adj {:.6f}/{:.6f}".format(
+            round(from_wad(self.pool_eth), 6), round(from_wad(self.calc_eth_price(self.MID)), 4), round(from_wad(mul_down(self.pool_eth, self.calc_eth_price(self.MID))), 2),
+            round(from_wad(self.usm_supply), 4), from_wad(self.debt_ratio()), round(from_wad(self.fum_supply), 4), round(from_wad(self.calc_fum_price(self.SELL) or 0), 6),
+            round(from_wad(self.calc_fum_price(self.BUY)), 6), round(from_wad(self.min_fum_buy_price_in_eth()), 8), from_wad(self.mint_burn_adjustment()), from_wad(self.fund_defund_adjustment()))
+
+    # ________________________________________ State-modifying operations ________________________________________
+
+    def reset_state(self):
+        initial = usm_constproduct.Pool.INITIAL_STATE
+        self.time = int(initial['time'])
+        self.oracle_eth_buy_price = to_wad(initial['oracle_eth_buy_price'])
+        self.oracle_eth_sell_price = to_wad(initial['oracle_eth_sell_price'])
+        self.pool_eth = 0
+        self.usm_holdings = {}
+        self.fum_holdings = {}
+        self.usm_supply = 0
+        self.fum_supply = 0
+        self.mint_burn_adjustment_stored = WAD
+        self.mint_burn_adjustment_timestamp = 0
+        self.fund_defund_adjustment_stored = WAD
+        self.fund_defund_adjustment_timestamp = 0
+        self.min_fum_buy_price_in_eth_stored = 0
+        self.min_fum_buy_price_timestamp = 0
+        self.invalidate_decayed_values()
+
+    def invalidate_decayed_values(self):
+        # The decayed adjustments and min FUM buy price as of self.time, computed when first needed (None until then): only time and the stored values change them, so nothing else
+        # has to invalidate them.
+        self.decayed_mint_burn_adjustment = self.decayed_fund_defund_adjustment = self.decayed_min_fum_buy_price_in_eth = None
+
+    def set_time(self, new_time):
+        assert new_time >= self.time, "Time can't go backwards"
+        if new_time != self.time:
+            self.time = new_time
+            self.invalidate_decayed_values()
+
+    def set_oracle_eth_price(self, new_price, new_buy_price=None):
+        self.oracle_eth_sell_price = new_price
+        self.oracle_eth_buy_price = new_buy_price if new_buy_price is not None else new_price
+        if self.min_fum_buy_price_needs_setting():
+            # The FUM price in ETH as of the ETH price at which the debt ratio crossed MAX_DEBT_RATIO: see usm_constproduct.Pool.set_oracle_eth_price().
+            self.set_min_fum_buy_price_in_eth_if_needed(mul_div_up(self.pool_eth, WAD - self.MAX_DEBT_RATIO, self.fum_supply))
+
+    def mint_usm(self, user, eth_to_add):
+        initial_eth_price = self.calc_eth_price(self.SELL)
+        pool_eth = self.pool_eth
+        new_pool_eth = checked(pool_eth + eth_to_add)
+        if pool_eth == 0:
+            usm_minted = mul_down(eth_to_add, initial_eth_price)
+        else:
+            usm_minted = amount_out_for_eth_in(pool_eth, initial_eth_price, eth_to_add)
+            self.set_mint_burn_adjustment(round_away_from_one(self.mint_burn_adjustment() * pool_eth * pool_eth, new_pool_eth * new_pool_eth))   # / pool_eth_growth_factor**2
+        self.usm_supply = checked(self.usm_supply + usm_minted)                    # Can only fail if the adjustment's did, since usm_minted < new_pool_eth * initial_eth_price
+        self.usm_holdings[user] = self.usm_holdings.get(user, 0) + usm_minted
+        self.pool_eth = new_pool_eth
+        return usm_minted
+
+    def burn_usm(self, user, usm_to_burn, check_debt_ratio=True):
+        held = self.usm_holdings.get(user, 0)
+        assert usm_to_burn <= held, "{} doesn't own that many USM".format(user)
+        pool_eth = self.pool_eth
+        eth_removed = eth_out_for_amount_in(pool_eth, self.calc_eth_price(self.BUY), usm_to_burn)
+        assert eth_removed <= pool_eth, "Not enough ETH in the pool"
+        new_pool_eth = pool_eth - eth_removed
+        if check_debt_ratio:
+            assert self.debt_ratio(eth=new_pool_eth, usm=self.usm_supply - usm_to_burn) <= WAD, "Burning {:,} USM would leave the debt ratio above 100%".format(from_wad(usm_to_burn))
+        self.set_mint_burn_adjustment(round_away_from_one(self.mint_burn_adjustment() * pool_eth * pool_eth, new_pool_eth * new_pool_eth))       # / pool_eth_shrink_factor**2
+        self.usm_holdings[user] = held - usm_to_burn
+        self.usm_supply = sub(self.usm_supply, usm_to_burn)
+        self.pool_eth = new_pool_eth
+        return eth_removed
+
+    def create_fum_from_eth(self, user, eth_to_add):
+        # Every check is done before the first write (checks-effects, as a contract would order it), so a failed fund changes nothing: create_fum_from_usm() relies on that.
+        pool_eth = self.pool_eth
+        new_pool_eth = checked(pool_eth + eth_to_add)
+        if self.fum_supply == 0:
+            fum_created = mul_down(eth_to_add, self.calc_eth_price(self.MID))
+            adjustment = None
+        else:
+            initial_eth_price_in_fum = div_down(self.calc_eth_price(self.MID), self.calc_fum_price(self.BUY))
+            fum_created = amount_out_for_eth_in(pool_eth, initial_eth_price_in_fum, eth_to_add)
+            adjustment = round_away_from_one(self.fund_defund_adjustment() * new_pool_eth * new_pool_eth, pool_eth * pool_eth)                    # * pool_eth_growth_factor**2
+        new_fum_supply = checked(self.fum_supply + fum_created)
+        if adjustment is not None:
+            self.set_fund_defund_adjustment(adjustment)
+        self.fum_holdings[user] = self.fum_holdings.get(user, 0) + fum_created
+        self.fum_supply = new_fum_supply
+        self.pool_eth = new_pool_eth
+        return fum_created
+
+    def create_fum_from_usm(self, user, usm_to_convert):
+        # A burn (without the debt ratio check) then a fund, as one transaction: if the fund fails, the burn is undone too.  Rather than journal every write, as usm_constproduct.Pool's
+        # forks do, just save the little that a burn (and clearing the min FUM buy price) changes: a failed fund writes nothing.
+        saved = (self.pool_eth, self.usm_supply, self.usm_holdings.get(user), self.mint_burn_adjustment_stored, self.mint_burn_adjustment_timestamp, self.decayed_mint_burn_adjustment,
+                 self.min_fum_buy_price_in_eth_stored, self.min_fum_buy_price_timestamp, self.decayed_min_fum_buy_price_in_eth)
+        try:
+            eth_converted = self.burn_usm(user, usm_to_convert, check_debt_ratio=False)
+            self.clear_min_fum_buy_price_if_obsolete()
+            return self.create_fum_from_eth(user, eth_converted)
+        except BaseException:
+            (self.pool_eth, self.usm_supply, usm_held, self.mint_burn_adjustment_stored, self.mint_burn_adjustment_timestamp, self.decayed_mint_burn_adjustment,
+             self.min_fum_buy_price_in_eth_stored, self.min_fum_buy_price_timestamp, self.decayed_min_fum_buy_price_in_eth) = saved
+            if usm_held is None:
+                self.usm_holdings.pop(user, None)
+            else:
+                self.usm_holdings[user] = usm_held
+            raise
+
+    def redeem_fum(self, user, fum_to_redeem):
+        held = self.fum_holdings.get(user, 0)
+        assert fum_to_redeem <= held, "{} doesn't own that many FUM".format(user)
+        pool_eth = self.pool_eth
+        fum_sell_price = self.calc_fum_price(self.SELL)
+        assert fum_sell_price > 0, "FUM can't be redeemed at a sell price of {}".format(from_wad(fum_sell_price))     # Eg, a buffer at or below 0, which calc_fum_price() clamps to 0
+        initial_eth_price_in_fum = div_up(self.calc_eth_price(self.MID), fum_sell_price)
+        eth_removed = eth_out_for_amount_in(pool_eth, initial_eth_price_in_fum, fum_to_redeem)
+        new_pool_eth = sub(pool_eth, eth_removed)
+        assert self.debt_ratio(eth=new_pool_eth) <= self.MAX_DEBT_RATIO, "Redeeming {:,} FUM would leave the debt ratio above {:.0%}".format(from_wad(fum_to_redeem), from_wad(self.MAX_DEBT_RATIO))
+        self.set_fund_defund_adjustment(round_away_from_one(self.fund_defund_adjustment() * new_pool_eth * new_pool_eth, pool_eth * pool_eth))    # * pool_eth_shrink_factor**2
+        self.fum_holdings[user] = held - fum_to_redeem
+        self.fum_supply = sub(self.fum_supply, fum_to_redeem)
+        self.pool_eth = new_pool_eth
+        return eth_removed
+
+    def set_min_fum_buy_price_in_eth_if_needed(self, price_in_eth=None):
+        if self.min_fum_buy_price_needs_setting():
+            if price_in_eth is None:
+                price_in_eth = div_up(self.calc_fum_price(self.BUY, adjusted=False, mfbp=False), self.calc_eth_price(self.MID))
+            self.min_fum_buy_price_in_eth_stored = self.decayed_min_fum_buy_price_in_eth = price_in_eth
+            self.min_fum_buy_price_timestamp = self.time
+
+    def clear_min_fum_buy_price_if_obsolete(self):
+        if self.min_fum_buy_price_in_eth() != 0 and self.debt_ratio() <= self.MAX_DEBT_RATIO:
+            self.min_fum_buy_price_in_eth_stored = self.decayed_min_fum_buy_price_in_eth = 0
+            self.min_fum_buy_price_timestamp = 0
+
+    def set_mint_burn_adjustment(self, adjustment_factor):
+        self.mint_burn_adjustment_stored = self.decayed_mint_burn_adjustment = adjustment_factor
+        self.mint_burn_adjustment_timestamp = self.time
+
+    def set_fund_defund_adjustment(self, adjustment_factor):
+        self.fund_defund_adjustment_stored = self.decayed_fund_defund_adjustment = adjustment_factor
+        self.fund_defund_adjustment_timestamp = self.time
+
+    # ________________________________________ Prices and ratios ________________________________________
+
+    def debt_ratio(self, eth=None, usm=None):
+        value = mul_down(self.pool_eth if eth is None else eth, self.calc_eth_price(self.MID))
+        return 0 if value == 0 else div_up(self.usm_supply if usm is None else usm, value)
+
+    def calc_eth_price(self, side, adjusted=True):
+        if side == self.MID:                                                        # The most common case (debt_ratio() and every FUM price need it), so checked first
+            return (self.oracle_eth_sell_price + self.oracle_eth_buy_price) // 2
+        elif side == self.BUY:
+            if not adjusted:
+                return self.oracle_eth_buy_price
+            return mul_div_up(self.oracle_eth_buy_price * max(WAD, self.mint_burn_adjustment()), max(WAD, self.fund_defund_adjustment()), WAD * WAD)
+        elif side == self.SELL:
+            if not adjusted:
+                return self.oracle_eth_sell_price
+            return mul_div_down(self.oracle_eth_sell_price * min(WAD, self.mint_burn_adjustment()), min(WAD, self.fund_defund_adjustment()), WAD * WAD)
+        raise ValueError("Unknown side: {!r}".format(side))
+
+    def calc_fum_price(self, side, adjusted=True, mfbp=True):
+        # None for a SELL/MID price with no FUM yet (where the float engine returns NaN):
+        if self.fum_supply == 0:
+            return WAD if side == self.BUY else None
+        eth_price = self.calc_eth_price(side, adjusted=False)
+        if side == self.BUY:
+            price = div_up(max(0, mul_up(self.pool_eth, eth_price) - self.usm_supply), self.fum_supply)
+            if adjusted:
+                price = mul_div_up(price * max(WAD, self.mint_burn_adjustment()), max(WAD, self.fund_defund_adjustment()), WAD * WAD)
+            if mfbp:
+                price = max(price, mul_up(self.min_fum_buy_price_in_eth(), self.calc_eth_price(self.MID)))
+        else:
+            price = div_down(max(0, mul_down(self.pool_eth, eth_price) - self.usm_supply), self.fum_supply)
+            if side == self.SELL and adjusted:
+                price = mul_div_down(price * min(WAD, self.mint_burn_adjustment()), min(WAD, self.fund_defund_adjustment()), WAD * WAD)
+        return price
+
+    def min_fum_buy_price_needs_setting(self):
+        return self.min_fum_buy_price_in_eth() == 0 and self.fum_supply > 0 and self.debt_ratio() > self.MAX_DEBT_RATIO
+
+    def min_fum_buy_price_in_eth(self):
+        value = self.decayed_min_fum_buy_price_in_eth
+        if value is None:
+            stored, elapsed = self.min_fum_buy_price_in_eth_stored, self.time - self.min_fum_buy_price_timestamp
+            if stored == 0 or elapsed == 0:
+                value = stored
+            elif self.APPROXIMATE_TO_SAVE_GAS:
+                value = mul_div_up(stored, usm_constproduct.half_exp_approx(elapsed * WAD // self.MIN_FUM_BUY_PRICE_HALF_LIFE), WAD)
+            else:
+                value = mul_div_up(stored, half_pow_precise(elapsed, self.MIN_FUM_BUY_PRICE_HALF_LIFE), PRECISE)
+            self.decayed_min_fum_buy_price_in_eth = value
+        return value
+
+    def mint_burn_adjustment(self):
+        value = self.decayed_mint_burn_adjustment
+        if value is None:
+            value = self.decayed_mint_burn_adjustment = self.decayed_adjustment(self.mint_burn_adjustment_stored, self.time - self.mint_burn_adjustment_timestamp)
+        return value
+
+    def fund_defund_adjustment(self):
+        value = self.decayed_fund_defund_adjustment
+        if value is None:
+            value = self.decayed_fund_defund_adjustment = self.decayed_adjustment(self.fund_defund_adjustment_stored, self.time - self.fund_defund_adjustment_timestamp)
+        return value
+
+    def decayed_adjustment(self, stored, elapsed):
+        # stored ** (0.5 ** (elapsed / BUY_SELL_ADJUSTMENTS_HALF_LIFE)), rounded away from 1: the exact version computes it as e**(ln(stored) * 0.5**(...)), the approximate one as
+        # 1 - (1 - stored) * half_exp_approx(...), as usm_constproduct.Pool.mint_burn_adjustment() does.
+        if elapsed == 0 or stored == WAD:
+            return stored
+        if self.APPROXIMATE_TO_SAVE_GAS:
+            power = usm_constproduct.half_exp_approx(elapsed * WAD // self.BUY_SELL_ADJUSTMENTS_HALF_LIFE, max_power=10)
+            return WAD + mul_up(stored - WAD, power) if stored > WAD else WAD - mul_up(WAD - stored, power)
+        power = half_pow_precise(elapsed, self.BUY_SELL_ADJUSTMENTS_HALF_LIFE)
+        value = exp_precise(ln_precise(stored * GUARD) * power // PRECISE)
+        return checked(-(-value // GUARD)) if stored > WAD else value // GUARD
+
+
+# ________________________________________ Sliding-price integrals ________________________________________
+
+def amount_out_for_eth_in(pool_eth, initial_price, eth_in):
+    # usm_constproduct.amount_out_for_eth_in() = pool_eth * initial_price * eth_in / (pool_eth + eth_in), rounded down:
+    return mul_div_down(mul_down(pool_eth, initial_price), eth_in, pool_eth + eth_in)
+
+def eth_out_for_amount_in(pool_eth, initial_price, amount_in):
+    # usm_constproduct.eth_out_for_amount_in() = amount_in * pool_eth / (initial_price * pool_eth + amount_in), rounded down:
+    return mul_div_down(amount_in, pool_eth, mul_up(initial_price, pool_eth) + amount_in)
+
+
+# ________________________________________ Drift against the float engine ________________________________________
+
+DRIFT_STATE_VARIABLES = ('pool_eth', 'usm_supply', 'fum_supply', 'mint_burn_adjustment_stored', 'fund_defund_adjustment_stored', 'min_fum_buy_price_in_eth_stored')
+OUTPUT_UNITS = {'mint': 'USM', 'burn': 'ETH', 'fund_eth': 'FUM', 'fund_usm': 'FUM', 'defund': 'ETH'}
+
+def relative_difference(fixed, floating):
+    # |fixed - floating| / |floating|, exactly (fixed a WAD, floating a float engine value), or the absolute difference where floating is 0:
+    exact = to_wad(floating)
+    return abs(fixed - exact) / exact if exact else from_wad(fixed)
+
+def measure_drift(lines, approximate_to_save_gas=False):
+    # Runs lines through a FixedPointPool and a usm_constproduct.Pool in lockstep.  Returns a dict of how far apart they got:
+    # - 'outputs': per command, the number of successful ops, and the sum of (fixed-point output - float output) and of the float outputs, in tokens: the cumulative rounding drift
+    #   of what users got, and the volume it's relative to.
+    # - 'state': per state variable in DRIFT_STATE_VARIABLES, the relative difference at the end, and the largest along the way.
+    # - 'disagreements': how many commands one engine rejected and the other didn't, and the (1-based) command number of the first.  After a disagreement the two states differ
+    #   by a whole op, so later differences measure that, not rounding.
+    fixed_pool, float_pool = FixedPointPool(APPROXIMATE_TO_SAVE_GAS=approximate_to_save_gas), usm_constproduct.Pool(APPROXIMATE_TO_SAVE_GAS=approximate_to_save_gas)
+    outputs = {command: [0, 0, 0.0] for command in OUTPUT_UNITS}
+    max_state = dict.fromkeys(DRIFT_STATE_VARIABLES, 0.0)
+    commands = disagreements = 0
+    first_disagreement = None
+    with contextlib.redirect_stdout(io.StringIO()):                                 # Silence the float engine's min FUM buy price messages
+        for line in lines:
+            words = line.split()
+            if not words or words[0].startswith('#'):
+                continue
+            commands += 1
+            results = []
+            for pool in (fixed_pool, float_pool):
+                pool.prepare_for_next_command()
+                try:
+                    results.append(pool.apply_command(words) if pool is fixed_pool else pool.apply_command(words, verbose=False))
+                except Exception as err:
+                    results.append(err)
+            fixed_result, float_result = results
+            if isinstance(fixed_result, Exception) != isinstance(float_result, Exception):
+                disagreements += 1
+                first_disagreement = first_disagreement or commands
+            elif words[0] in outputs and not isinstance(fixed_result, Exception):
+                totals = outputs[words[0]]
+                totals[0] += 1
+                totals[1] += fixed_result - to_wad(float_result)                   # Summed exactly, in WADs
+                totals[2] += float_result
+            for name in DRIFT_STATE_VARIABLES:
+                max_state[name] = max(max_state[name], relative_difference(getattr(fixed_pool, name), getattr(float_pool, name)))
+    final_state = {name: relative_difference(getattr(fixed_pool, name), getattr(float_pool, name)) for name in DRIFT_STATE_VARIABLES}
+    return {'commands': commands, 'outputs': {command: (count, from_wad(drift), volume) for command, (count, drift, volume) in outputs.items()},
+            'state': {name: (final_state[name], max_state[name]) for name in DRIFT_STATE_VARIABLES}, 'disagreements': (disagreements, first_disagreement)}
+
+def print_drift(drift):
+    print("Cumulative drift, fixed point minus float, over {:,} commands:".format(drift['commands']))
+    print("  {:<10} {:>9} {:>24} {:>24} {:>12}".format("op", "ops", "output drift", "output volume", "relative"))
+    for command, (count, difference, volume) in drift['outputs'].items():
+        print("  {:<10} {:>9,} {:>20.6g} {:<3} {:>20,.4f} {:<3} {:>12.3g}".format(command, count, difference, OUTPUT_UNITS[command], volume, OUTPUT_UNITS[command],
+                                                                                   difference / volume if volume else 0))
+    print("  {:<32} {:>16} {:>16}".format("state variable", "final relative", "max relative"))
+    for name, (final, largest) in drift['state'].items():
+        print("  {:<32} {:>16.3g} {:>16.3g}".format(name, final, largest))
+    disagreements, first = drift['disagreements']
+    print("  Commands only one engine rejected: {:,}{}".format(disagreements, " (first: command {:,})".format(first) if first else ""))
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a trace through the WAD fixed-point engine, and optionally measure its rounding drift from the float engine (usm_constproduct.py).")
+    parser.add_argument('trace', help="commands to run, one per line, as for --replay ('-' for stdin)")
+    parser.add_argument('--drift', action='store_true', help="also run the trace through usm_constproduct.py in lockstep, and report how far the two drift apart")
+    parser.add_argument('--approximate-to-save-gas', action='store_true', help="mirror usm_constproduct.py's APPROXIMATE_TO_SAVE_GAS mode")
+    args = parser.parse_args()
+
+    with (contextlib.nullcontext(sys.stdin) if args.trace == '-' else open(args.trace)) as trace:
+        lines = trace.readlines()
+    pool = FixedPointPool(APPROXIMATE_TO_SAVE_GAS=args.approximate_to_save_gas)
+    start = perf_counter()
+    commands, errors = pool.replay(lines)
+    elapsed = perf_counter() - start
+    print(pool.status_summary())
+    print("Replayed {:,} commands ({:,} errors) in fixed point in {:.3f}s = {:,.0f} ops/sec.".format(commands, errors, elapsed, commands / elapsed if elapsed > 0 else math.inf))
+    if args.drift:
+        print()
+        print_drift(measure_drift(lines, args.approximate_to_save_gas))
+
+if __name__ == '__main__':
+    main()
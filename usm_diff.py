@@ -0,0 +1,202 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+import sys
+from time import perf_counter
+
+import numpy as np
+
+import usm
+import usm_constproduct
+import usm_metrics
+
+# Runs one command stream through usm.py (flat fees) and usm_constproduct.py (sliding prices) in lockstep, records how each pool looks after every step, and finds the first step where
+# they diverge on each of a chosen set of metrics, eg:
+#   python usm_diff.py --trace trace.txt                                       # One trace file, in the format the models' --replay reads
+#   python usm_diff.py --seeds 0-63 --commands 100000                           # 64 random traces, one per seed, run in parallel across all cores
+#   python usm_diff.py --seeds 0-7 --metrics fum_price=0.05,min_fum_buy_price --save diffs/
+# usm.py has no clock and a single ETH price, so it takes "wait" commands as no-ops, and "price 150/160" as the mid price, "price 155".  Each run's paths are one (steps, len(COLUMNS)) float64
+# array per model; --save writes them, plus the per-step deltas (usm_constproduct minus usm), to an .npz per run.
+
+MODELS = ('usm', 'usm_constproduct')
+COLUMNS = ('fee_revenue', 'fum_price', 'debt_ratio', 'min_fum_buy_price', 'rejected')    # min_fum_buy_price is in ETH (0 when not set); rejected is 1 if the command raised, else 0
+COMMAND_WEIGHTS = {'mint': 0.25, 'burn': 0.15, 'fund_eth': 0.15, 'fund_usm': 0.05, 'defund': 0.1, 'price': 0.1, 'wait': 0.2}       # For random_trace()
+USERS = tuple('ABCDEFGH')
+
+def cumulative_fee_revenue(paths):
+    return np.cumsum(paths[..., COLUMNS.index('fee_revenue')], axis=-1)
+
+def relative_difference(a, b):
+    # |a - b| relative to the larger of the two, 0 where they're equal (including both 0, or both NaN - eg, the FUM price before there are any FUM), and inf where just one is NaN:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        difference = np.abs(a - b) / np.maximum(np.abs(a), np.abs(b))
+    difference[(a == b) | (np.isnan(a) & np.isnan(b))] = 0
+    difference[np.isnan(a) != np.isnan(b)] = np.inf
+    return difference
+
+# Divergence metrics: name -> function(usm path, usm_constproduct path, tolerance) -> a bool per step, true where the two have diverged.  The numeric ones compare relative differences
+# against the tolerance; the others diverge wherever the two pools disagree, whatever the tolerance.
+DIVERGENCE_METRICS = {
+    'fee_revenue':          lambda a, b, tolerance: relative_difference(cumulative_fee_revenue(a), cumulative_fee_revenue(b)) > tolerance,     # Total to date, not each step's
+    'fum_price':            lambda a, b, tolerance: relative_difference(a[:, COLUMNS.index('fum_price')], b[:, COLUMNS.index('fum_price')]) > tolerance,
+    'debt_ratio':           lambda a, b, tolerance: relative_difference(a[:, COLUMNS.index('debt_ratio')], b[:, COLUMNS.index('debt_ratio')]) > tolerance,
+    'min_fum_buy_price':    lambda a, b, tolerance: (a[:, COLUMNS.index('min_fum_buy_price')] > 0) != (b[:, COLUMNS.index('min_fum_buy_price')] > 0),   # Set in one pool but not the other
+    'rejected':             lambda a, b, tolerance: a[:, COLUMNS.index('rejected')] != b[:, COLUMNS.index('rejected')],
+}
+
+def random_trace(seed, commands):
+    # A random command stream, as lines like a trace file's: a few users minting, burning, funding and defunding random amounts, while the ETH price does a random walk and time passes.
+    rng = np.random.default_rng(seed)
+    names = list(COMMAND_WEIGHTS)
+    kinds = rng.choice(len(names), commands, p=list(COMMAND_WEIGHTS.values())).tolist()
+    users = rng.choice(USERS, commands).tolist()
+    eth_amounts, usm_amounts, fum_amounts = rng.uniform(0.01, 2, commands).tolist(), rng.uniform(1, 200, commands).tolist(), rng.uniform(1, 50, commands).tolist()
+    waits = rng.integers(1, 600, commands).tolist()
+    prices = (200 * np.exp(np.cumsum(rng.normal(0, 0.01, commands)))).tolist()
+    lines = ["mint A 10", "fund_eth B 5"]
+    for i in range(commands - len(lines)):
+        command = names[kinds[i]]
+        if command in ('mint', 'fund_eth'):
+            lines.append("{} {} {:.4f}".format(command, users[i], eth_amounts[i]))
+        elif command in ('burn', 'fund_usm'):
+            lines.append("{} {} {:.2f}".format(command, users[i], usm_amounts[i]))
+        elif command == 'defund':
+            lines.append("{} {} {:.2f}".format(command, users[i], fum_amounts[i]))
+        elif command == 'price':
+            lines.append("price {:.2f}".format(prices[i]))
+        else:
+            lines.append("wait {}".format(waits[i]))
+    return lines
+
+def apply(model, words, row):
+    # Applies one command to model, and fills in row (one step of its path) with how the pool looks after it.
+    model.prepare_for_next_command()
+    eth_mid_price, fum_mid_price = usm_metrics.eth_mid_price(model), usm_metrics.fum_mid_price(model)
+    fee_revenue, rejected = 0, 0
+    try:
+        result = model.apply_command(words, verbose=False)
+    except Exception:
+        rejected = 1
+    else:
+        if result is not None:
+            fee_revenue = usm_metrics.fee_revenue(words[0], float(words[2]), result, eth_mid_price, fum_mid_price)
+    row[:] = (fee_revenue, usm_metrics.fum_mid_price(model), model.debt_ratio(), usm_metrics.min_fum_buy_price_in_eth(model), rejected)
+
+def run_lockstep(lines):
+    # Runs lines through a fresh pool of each model, one command at a time.  Returns (commands, paths): the commands run (as split words, skipping blanks and comments), and a
+    # (len(MODELS), steps, len(COLUMNS)) array, where paths[i, step] is how model MODELS[i]'s pool looked after command step.
+    commands = [words for words in (line.split() for line in lines) if words and not words[0].startswith('#')]
+    flat_pool, sliding_pool = usm.Pool(), usm_constproduct.Pool()
+    paths = np.empty((len(MODELS), len(commands), len(COLUMNS)))
+    flat_path, sliding_path = paths
+    with flat_pool.quiet(), sliding_pool.quiet():
+        for step, words in enumerate(commands):
+            apply(flat_pool, words, flat_path[step])
+            apply(sliding_pool, words, sliding_path[step])
+    return commands, paths
+
+def first_divergences(paths, tolerances):
+    # {metric: the first step at which the two paths diverge on it beyond its tolerance, or None if they never do}:
+    firsts = {}
+    for metric, tolerance in tolerances.items():
+        diverged = np.flatnonzero(DIVERGENCE_METRICS[metric](paths[0], paths[1], tolerance))
+        firsts[metric] = int(diverged[0]) if len(diverged) else None
+    return firsts
+
+def min_fum_buy_price_triggers(path):
+    # How many times the min FUM buy price was set, ie went from unset to set:
+    is_set = path[:, COLUMNS.index('min_fum_buy_price')] > 0
+    return int(np.count_nonzero(is_set[1:] & ~is_set[:-1]) + is_set[0]) if len(is_set) else 0
+
+def run_job(name, trace_path, seed, commands, tolerances, save_dir=None):
+    # Runs in a worker process: one trace (from trace_path, or random_trace(seed, commands)) through both models.  Returns a summary: the full paths only go to save_dir, if given, so
+    # only a few numbers per run come back to the parent process.
+    start = perf_counter()
+    if trace_path is not None:
+        with open(trace_path) as trace:
+            lines = trace.readlines()
+    else:
+        lines = random_trace(seed, commands)
+    commands, paths = run_lockstep(lines)
+    elapsed = perf_counter() - start
+    firsts = first_divergences(paths, tolerances)
+    if save_dir is not None:
+        np.savez_compressed(os.path.join(save_dir, name + '.npz'), columns=np.array(COLUMNS), **dict(zip(MODELS, paths)), delta=paths[1] - paths[0])
+    final_fee_revenue = cumulative_fee_revenue(paths)[:, -1] if len(commands) else np.zeros(len(MODELS))
+    return {'name': name, 'steps': len(commands), 'elapsed': elapsed, 'first_divergences': firsts,
+            'first_divergence_commands': {metric: ' '.join(commands[step]) for metric, step in firsts.items() if step is not None},
+            'fee_revenue': dict(zip(MODELS, final_fee_revenue.tolist())), 'rejected': dict(zip(MODELS, paths[:, :, COLUMNS.index('rejected')].sum(axis=1).astype(int).tolist())),
+            'min_fum_buy_price_triggers': dict(zip(MODELS, map(min_fum_buy_price_triggers, paths)))}
+
+def parse_seeds(spec):
+    # "0-3,10" -> [0, 1, 2, 3, 10]:
+    seeds = []
+    for part in spec.split(','):
+        first, _, last = part.partition('-')
+        seeds.extend(range(int(first), int(last or first) + 1))
+    return seeds
+
+def parse_metrics(spec, default_tolerance):
+    # "fum_price=0.05,min_fum_buy_price" -> {'fum_price': 0.05, 'min_fum_buy_price': default_tolerance}:
+    tolerances = {}
+    for part in spec.split(','):
+        metric, _, tolerance = part.partition('=')
+        if metric not in DIVERGENCE_METRICS:
+            raise ValueError("unknown metric '{}': choose from {}".format(metric, ", ".join(DIVERGENCE_METRICS)))
+        tolerances[metric] = float(tolerance) if tolerance else default_tolerance
+    return tolerances
+
+def format_summary(summary):
+    firsts = ", ".join("{} {}".format(metric, "never" if step is None else "at step {:,} ({})".format(step, summary['first_divergence_commands'][metric]))
+                       for metric, step in summary['first_divergences'].items())
+    return "{}: {:,} steps in {:.2f}s = {:,.0f} steps/sec; fee revenue ${:,.2f} vs ${:,.2f}; rejected {:,} vs {:,}; min FUM buy price set {:,} vs {:,} times; first divergence: {}".format(
+        summary['name'], summary['steps'], summary['elapsed'], summary['steps'] / summary['elapsed'] if summary['elapsed'] > 0 else 0,
+        *(summary[key][model] for key in ('fee_revenue', 'rejected', 'min_fum_buy_price_triggers') for model in MODELS), firsts)
+
+def print_totals(summaries, tolerances):
+    print("Over {:,} runs ({} vs {}):".format(len(summaries), *MODELS))
+    for metric, tolerance in tolerances.items():
+        steps = np.array([summary['first_divergences'][metric] for summary in summaries if summary['first_divergences'][metric] is not None])
+        print("  {:<20} (tolerance {:g}): diverged in {:,} runs{}".format(metric, tolerance, len(steps),
+              ", first at step {:,} (median {:,.0f}, max {:,})".format(steps.min(), np.median(steps), steps.max()) if len(steps) else ""))
+    total_steps = sum(summary['steps'] for summary in summaries)
+    print("  {:,} steps in all, {:,.0f} steps/sec per worker".format(total_steps, total_steps / sum(summary['elapsed'] for summary in summaries)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the same commands through usm.py and usm_constproduct.py in lockstep, and find where they diverge.")
+    parser.add_argument('--trace', action='append', default=[], metavar='FILE', help="a trace to run, one command per line as for --replay (repeatable)")
+    parser.add_argument('--seeds', type=parse_seeds, default=[], metavar='SEEDS', help="random traces to run, one per seed, eg 0-63 or 1,5,9")
+    parser.add_argument('--commands', type=int, default=100000, help="commands per random trace")
+    parser.add_argument('--metrics', default='fee_revenue,fum_price,min_fum_buy_price', metavar='NAME[=TOLERANCE],...',
+                        help="metrics to find the first divergence of, from: " + ", ".join(DIVERGENCE_METRICS))
+    parser.add_argument('--tolerance', type=float, default=0.01, help="relative difference beyond which the numeric metrics count as diverged, unless given per metric")
+    parser.add_argument('--save', metavar='DIR', help="save each run's paths and deltas to DIR/<run>.npz")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes (default: one per core)")
+    args = parser.parse_args()
+    if not args.trace and not args.seeds:
+        parser.error("give at least one --trace or --seeds")
+    try:
+        tolerances = parse_metrics(args.metrics, args.tolerance)
+    except ValueError as err:
+        parser.error(str(err))
+    if args.save:
+        os.makedirs(args.save, exist_ok=True)
+
+    jobs = [(os.path.splitext(os.path.basename(path))[0], path, None) for path in args.trace] + [('seed{}'.format(seed), None, seed) for seed in args.seeds]
+    summaries = []
+    start = perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(run_job, name, path, seed, args.commands, tolerances, args.save) for name, path, seed in jobs]
+        try:
+            for future in as_completed(futures):
+                summaries.append(future.result())
+                print(format_summary(summaries[-1]), flush=True)
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    print()
+    print_totals(summaries, tolerances)
+    print("{:,} runs in {:.1f}s.".format(len(summaries), perf_counter() - start))
+
+if __name__ == '__main__':
+    main()
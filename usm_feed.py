@@ -0,0 +1,128 @@
+import argparse
+import csv
+import heapq
+import importlib
+import itertools
+import struct
+import sys
+from time import perf_counter
+
+import usm_metrics
+
+# Backtests a model against a historical oracle price feed: streams (timestamp, sell price, buy price) ticks from a CSV or binary file, merges them by timestamp with a stream of user actions,
+# and drives the model's clock and oracle prices from the ticks, applying each action at its timestamp.  Both files are read lazily, so memory use doesn't grow with their size.  Eg:
+#   python usm_feed.py usm_constproduct eth_ticks.csv --actions actions.txt
+#   python usm_feed.py usm_constproduct eth_ticks.csv --convert eth_ticks.bin        # Binary ticks are much faster to parse
+# Tick files: CSV rows of "timestamp,sell,buy" (buy may be blank, meaning the same as sell; a header row is skipped), or binary records of three little-endian float64s.  Action files: one command
+# per line, as for --replay, prefixed by its timestamp, eg "1596240000 mint A 10".  Both must be in timestamp order.  At equal timestamps, ticks are applied before actions.
+
+TICK_RECORD = struct.Struct('<ddd')
+TICK_CHUNK_RECORDS = 65536                                                          # Binary ticks are read this many at a time
+TICK, ACTION = 0, 1                                                                 # Event kinds, in the order they're applied at equal timestamps
+
+def read_ticks(path):
+    return read_csv_ticks(path) if path.endswith('.csv') else read_binary_ticks(path)
+
+def read_csv_ticks(path):
+    with open(path, newline='') as ticks:
+        for row_number, row in enumerate(csv.reader(ticks)):
+            if not row or row[0].startswith('#'):
+                continue
+            try:
+                timestamp, sell_price = float(row[0]), float(row[1])
+            except ValueError:
+                if row_number == 0:
+                    continue                                                        # Header
+                raise
+            yield timestamp, sell_price, float(row[2]) if len(row) > 2 and row[2] else sell_price
+
+def read_binary_ticks(path):
+    with open(path, 'rb') as ticks:
+        while True:
+            chunk = ticks.read(TICK_RECORD.size * TICK_CHUNK_RECORDS)
+            if not chunk:
+                break
+            yield from TICK_RECORD.iter_unpack(chunk)
+
+def write_binary_ticks(ticks, path):
+    with open(path, 'wb') as output:
+        for chunk in iter(lambda: list(itertools.islice(ticks, TICK_CHUNK_RECORDS)), []):
+            output.write(b''.join(TICK_RECORD.pack(*tick) for tick in chunk))
+
+def read_actions(path):
+    with open(path) as actions:
+        for line in actions:
+            words = line.split()
+            if words and not words[0].startswith('#'):
+                yield float(words[0]), words[1:]
+
+def events(ticks, actions):
+    # Merges the two streams into one, ordered by (timestamp, kind), lazily: heapq.merge() only holds the next item of each.
+    return heapq.merge(((tick[0], TICK, tick[1:]) for tick in ticks), ((timestamp, ACTION, words) for timestamp, words in actions))
+
+def run(model, events, skip_unchanged_ticks=True):
+    # Applies each event to model, as replay() would the equivalent "wait"/"price" commands: the clock is set to each event's timestamp, the min FUM buy price is set/cleared as needed
+    # (prepare_for_next_command()), then the tick's prices or the action are applied.  With skip_unchanged_ticks, a tick that doesn't change the price, when nothing else has changed since
+    # the last event either, is skipped entirely: it couldn't set or clear the min FUM buy price, and the clock is only read by the next event that does something, which sets it anyway.
+    # (usm.py has no clock or buy/sell spread, so for it a tick just sets eth_price to the mid price.)  Returns counts of what was done.
+    constproduct = usm_metrics.is_constproduct(model)
+    counts = {'ticks': 0, 'ticks_skipped': 0, 'actions': 0, 'errors': 0}
+    previous_timestamp = -float('inf')
+    changed = True                                                                  # Has anything changed since the last prepare_for_next_command()?
+    for timestamp, kind, payload in events:
+        assert timestamp >= previous_timestamp, "Event at {} is out of order (after {})".format(timestamp, previous_timestamp)
+        previous_timestamp = timestamp
+        if kind == TICK:
+            counts['ticks'] += 1
+            sell_price, buy_price = payload
+            if constproduct:
+                unchanged = sell_price == model.oracle_eth_sell_price and buy_price == model.oracle_eth_buy_price
+            else:
+                unchanged = (sell_price + buy_price) / 2 == model.eth_price
+            if unchanged and not changed and skip_unchanged_ticks:
+                counts['ticks_skipped'] += 1
+                continue
+        model.prepare_for_next_command()
+        if constproduct and timestamp != model.time:
+            model.set_time(timestamp)
+        if kind == TICK:
+            if not unchanged:
+                if constproduct:
+                    model.set_oracle_eth_price(sell_price, buy_price)
+                else:
+                    model.change_eth_price((sell_price + buy_price) / 2)
+            changed = not unchanged
+        else:
+            counts['actions'] += 1
+            try:
+                model.apply_command(payload, verbose=False)
+            except Exception as err:
+                counts['errors'] += 1
+                print("Error at {}: {!r}".format(timestamp, err), file=sys.stderr)
+            changed = True
+    model.prepare_for_next_command()
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtest a model against a stream of oracle price ticks, merged with a stream of timestamped user actions.")
+    parser.add_argument('model', choices=['usm', 'usm_constproduct'])
+    parser.add_argument('ticks', help="tick file: .csv, or anything else for binary")
+    parser.add_argument('--actions', metavar='FILE', help="timestamped commands to interleave with the ticks")
+    parser.add_argument('--convert', metavar='BINARY', help="just convert the tick file to binary, and exit")
+    parser.add_argument('--no-skip', action='store_true', help="process every tick, even ones that change nothing")
+    args = parser.parse_args()
+
+    if args.convert:
+        write_binary_ticks(read_ticks(args.ticks), args.convert)
+        return
+    model = importlib.import_module(args.model).Pool()
+    start = perf_counter()
+    counts = run(model, events(read_ticks(args.ticks), read_actions(args.actions) if args.actions else ()), skip_unchanged_ticks=not args.no_skip)
+    elapsed = perf_counter() - start
+    print(model.status_summary())
+    print()
+    print("{:,} ticks ({:,} skipped as unchanged), {:,} actions ({:,} errors) in {:.3f}s = {:,.0f} events/sec.".format(
+        counts['ticks'], counts['ticks_skipped'], counts['actions'], counts['errors'], elapsed, (counts['ticks'] + counts['actions']) / elapsed if elapsed > 0 else float('inf')))
+
+if __name__ == '__main__':
+    main()
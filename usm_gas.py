@@ -0,0 +1,174 @@
+import argparse
+import collections
+import contextlib
+import dis
+import importlib
+import io
+import sys
+
+# Estimates what each top-level op (mint_usm(), burn_usm(), create_fum_from_eth(), create_fum_from_usm(), redeem_fum()) would cost on-chain, by tracing the bytecode the model actually
+# executes for it: every multiplication, division and exponentiation, every read/write of a storage variable (the *_stored/*_timestamp globals, pool_eth and the supplies), and every
+# function call, plus the deepest recursion.  Those counts are then weighted by rough EVM gas costs.  Eg, to compare the approximation strategies on the same trace:
+#   python usm_gas.py usm_constproduct trace.txt --compare
+# These are estimates, not a port: a Solidity version would be structured differently.  But the counts come from the same code paths, so they compare strategies fairly.
+
+GAS_COSTS = {
+    'add':          3,                                      # ADD/SUB, and shifts (SHL/SHR)
+    'mul':          5,                                      # MUL (a fixed-point multiply is really a MUL and a DIV, but the DIV is counted separately in the model's own code)
+    'div':          5,                                      # DIV/MOD
+    'exp':          2500,                                   # A fractional or variable power (eg, x ** (0.5 ** y)): no single EVM op, so this is a ballpark for a fixed-point log2/exp2 library call
+    'sload_cold':   2100,                                   # First read of a storage variable within an op (EIP-2929)
+    'sload_warm':   100,                                    # Later reads of the same variable
+    'sstore':       5000,                                   # First write of a storage variable within an op
+    'sstore_warm':  100,                                    # Later writes of the same variable
+    'call':         40,                                     # Internal function call: jumps plus stack shuffling
+}
+
+BOOKKEEPING = {'fork', 'commit', 'rollback', 'transaction', 'save_for_rollback', 'save_holding_for_rollback',
+               'decayed', 'cached', 'invalidate_prices', 'invalidate_derived_state',
+               'half_exp', 'half_exp_table'}                     # Simulation machinery, not protocol logic (on-chain the choice of approximation would be fixed, and the table constants): not traced
+
+COMMAND_OPS = {'mint': 'mint_usm', 'burn': 'burn_usm', 'fund_eth': 'create_fum_from_eth', 'fund_usm': 'create_fum_from_usm', 'defund': 'redeem_fum'}
+
+BINARY_OPS = {'+': 'add', '-': 'add', '+=': 'add', '-=': 'add', '*': 'mul', '*=': 'mul', '/': 'div', '/=': 'div', '//': 'div', '//=': 'div', '%': 'div', '%=': 'div',
+              '**': 'exp', '**=': 'exp', '<<': 'add', '>>': 'add'}
+OLD_BINARY_OPS = {'ADD': '+', 'SUBTRACT': '-', 'MULTIPLY': '*', 'TRUE_DIVIDE': '/', 'FLOOR_DIVIDE': '//', 'MODULO': '%', 'POWER': '**', 'LSHIFT': '<<', 'RSHIFT': '>>'}   # Python < 3.11
+
+def storage_variables(model):
+    return {name for name in model.STATE_VARIABLES if name.endswith(('_stored', '_timestamp')) or name in ('pool_eth', 'usm_supply', 'fum_supply', 'min_fum_buy_price_in_eth')}
+
+def classify_instructions(code, storage):
+    # {bytecode offset: what it counts as} for one function's code.  x ** 2 (a constant integer power) is really just a multiplication, so it's counted as one; any other power is an 'exp'.
+    kinds = {}
+    instructions = list(dis.get_instructions(code))
+    for i, instruction in enumerate(instructions):
+        opname, symbol = instruction.opname, None
+        if opname == 'BINARY_OP':
+            symbol = instruction.argrepr
+        elif opname.startswith(('BINARY_', 'INPLACE_')) and opname.split('_', 1)[1] in OLD_BINARY_OPS:
+            symbol = OLD_BINARY_OPS[opname.split('_', 1)[1]]
+        if symbol in BINARY_OPS:
+            kind = BINARY_OPS[symbol]
+            previous = instructions[i - 1]
+            if kind == 'exp' and previous.opname == 'LOAD_CONST' and isinstance(previous.argval, int) and previous.argval >= 1:
+                kinds[instruction.offset] = ('mul', previous.argval - 1)
+            else:
+                kinds[instruction.offset] = (kind, 1)
+        elif opname in ('LOAD_ATTR', 'LOAD_GLOBAL') and instruction.argval in storage:          # self.pool_eth, etc (state lives on the pool)
+            kinds[instruction.offset] = ('sload', instruction.argval)
+        elif opname in ('STORE_ATTR', 'STORE_GLOBAL') and instruction.argval in storage:
+            kinds[instruction.offset] = ('sstore', instruction.argval)
+    return kinds
+
+class OpProfiler:
+    """Counts what one top-level op does, via sys.settrace() opcode events on the model's own code."""
+
+    def __init__(self, model):
+        self.model = model
+        self.filename = sys.modules[type(model).__module__].__file__          # model is a pool: its code is in its class's module
+        self.storage = storage_variables(model)
+        self.classified = {}                                # code object -> classify_instructions() result
+
+    def profile(self, op, *args):
+        self.counts = collections.Counter()
+        self.slots_read, self.slots_written = set(), set()
+        self.active_frames = collections.Counter()          # function name -> number of its frames currently on the stack, to measure recursion depth
+        self.counts['recursion_depth'] = 0
+        sys.settrace(self.trace_call)
+        try:
+            result = getattr(self.model, op)(*args)
+        finally:
+            sys.settrace(None)
+        self.counts['gas'] = estimated_gas(self.counts)
+        return result, self.counts
+
+    def trace_call(self, frame, event, arg):
+        if frame.f_code.co_filename != self.filename or frame.f_code.co_name in BOOKKEEPING:
+            return None
+        code = frame.f_code
+        if code not in self.classified:
+            self.classified[code] = classify_instructions(code, self.storage)
+        self.counts['call'] += 1
+        self.active_frames[code.co_name] += 1
+        self.counts['recursion_depth'] = max(self.counts['recursion_depth'], self.active_frames[code.co_name])
+        frame.f_trace_opcodes = True
+        kinds = self.classified[code]
+
+        def trace_opcode(frame, event, arg):
+            if event == 'opcode':
+                kind = kinds.get(frame.f_lasti)
+                if kind is not None:
+                    self.count(*kind)
+            elif event == 'return':
+                self.active_frames[code.co_name] -= 1
+            return trace_opcode
+        return trace_opcode
+
+    def count(self, kind, detail):
+        if kind == 'sload':
+            self.counts['sload_warm' if detail in self.slots_read or detail in self.slots_written else 'sload_cold'] += 1
+            self.slots_read.add(detail)
+        elif kind == 'sstore':
+            self.counts['sstore_warm' if detail in self.slots_written else 'sstore'] += 1
+            self.slots_written.add(detail)
+        else:
+            self.counts[kind] += detail
+
+def estimated_gas(counts):
+    return sum(counts[kind] * cost for kind, cost in GAS_COSTS.items())
+
+def profile_trace(model, lines):
+    # Replays lines like model.replay() does, but profiles each top-level op.  Returns {op name: [counts for each successful call]}.
+    profiler = OpProfiler(model)
+    profiles = collections.defaultdict(list)
+    with contextlib.redirect_stdout(io.StringIO()):                                 # Silence the min FUM buy price messages
+        for line in lines:
+            words = line.split()
+            if not words or words[0].startswith('#'):
+                continue
+            model.prepare_for_next_command()
+            try:
+                if words[0] in COMMAND_OPS:
+                    _, counts = profiler.profile(COMMAND_OPS[words[0]], words[1], float(words[2]))
+                    profiles[COMMAND_OPS[words[0]]].append(counts)
+                else:
+                    model.apply_command(words, verbose=False)
+            except (AssertionError, ZeroDivisionError, ValueError):
+                pass
+    return profiles
+
+COLUMNS = ('add', 'mul', 'div', 'exp', 'sload_cold', 'sload_warm', 'sstore', 'sstore_warm', 'call', 'recursion_depth', 'gas')
+
+def print_profiles(title, profiles):
+    print(title)
+    print("{:<22} {:>7}".format("op", "calls") + "".join(" {:>11}".format(column) for column in COLUMNS))
+    for op in COMMAND_OPS.values():
+        if profiles.get(op):
+            averages = [sum(counts[column] for counts in profiles[op]) / len(profiles[op]) for column in COLUMNS]
+            averages[COLUMNS.index('recursion_depth')] = max(counts['recursion_depth'] for counts in profiles[op])
+            print("{:<22} {:>7,}".format(op, len(profiles[op])) + "".join(" {:>11,.1f}".format(average) for average in averages))
+    print()
+
+MODES = {'exact': {'APPROXIMATE_TO_SAVE_GAS': False}, 'tenths': {'APPROXIMATE_TO_SAVE_GAS': True, 'USE_HALF_EXP_TABLE': False},
+         'table': {'APPROXIMATE_TO_SAVE_GAS': True, 'USE_HALF_EXP_TABLE': True}}
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimate per-op on-chain costs of a model, by counting the arithmetic and storage access each op executes.")
+    parser.add_argument('model', choices=['usm', 'usm_constproduct'])
+    parser.add_argument('trace', help="commands to run, one per line, as for --replay")
+    parser.add_argument('--compare', action='store_true', help="profile the trace under each approximation mode (usm_constproduct only): exact, tenths and table")
+    args = parser.parse_args()
+
+    module = importlib.import_module(args.model)
+    if hasattr(module, 'half_exp_table'):
+        module.half_exp_table()                             # Build the table up front (on-chain it'd be constants), so the first op that uses it isn't charged for computing it
+    modes = MODES if args.compare else {'as configured': {}}
+    for mode, params in modes.items():
+        model = module.Pool(**params)
+        if hasattr(model, 'CACHE_DERIVED_STATE'):
+            model.CACHE_DERIVED_STATE = False               # On-chain there's no cache: every op recomputes what it needs
+        with open(args.trace) as trace:
+            print_profiles("{} ({}): average per op".format(args.model, mode), profile_trace(model, trace))
+
+if __name__ == '__main__':
+    main()
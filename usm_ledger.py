@@ -0,0 +1,225 @@
+import copy
+
+import numpy as np
+
+# A compact replacement for the models' usm_holdings/fum_holdings dicts, for simulations with millions of holders.  Each holder is interned to an integer ID, and their USM and FUM balances
+# live at that index in two float64 arrays, alongside two bool arrays saying whether they hold any at all (so, as in a dict, a 0 balance is still there until it's deleted).  The arrays
+# double in size as they fill up: ~18 bytes per numbered holder, vs ~200 for two dicts of floats keyed by name.  (Named holders also cost a name -> ID dict entry each, and one back.)  To switch
+# a pool over:
+#   import usm_constproduct, usm_ledger
+#   pool = usm_constproduct.Pool()
+#   ledger = usm_ledger.use_ledger(pool)
+# From then on the pool's ops read and write balances through ledger.usm/ledger.fum, which support the dict methods the models use (get(), [], del, values()), and reset_state() starts a fresh
+# empty ledger.  Holders can be named (eg 'A', as in the REPL), or just be integer IDs: an int is taken as the ID itself, so a simulation with 10M numbered accounts needs no name lookup at all.
+# But not both in one ledger, since a number could then land on a named holder's ID: the first holder added decides which, and the other kind raises TypeError.
+
+class Ledger:
+    """USM and FUM balances for every holder, by holder ID.  IDs run from 0 to size - 1.  Holders are either all named, each name interned to the next unused ID the first time it's seen, or
+    all numbered, each number being the ID itself."""
+
+    ARRAYS = ('usm_balances', 'fum_balances', 'usm_held', 'fum_held')
+
+    def __init__(self, capacity=1024):
+        self.size = 0                                                               # One more than the highest ID in use
+        self.usm_balances = np.zeros(capacity)
+        self.fum_balances = np.zeros(capacity)
+        self.usm_held = np.zeros(capacity, dtype=bool)                              # Whether each holder has a USM balance (even 0), ie is "in" usm: set by assigning one, cleared by del
+        self.fum_held = np.zeros(capacity, dtype=bool)
+        self.named = None                                                           # True once a holder's been added by name, False once one's been added by number
+        self.ids = {}                                                               # name -> ID, for holders identified by name
+        self.names = {}                                                             # ID -> name
+        self.usm = Balances(self, 'usm_balances', 'usm_held')
+        self.fum = Balances(self, 'fum_balances', 'fum_held')
+
+    @classmethod
+    def from_balances(cls, usm_balances, fum_balances, names=None, usm_held=None, fum_held=None):
+        # A ledger using the given arrays (eg, memory-mapped from a snapshot) as is, rather than copies.  They're only replaced by copies if the ledger has to grow.  names: {ID: name}, for a
+        # ledger of named holders.  usm_held/fum_held default to the nonzero balances (eg, for a version 1 snapshot, which doesn't record them).
+        ledger = cls(capacity=0)
+        ledger.usm_balances, ledger.fum_balances = usm_balances, fum_balances
+        ledger.usm_held = usm_balances != 0 if usm_held is None else usm_held
+        ledger.fum_held = fum_balances != 0 if fum_held is None else fum_held
+        ledger.size = len(usm_balances)
+        ledger.names = dict(names or {})
+        ledger.ids = {name: holder_id for holder_id, name in ledger.names.items()}
+        ledger.named = bool(ledger.names) if ledger.size else None
+        return ledger
+
+    def holder_id(self, user, create=True):
+        # The ID of user (a name or an ID), adding them to the ledger if create is set.  Returns None for a holder who isn't in the ledger, if not create.
+        holder_id = self.ids.get(user)
+        if holder_id is not None:
+            return holder_id                                                        # The usual case, checked first since the isinstance() below is comparatively slow
+        if isinstance(user, (int, np.integer)):
+            if self.named:
+                raise TypeError("This ledger's holders are named, so holder number {} can't be added or looked up".format(user))
+            if user >= self.size:
+                if not create:
+                    return None
+                self.named = False
+                self.reserve(user + 1)
+            return int(user)
+        if create:
+            if self.named is False:
+                raise TypeError("This ledger's holders are numbered, so holder {!r} can't be added".format(user))
+            self.named = True
+            holder_id = self.size
+            self.reserve(holder_id + 1)
+            self.ids[user] = holder_id
+            self.names[holder_id] = user
+        return holder_id
+
+    def holder(self, holder_id):
+        # The reverse: the name a holder was added under, or their ID if they were added by ID.
+        return self.names.get(holder_id, holder_id)
+
+    def reserve(self, size):
+        # Make IDs up to size - 1 valid, growing the arrays geometrically (so adding n holders one at a time costs O(n) copying in total, not O(n**2)):
+        if size > len(self.usm_balances):
+            capacity = max(size, 2 * len(self.usm_balances))
+            for name in self.ARRAYS:
+                array = np.zeros(capacity, dtype=getattr(self, name).dtype)
+                array[:self.size] = getattr(self, name)[:self.size]
+                setattr(self, name, array)
+        self.size = max(self.size, size)
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    def __deepcopy__(self, memo):
+        # Copies just the used part of the arrays, into arrays of the same capacity: the models deepcopy INITIAL_STATE on reset_state(), so use_ledger()'s capacity would otherwise be lost, and
+        # the ledger regrown from scratch.  (And a snapshot of STATE_VARIABLES should be independent of the live ledger.)
+        ledger = Ledger(capacity=max(len(self.usm_balances), 1))
+        memo[id(self)] = ledger
+        ledger.reserve(self.size)
+        for name in self.ARRAYS:
+            getattr(ledger, name)[:self.size] = getattr(self, name)[:self.size]
+        ledger.named, ledger.ids, ledger.names = self.named, dict(self.ids), dict(self.names)
+        return ledger
+
+class Balances:
+    """One token's balances in a Ledger, looking enough like a {holder: balance} dict for the models to use it as usm_holdings/fum_holdings.  As in a dict, a holder is in it from when
+    they're assigned a balance (even 0) until they're deleted."""
+
+    REPR_HOLDERS = 10                                                               # Holders listed by repr(), largest first, if there are more than this many
+
+    def __init__(self, ledger, array_name, held_name):
+        self.ledger = ledger
+        self.array_name = array_name
+        self.held_name = held_name
+
+    @property
+    def balances(self):
+        # The arrays are looked up each time rather than kept, since the ledger replaces them when it grows:
+        return getattr(self.ledger, self.array_name)
+
+    @property
+    def held(self):
+        return getattr(self.ledger, self.held_name)
+
+    def get(self, user, default=None):
+        # (get() and __setitem__() are what every op calls, so they skip the balances/held properties and look the arrays up directly)
+        ledger = self.ledger
+        holder_id = ledger.holder_id(user, create=False)
+        if holder_id is None or not getattr(ledger, self.held_name)[holder_id]:
+            return default
+        return float(getattr(ledger, self.array_name)[holder_id])
+
+    def __getitem__(self, user):
+        balance = self.get(user, self)                                              # self is just a sentinel meaning "not held"
+        if balance is self:
+            raise KeyError(user)
+        return balance
+
+    def __setitem__(self, user, balance):
+        ledger = self.ledger
+        holder_id = ledger.holder_id(user)
+        getattr(ledger, self.array_name)[holder_id] = balance
+        getattr(ledger, self.held_name)[holder_id] = True
+
+    def __delitem__(self, user):
+        holder_id = self.ledger.holder_id(user, create=False)
+        if holder_id is None or not self.held[holder_id]:
+            raise KeyError(user)
+        self.balances[holder_id] = 0
+        self.held[holder_id] = False
+
+    def __contains__(self, user):
+        holder_id = self.ledger.holder_id(user, create=False)
+        return holder_id is not None and bool(self.held[holder_id])
+
+    def __len__(self):
+        return int(np.count_nonzero(self.held[:self.ledger.size]))
+
+    def __iter__(self):
+        return (self.ledger.holder(int(holder_id)) for holder_id in np.flatnonzero(self.held[:self.ledger.size]))
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        # All balances, as an array (including the zeros of IDs not held, which don't affect a sum):
+        return self.balances[:self.ledger.size]
+
+    def items(self):
+        balances = self.balances
+        return ((self.ledger.holder(int(holder_id)), float(balances[holder_id])) for holder_id in np.flatnonzero(self.held[:self.ledger.size]))
+
+    def credit(self, users, amounts):
+        # Bulk update: adds amounts[i] to the balance of users[i], for every i at once.  users can be an array of IDs, or any sequence of names/IDs; amounts an array, or one amount for all.
+        # Returns the total added, so the caller can keep the model's usm_supply/fum_supply in step.
+        holder_ids = self.holder_ids(users)
+        amounts = np.broadcast_to(np.asarray(amounts, dtype=float), holder_ids.shape)
+        np.add.at(self.balances, holder_ids, amounts)                               # Unlike balances[holder_ids] += amounts, this adds every amount even when a holder is listed twice
+        self.held[holder_ids] = True
+        return float(amounts.sum())
+
+    def debit(self, users, amounts):
+        # The reverse, refusing (and changing nothing) if it would leave anyone with a negative balance:
+        holder_ids = self.holder_ids(users)
+        amounts = np.broadcast_to(np.asarray(amounts, dtype=float), holder_ids.shape)
+        np.subtract.at(self.balances, holder_ids, amounts)
+        if (self.balances[holder_ids] < 0).any():
+            np.add.at(self.balances, holder_ids, amounts)
+            raise AssertionError("Debit would leave {:,} holders with a negative balance".format(int(np.count_nonzero(self.balances[holder_ids] - amounts < 0))))
+        self.held[holder_ids] = True                                                # (Only matters for 0 amounts: anyone else debited must have had a balance already)
+        return float(amounts.sum())
+
+    def holder_ids(self, users):
+        if isinstance(users, np.ndarray) and np.issubdtype(users.dtype, np.integer):
+            if len(users) > 0:
+                if self.ledger.named:
+                    raise TypeError("This ledger's holders are named, so holders can't be added or looked up by number")
+                self.ledger.named = False
+                self.ledger.reserve(int(users.max()) + 1)
+            return users
+        return np.array([self.ledger.holder_id(user) for user in users], dtype=np.int64)
+
+    def top(self, n):
+        # The n largest holders, as [(holder, balance), ...], largest first.  O(size), via a partial sort, rather than sorting every balance:
+        balances = np.where(self.held[:self.ledger.size], self.balances[:self.ledger.size], -np.inf)
+        n = min(n, len(balances))
+        if n == 0:
+            return []
+        top_ids = np.argpartition(-balances, n - 1)[:n]                            # (Selecting the n smallest of -balances, rather than the n largest of balances, stays fast when most balances are equal)
+        top_ids = top_ids[np.argsort(balances[top_ids])[::-1]]
+        return [(self.ledger.holder(int(holder_id)), float(balances[holder_id])) for holder_id in top_ids if balances[holder_id] != -np.inf]
+
+    def __repr__(self):
+        # Like a dict's repr for a few holders, but for millions just the largest, so status_summary() doesn't try to print them all:
+        count = len(self)
+        if count <= self.REPR_HOLDERS:
+            return repr(dict(self.items()))
+        return "{{{}, ... ({:,} holders)}}".format(", ".join("{!r}: {!r}".format(holder, balance) for holder, balance in self.top(self.REPR_HOLDERS)), count)
+
+    def __deepcopy__(self, memo):
+        return Balances(copy.deepcopy(self.ledger, memo), self.array_name, self.held_name)
+
+def use_ledger(model, capacity=1024):
+    # Switches model (a usm.Pool or usm_constproduct.Pool) from holdings dicts to a Ledger, starting from a fresh state: after this, its reset_state() gives an empty ledger rather than empty
+    # dicts.  Only this pool: it gets an INITIAL_STATE of its own, rather than changing its class's.  Single ops run ~20-30% slower than with dicts (each balance is a NumPy scalar access), so this
+    # only pays off when the memory does: millions of holders.
+    ledger = Ledger(capacity)
+    model.INITIAL_STATE = dict(model.INITIAL_STATE, usm_holdings=ledger.usm, fum_holdings=ledger.fum)
+    model.reset_state()
+    return model.usm_holdings.ledger
@@ -0,0 +1,57 @@
+import math
+
+# Model-independent views of the pool state, so that tools can run against either usm.py (flat fees) or usm_constproduct.py (sliding prices).  model is a pool of either: a usm.Pool or a
+# usm_constproduct.Pool.
+
+def is_constproduct(model):
+    return hasattr(model, 'calc_eth_price')
+
+def model_name(model):
+    # 'usm' or 'usm_constproduct': the module the pool's class is from.
+    return type(model).__module__
+
+def eth_mid_price(model):
+    return model.calc_eth_price(model.MID) if is_constproduct(model) else model.eth_price
+
+def fum_mid_price(model):
+    # The FUM price before fees/adjustments, ie buffer_value() / fum_outstanding() (NaN if there are no FUM yet):
+    return model.calc_fum_price(model.MID) if is_constproduct(model) else model.fum_price(model.THEORETICAL)
+
+def usm_bid_ask(model):
+    # (sell, buy) prices of 1 USM, in USD.  usm.py has no USM price as such, just fees, so there it's what a burn pays out and a mint costs, per USM:
+    if is_constproduct(model):
+        return model.calc_usm_price(model.SELL), model.calc_usm_price(model.BUY)
+    return 1 - model.USM_BURN_FEE, 1 / (1 - model.USM_MINT_FEE)
+
+def fum_bid_ask(model):
+    if is_constproduct(model):
+        return model.calc_fum_price(model.SELL), model.calc_fum_price(model.BUY)
+    return model.fum_price(model.SELL), model.fum_price(model.BUY)
+
+def adjustment_factors(model):
+    # (mint/burn, fund/defund) adjustments: always 1 for usm.py, which charges flat fees instead.
+    if is_constproduct(model):
+        return model.mint_burn_adjustment(), model.fund_defund_adjustment()
+    return 1, 1
+
+def min_fum_buy_price_in_eth(model):
+    return model.min_fum_buy_price_in_eth() if is_constproduct(model) else model.min_fum_buy_price_in_eth
+
+def sim_time(model):
+    return model.time if is_constproduct(model) else 0                      # usm.py has no clock
+
+def fee_revenue(command, amount, result, eth_mid_price, fum_mid_price):
+    # Value (in USD) the pool kept from one command, measured at the mid prices from just before it: what the user paid in, minus what they got out.  For usm.py this is just the fee; for
+    # usm_constproduct.py it's whatever the sliding prices and adjustments charged.  amount is the command's input, result its output (eg, for "mint A 10", amount = 10 ETH, result = USM minted).
+    if command == 'mint':
+        return amount * eth_mid_price - result
+    elif command == 'burn':
+        return amount - result * eth_mid_price
+    elif command == 'fund_eth':
+        return amount * eth_mid_price - result * fum_mid_price if not math.isnan(fum_mid_price) else 0      # The very first FUM have no mid price to charge against
+    elif command == 'fund_usm':
+        return amount - result * fum_mid_price if not math.isnan(fum_mid_price) else 0
+    elif command == 'defund':
+        return amount * fum_mid_price - result * eth_mid_price
+    else:
+        return 0
@@ -0,0 +1,184 @@
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import struct
+import sys
+
+import numpy as np
+
+import usm_metrics
+
+# Records the path of the pool's metrics over a simulation, as numbers rather than status_summary() strings.  Each sample is written into a preallocated in-memory chunk (one row per
+# sample, one array per metric), and each full chunk is appended to the output file, so memory stays bounded however long the run.  Eg:
+#   python usm_recorder.py record usm_constproduct trace.txt run.rec --every 10
+#   python usm_recorder.py downsample run.rec run_coarse.rec 100 --how last
+# Or from any loop that drives a model: recorder = Recorder(model, 'run.rec'); call recorder.record() after each command, and recorder.close() at the end; load('run.rec') then gives
+# {column: array}.
+# File format (version 1): MAGIC, then FORMAT_VERSION and the length of a JSON list of column names, as little-endian uint32s, then that list, padded to a multiple of 8 bytes; then chunks,
+# each a little-endian uint64 row count n, followed by each column's n float64s in turn.
+
+MAGIC = b'USMREC\0\0'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sII')
+CHUNK_HEADER = struct.Struct('<Q')
+
+COLUMNS = ('step', 'time', 'pool_eth', 'eth_price', 'pool_value', 'buffer_value', 'debt_ratio', 'usm_supply', 'fum_supply', 'usm_bid', 'usm_ask', 'fum_bid', 'fum_ask',
+           'mint_burn_adjustment', 'fund_defund_adjustment', 'min_fum_buy_price_in_eth')
+
+def sample(model, step):
+    # One row of COLUMNS, for the model's current state:
+    return ((step, usm_metrics.sim_time(model), model.pool_eth, usm_metrics.eth_mid_price(model), model.pool_value(), model.buffer_value(), model.debt_ratio(), model.usm_outstanding(),
+             model.fum_outstanding()) + usm_metrics.usm_bid_ask(model) + usm_metrics.fum_bid_ask(model) + usm_metrics.adjustment_factors(model)
+            + (usm_metrics.min_fum_buy_price_in_eth(model),))
+
+class Recorder:
+    """Samples COLUMNS from model every every_steps calls to record(), or (usm_constproduct.py only) every every_seconds of simulated time, whichever is given, into chunks of chunk_rows
+    rows that are appended to path as they fill."""
+
+    def __init__(self, model, path, every_steps=1, every_seconds=None, chunk_rows=65536):
+        if every_seconds is not None and not usm_metrics.is_constproduct(model):
+            raise ValueError("Can't sample every {} seconds of a {} pool: it has no clock".format(every_seconds, usm_metrics.model_name(model)))
+        self.model = model
+        self.every_steps = every_steps
+        self.every_seconds = every_seconds
+        self.chunk = np.empty((len(COLUMNS), chunk_rows))                          # Column-major, so each column's values for the chunk are contiguous, as they're written to disk
+        self.rows = 0                                                               # Rows of self.chunk filled so far
+        self.step = 0
+        self.next_sample_step = 0
+        self.next_sample_time = -np.inf
+        self.file = open(path, 'wb')
+        column_names = json.dumps(COLUMNS).encode()
+        self.file.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(column_names)))
+        self.file.write(column_names)
+        self.file.write(b'\0' * (-self.file.tell() % 8))
+
+    def record(self):
+        # Call after every command.  Cheap when no sample is due: just a counter and a comparison (or two).
+        step = self.step
+        self.step += 1
+        if self.every_seconds is None:
+            if step < self.next_sample_step:
+                return
+            self.next_sample_step = step + self.every_steps
+        else:
+            time = self.model.time
+            if time < self.next_sample_time:
+                return
+            self.next_sample_time = time + self.every_seconds
+        self.chunk[:, self.rows] = sample(self.model, step)
+        self.rows += 1
+        if self.rows == self.chunk.shape[1]:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.file.write(CHUNK_HEADER.pack(self.rows))
+            self.file.write(self.chunk[:, :self.rows].astype('<f8').tobytes())       # (Slicing the rows of each column makes this a copy, so write it in one go)
+            self.rows = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_chunks(path):
+    # Yields each chunk of a recording as {column: array}, reading one at a time, so a long recording can be processed in bounded memory.
+    with open(path, 'rb') as recording:
+        magic, version, names_length = HEADER.unpack(recording.read(HEADER.size))
+        assert magic == MAGIC, "{} is not a USM metrics recording".format(path)
+        assert version == FORMAT_VERSION, "{} is a version {} recording: only version {} is supported".format(path, version, FORMAT_VERSION)
+        columns = json.loads(recording.read(names_length))
+        recording.read(-(HEADER.size + names_length) % 8)
+        while True:
+            chunk_header = recording.read(CHUNK_HEADER.size)
+            if len(chunk_header) < CHUNK_HEADER.size:
+                break
+            rows, = CHUNK_HEADER.unpack(chunk_header)
+            values = np.frombuffer(recording.read(8 * rows * len(columns)), dtype='<f8').reshape(len(columns), rows)
+            yield dict(zip(columns, values))
+
+def load(path):
+    # The whole recording, as {column: array}.
+    chunks = list(read_chunks(path))
+    return {column: np.concatenate([chunk[column] for chunk in chunks]) if chunks else np.zeros(0) for column in COLUMNS}
+
+DOWNSAMPLERS = {'last': lambda buckets: buckets[:, -1], 'first': lambda buckets: buckets[:, 0], 'mean': lambda buckets: buckets.mean(axis=1),
+                'min': lambda buckets: buckets.min(axis=1), 'max': lambda buckets: buckets.max(axis=1)}
+
+def downsample(data, factor, how='last'):
+    # Reduces {column: array} by factor, combining each run of factor rows into one with DOWNSAMPLERS[how] ('last' keeps the value at the end of each bucket, as a price chart would; 'max'
+    # eg gives the peak debt ratio in each).  step and time always take the bucket's last value.  A final partial bucket is dropped.
+    reduce = DOWNSAMPLERS[how]
+    downsampled = {}
+    for column, values in data.items():
+        buckets = values[:len(values) // factor * factor].reshape(-1, factor)
+        downsampled[column] = buckets[:, -1] if column in ('step', 'time') else reduce(buckets)
+    return downsampled
+
+def downsample_file(source_path, destination_path, factor, how='last'):
+    # downsample() for a recording too long to load: streams it chunk by chunk, as it was recorded (so memory is bounded by the Recorder's chunk_rows), carrying any leftover rows (less than a
+    # bucket) over to the next chunk.
+    with open(destination_path, 'wb') as destination:
+        column_names = json.dumps(COLUMNS).encode()
+        destination.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(column_names)) + column_names)
+        destination.write(b'\0' * (-destination.tell() % 8))
+        leftover = None
+        for chunk in read_chunks(source_path):
+            if leftover is not None:
+                chunk = {column: np.concatenate([leftover[column], chunk[column]]) for column in COLUMNS}
+            usable = len(chunk['step']) // factor * factor
+            leftover = {column: values[usable:] for column, values in chunk.items()}
+            if usable:
+                downsampled = downsample({column: values[:usable] for column, values in chunk.items()}, factor, how)
+                destination.write(CHUNK_HEADER.pack(usable // factor))
+                destination.write(np.stack([downsampled[column] for column in COLUMNS]).astype('<f8').tobytes())
+
+def record_trace(model, trace_path, recording_path, every_steps=1, every_seconds=None):
+    # Replays a trace like model.replay() does (without its printing), recording as it goes.
+    with Recorder(model, recording_path, every_steps, every_seconds) as recorder, open(trace_path) as trace, contextlib.redirect_stdout(io.StringIO()):
+        for line in trace:
+            words = line.split()
+            if not words or words[0].startswith('#'):
+                continue
+            model.prepare_for_next_command()
+            try:
+                model.apply_command(words, verbose=False)
+            except Exception:
+                pass
+            recorder.record()
+        model.prepare_for_next_command()
+    return recorder.step
+
+def main():
+    parser = argparse.ArgumentParser(description="Record a model's metrics over a trace to a columnar file, or downsample a recording.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    record_parser = subparsers.add_parser('record', help="replay a trace, recording metrics")
+    record_parser.add_argument('model', choices=['usm', 'usm_constproduct'])
+    record_parser.add_argument('trace')
+    record_parser.add_argument('recording')
+    record_parser.add_argument('--every', type=int, default=1, metavar='N', help="sample every N commands")
+    record_parser.add_argument('--every-seconds', type=float, metavar='S', help="sample every S seconds of simulated time instead (usm_constproduct only)")
+    downsample_parser = subparsers.add_parser('downsample', help="reduce a recording by a factor")
+    downsample_parser.add_argument('recording')
+    downsample_parser.add_argument('output')
+    downsample_parser.add_argument('factor', type=int)
+    downsample_parser.add_argument('--how', choices=sorted(DOWNSAMPLERS), default='last')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        if args.every_seconds is not None and args.model != 'usm_constproduct':
+            record_parser.error("--every-seconds needs simulated time, which only usm_constproduct has: use --every for {}".format(args.model))
+        steps = record_trace(importlib.import_module(args.model).Pool(), args.trace, args.recording, args.every, args.every_seconds)
+        print("Recorded {:,} commands to {}.".format(steps, args.recording), file=sys.stderr)
+    else:
+        downsample_file(args.recording, args.output, args.factor, args.how)
+
+if __name__ == '__main__':
+    main()
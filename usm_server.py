@@ -0,0 +1,286 @@
+import argparse
+import asyncio
+import collections
+import importlib
+import json
+import random
+import sys
+from time import perf_counter
+
+import numpy as np
+
+import usm_feed
+import usm_metrics
+import usm_recorder
+
+# Runs a model as a long-lived local service: JSON lines over TCP, one request per line, eg {"id": 1, "op": "mint", "user": "A", "amount": 10}, answered with {"id": 1, "result": ...} or
+# {"id": 1, "error": "..."}.  Ops:
+#   quote   {"kind": "mint"/"burn"/"fund_eth"/"fund_usm"/"defund", "amount": x} -> {"output", "price", "debt_ratio", "rejected"}, from the model's quote_*() functions
+#   mint, burn, fund, defund   {"user", "amount"} -> the op's result; fund takes ETH, or USM with "from": "usm"
+#   status  -> the pool's metrics, as recorded by usm_recorder (debt ratio, prices, adjustments, etc)
+# Every state change - ops, and price updates from the oracle - goes through one writer task, one at a time.  Quotes and status never change the state, and since each op runs to completion
+# without yielding to the event loop, they always see the state between two writes: so they're answered straight away, concurrently with the writes queued up.  Identical quotes against the
+# same state (ie, between the same two writes) are only computed once, and all the distinct quotes requested in one pass of the event loop are computed together, one vectorized call per kind.
+# Eg:
+#   python usm_server.py serve --port 8765 --oracle random
+#   python usm_server.py loadtest --port 8765 --clients 50 --requests 200
+
+OPS = {'mint': 'mint_usm', 'burn': 'burn_usm', 'fund': 'create_fum_from_eth', 'fund_usm': 'create_fum_from_usm', 'defund': 'redeem_fum'}
+QUOTES = {'mint': 'quote_mint_usm', 'burn': 'quote_burn_usm', 'fund_eth': 'quote_create_fum_from_eth', 'fund_usm': 'quote_create_fum_from_usm', 'defund': 'quote_redeem_fum'}
+
+class RandomWalkOracle:
+    """Stand-in for a real oracle: every interval seconds, moves the ETH price by a random factor (lognormal, with the given volatility per tick), and pushes it to the server."""
+
+    def __init__(self, price=200, spread=0.002, volatility=0.001, interval=1.0, seed=None):
+        self.price, self.spread, self.volatility, self.interval = price, spread, volatility, interval
+        self.rng = random.Random(seed)
+
+    async def ticks(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.price *= self.rng.lognormvariate(0, self.volatility)
+            yield self.price, self.price * (1 + self.spread)
+
+class FeedOracle:
+    """Plays back a tick file (see usm_feed.py), one tick every interval seconds."""
+
+    def __init__(self, path, interval=1.0):
+        self.path, self.interval = path, interval
+
+    async def ticks(self):
+        for _, sell_price, buy_price in usm_feed.read_ticks(self.path):
+            await asyncio.sleep(self.interval)
+            yield sell_price, buy_price
+
+class Server:
+    def __init__(self, model, oracle=None):
+        self.model = model
+        self.oracle = oracle
+        self.constproduct = usm_metrics.is_constproduct(model)
+        self.writes = asyncio.Queue()                                               # (callable, future) for the writer task to apply, in order
+        self.version = 0                                                            # Bumped by every write: quotes are cached per version
+        self.quote_cache = {}                                                       # (kind, amount) -> quote result, for the current version
+        self.pending_quotes = collections.defaultdict(list)                         # (kind, amount) -> futures waiting for it, until the next batch is computed
+        self.counts = collections.Counter()
+        self.start_time = None
+
+    async def run(self, host, port):
+        self.start_time = asyncio.get_running_loop().time()
+        self.start_sim_time = self.model.time if self.constproduct else 0
+        tasks = [asyncio.create_task(self.writer())]
+        if self.oracle is not None:
+            tasks.append(asyncio.create_task(self.feed_oracle()))
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print("Serving {} on {}:{}".format(usm_metrics.model_name(self.model), host, port), file=sys.stderr)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    # ________________________________________ Writes ________________________________________
+
+    async def writer(self):
+        while True:
+            write, future = await self.writes.get()
+            try:                                                                    # All inside the try: if this task died, every write after it (and its client) would hang
+                if self.constproduct:
+                    sim_time = self.start_sim_time + (asyncio.get_running_loop().time() - self.start_time)   # The model's clock follows the wall clock, so adjustments decay in real time
+                    if sim_time > self.model.time:
+                        self.model.set_time(sim_time)
+                self.model.prepare_for_next_command()
+                result = write()
+            except Exception as err:
+                if not future.done():
+                    future.set_exception(err)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            self.version += 1
+            self.quote_cache.clear()
+
+    def write(self, write):
+        future = asyncio.get_running_loop().create_future()
+        self.writes.put_nowait((write, future))
+        return future
+
+    async def feed_oracle(self):
+        async for sell_price, buy_price in self.oracle.ticks():
+            if self.constproduct:
+                await self.write(lambda: self.model.set_oracle_eth_price(sell_price, buy_price))
+            else:
+                await self.write(lambda: self.model.change_eth_price((sell_price + buy_price) / 2))
+            self.counts['ticks'] += 1
+
+    # ________________________________________ Reads ________________________________________
+
+    def quote(self, kind, amount):
+        key = (kind, amount)
+        if key in self.quote_cache:
+            self.counts['quotes_cached'] += 1
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(self.quote_cache[key])
+            return future
+        future = asyncio.get_running_loop().create_future()
+        if not self.pending_quotes:
+            asyncio.get_running_loop().call_soon(self.compute_quotes)                # Once this pass of the event loop has gathered every quote request it's going to
+        elif key in self.pending_quotes:
+            self.counts['quotes_coalesced'] += 1
+        self.pending_quotes[key].append(future)
+        return future
+
+    def compute_quotes(self):
+        pending, self.pending_quotes = self.pending_quotes, collections.defaultdict(list)
+        by_kind = collections.defaultdict(list)
+        for kind, amount in pending:
+            by_kind[kind].append(amount)
+        for kind, amounts in by_kind.items():
+            try:
+                quote = getattr(self.model, QUOTES[kind])(np.array(amounts))
+            except Exception as err:
+                # This runs as a call_soon() callback, so an exception here would just be logged by the event loop, leaving every client waiting on this batch hanging: fail this kind's
+                # requests instead, and carry on with the other kinds.
+                for amount in amounts:
+                    for future in pending[(kind, amount)]:
+                        if not future.done():
+                            future.set_exception(err)
+                continue
+            self.counts['quote_batches'] += 1
+            for i, amount in enumerate(amounts):
+                result = {'output': float(quote.output[i]), 'price': float(quote.price[i]), 'debt_ratio': float(quote.debt_ratio[i]), 'rejected': bool(quote.rejected[i])}
+                self.quote_cache[(kind, amount)] = result
+                for future in pending[(kind, amount)]:
+                    if not future.done():
+                        future.set_result(result)
+
+    def status(self):
+        row = usm_recorder.sample(self.model, self.version)
+        return dict(zip(usm_recorder.COLUMNS, (float(value) for value in row)))
+
+    # ________________________________________ Protocol ________________________________________
+
+    async def handle_connection(self, reader, writer):
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while line := await reader.readline():
+                task = asyncio.create_task(self.respond(line, writer, write_lock))
+                tasks.add(task)                                                     # Requests on one connection can be pipelined: each is answered when it's done, tagged with its id
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        finally:
+            writer.close()
+
+    async def respond(self, line, writer, write_lock):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            response = {'id': request_id, 'result': await self.handle(request)}
+        except Exception as err:
+            response = {'id': request_id, 'error': "{}: {}".format(type(err).__name__, err)}
+        async with write_lock:
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+
+    async def handle(self, request):
+        op = request['op']
+        self.counts[op] += 1
+        if op == 'quote':
+            if request['kind'] not in QUOTES:
+                raise ValueError("Unknown quote kind {!r}".format(request['kind']))         # Checked here, so it's reported to this client rather than failing the whole batch
+            return await self.quote(request['kind'], float(request['amount']))
+        elif op == 'status':
+            return self.status()
+        elif op in OPS:
+            if op == 'fund' and request.get('from') == 'usm':
+                op = 'fund_usm'
+            model_op, user, amount = getattr(self.model, OPS[op]), str(request['user']), float(request['amount'])
+            return await self.write(lambda: model_op(user, amount))
+        else:
+            raise ValueError("Unknown op {!r}".format(op))
+
+# ________________________________________ Load test ________________________________________
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+async def load_test_client(host, port, requests, mix, latencies, errors, rng):
+    reader, writer = await asyncio.open_connection(host, port)
+    ops, weights = zip(*mix.items())
+    user = 'client{}'.format(rng.randrange(10**6))
+    try:
+        for request_id in range(requests):
+            op = rng.choices(ops, weights)[0]
+            if op == 'quote':
+                request = {'op': 'quote', 'kind': rng.choice(sorted(QUOTES)), 'amount': rng.choice([0.1, 1, 10, 100, 1000])}  # A few round sizes, as real clients tend to ask for
+            elif op == 'status':
+                request = {'op': 'status'}
+            else:
+                request = {'op': op, 'user': user, 'amount': {'mint': 1, 'burn': 10, 'fund': 1, 'defund': 1}[op]}
+            request['id'] = request_id
+            start = perf_counter()
+            writer.write(json.dumps(request).encode() + b'\n')
+            await writer.drain()
+            response = json.loads(await reader.readline())
+            latencies[op].append(perf_counter() - start)
+            if 'error' in response:
+                errors[op] += 1
+    finally:
+        writer.close()
+
+async def load_test(host, port, clients, requests, mix, seed):
+    # Runs clients concurrent connections, each sending requests requests one after another (waiting for each answer), and reports latency percentiles and overall throughput.
+    latencies, errors = collections.defaultdict(list), collections.Counter()
+    rng = random.Random(seed)
+    start = perf_counter()
+    await asyncio.gather(*(load_test_client(host, port, requests, mix, latencies, errors, random.Random(rng.random())) for _ in range(clients)))
+    elapsed = perf_counter() - start
+    print("{:<8} {:>9} {:>8} {:>10} {:>10} {:>10}".format("op", "requests", "errors", "p50 ms", "p99 ms", "max ms"))
+    for op in sorted(latencies) + ['all']:
+        values = sorted(sum(latencies.values(), []) if op == 'all' else latencies[op])
+        print("{:<8} {:>9,} {:>8,} {:>10.3f} {:>10.3f} {:>10.3f}".format(op, len(values), sum(errors.values()) if op == 'all' else errors[op],
+                                                                          percentile(values, 0.5) * 1000, percentile(values, 0.99) * 1000, values[-1] * 1000))
+    print("{:,} requests in {:.3f}s = {:,.0f} requests/sec".format(clients * requests, elapsed, clients * requests / elapsed))
+
+def parse_mix(spec):
+    # "quote=0.8,mint=0.1,burn=0.1" -> {'quote': 0.8, 'mint': 0.1, 'burn': 0.1}
+    return {op: float(weight) for op, weight in (item.split('=') for item in spec.split(','))}
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a model over JSON-lines TCP, or load-test such a server.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve')
+    serve_parser.add_argument('--model', choices=['usm', 'usm_constproduct'], default='usm_constproduct')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8765)
+    serve_parser.add_argument('--oracle', default='random', help="'random' (a random walk), a tick file to play back (see usm_feed.py), or 'none'")
+    serve_parser.add_argument('--tick-interval', type=float, default=1.0, metavar='SECONDS')
+    serve_parser.add_argument('--seed', type=int)
+    loadtest_parser = subparsers.add_parser('loadtest')
+    loadtest_parser.add_argument('--host', default='127.0.0.1')
+    loadtest_parser.add_argument('--port', type=int, default=8765)
+    loadtest_parser.add_argument('--clients', type=int, default=50)
+    loadtest_parser.add_argument('--requests', type=int, default=200, help="per client")
+    loadtest_parser.add_argument('--mix', type=parse_mix, default=parse_mix('quote=0.8,status=0.05,mint=0.05,fund=0.04,burn=0.03,defund=0.03'), help="ops and their weights")
+    loadtest_parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        model = importlib.import_module(args.model).Pool()
+        if args.oracle == 'none':
+            oracle = None
+        elif args.oracle == 'random':
+            oracle = RandomWalkOracle(interval=args.tick_interval, seed=args.seed)
+        else:
+            oracle = FeedOracle(args.oracle, args.tick_interval)
+        try:
+            asyncio.run(Server(model, oracle).run(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+    else:
+        asyncio.run(load_test(args.host, args.port, args.clients, args.requests, args.mix, args.seed))
+
+if __name__ == '__main__':
+    main()
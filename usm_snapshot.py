@@ -0,0 +1,123 @@
+import argparse
+import importlib
+import json
+import os
+import struct
+import sys
+from time import perf_counter
+
+import numpy as np
+
+import usm_ledger
+import usm_metrics
+
+# Saves a model's full state (every name in its STATE_VARIABLES) to a binary snapshot file, and restores it, so a long simulation can be checkpointed and resumed - or many workers can start
+# from the same state - without replaying everything from the start.  The format (version 2) is:
+#   header:     MAGIC, then FORMAT_VERSION and the length of the metadata, as little-endian uint32s
+#   metadata:   JSON: the model's name, its scalar state variables, the holder count n, and the names of any named holders ({ID: name})
+#   padding:    to a multiple of 8 bytes
+#   balances:   n little-endian float64 USM balances, by holder ID, then n FUM balances
+#   held:       n bytes, 1 for each holder who holds USM (even a 0 balance, as a holdings dict can) and 0 for the rest, then the same for FUM
+# Version 1 snapshots, which have no held flags, still restore, taking every nonzero balance as held.  Restoring memory-maps the balances rather than reading them, so a state with millions of holders loads in milliseconds, and processes restoring the same file share its pages.  Eg:
+#   python usm_snapshot.py usm_constproduct --replay warmup.txt --save warm.snap
+#   python usm_snapshot.py usm_constproduct --restore warm.snap --replay scenario.txt
+
+MAGIC = b'USMSNAP\0'
+FORMAT_VERSION = 2
+SUPPORTED_VERSIONS = (1, 2)
+HEADER = struct.Struct('<8sII')
+
+HOLDINGS_VARIABLES = ('usm_holdings', 'fum_holdings')
+
+def save(model, path):
+    # Works whether the model's holdings are dicts or a usm_ledger.Ledger: dicts are laid out by first appearance, USM holders then FUM holders.
+    if isinstance(model.usm_holdings, usm_ledger.Balances):
+        ledger = model.usm_holdings.ledger
+    else:
+        ledger = usm_ledger.Ledger()
+        for name in HOLDINGS_VARIABLES:
+            holdings = getattr(ledger, name[:3])
+            for user, balance in getattr(model, name).items():
+                holdings[user] = balance
+    metadata = {'model': usm_metrics.model_name(model), 'holders': ledger.size, 'names': ledger.names,
+                'scalars': {name: getattr(model, name) for name in model.STATE_VARIABLES if name not in HOLDINGS_VARIABLES}}
+    metadata_bytes = json.dumps(metadata).encode()
+    # Written to a temporary file, then moved over path: the balances may be memory-mapped from path itself (restore() then save() to the same file), and truncating it would empty them
+    # mid-write.  The move also means a crash mid-save leaves the old snapshot intact.
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(temporary_path, 'wb') as snapshot:
+            snapshot.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(metadata_bytes)))
+            snapshot.write(metadata_bytes)
+            snapshot.write(b'\0' * (-snapshot.tell() % 8))
+            for balances in (ledger.usm_balances, ledger.fum_balances):
+                balances[:ledger.size].astype('<f8', copy=False).tofile(snapshot)
+            for held in (ledger.usm_held, ledger.fum_held):
+                held[:ledger.size].astype(np.bool_, copy=False).tofile(snapshot)
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+def load(path, mode='r'):
+    # Returns (metadata, usm_balances, fum_balances, usm_held, fum_held), all as memory-mapped arrays (the held flags are None for a version 1 snapshot).  mode is np.memmap's: 'r' for read-only (eg, workers analyzing a shared state), 'c' for
+    # copy-on-write (changes stay private to this process, and never reach the file).
+    with open(path, 'rb') as snapshot:
+        magic, version, metadata_length = HEADER.unpack(snapshot.read(HEADER.size))
+        assert magic == MAGIC, "{} is not a USM snapshot".format(path)
+        assert version in SUPPORTED_VERSIONS, "{} is a version {} snapshot: only versions {} are supported".format(path, version, SUPPORTED_VERSIONS)
+        metadata = json.loads(snapshot.read(metadata_length))
+    metadata['names'] = {int(holder_id): name for holder_id, name in metadata['names'].items()}        # JSON object keys are always strings
+    holders = metadata['holders']
+    offset = HEADER.size + metadata_length
+    offset += -offset % 8
+    if holders == 0:
+        return metadata, np.zeros(0), np.zeros(0), np.zeros(0, dtype=bool), np.zeros(0, dtype=bool)     # (np.memmap can't map 0 bytes)
+    usm_balances = np.memmap(path, dtype='<f8', mode=mode, offset=offset, shape=(holders,))
+    fum_balances = np.memmap(path, dtype='<f8', mode=mode, offset=offset + 8 * holders, shape=(holders,))
+    if version == 1:
+        return metadata, usm_balances, fum_balances, None, None
+    usm_held = np.memmap(path, dtype=np.bool_, mode=mode, offset=offset + 16 * holders, shape=(holders,))
+    fum_held = np.memmap(path, dtype=np.bool_, mode=mode, offset=offset + 17 * holders, shape=(holders,))
+    return metadata, usm_balances, fum_balances, usm_held, fum_held
+
+def restore(model, path, mode='c'):
+    # Puts model into the saved state.  Its holdings become a usm_ledger.Ledger over the memory-mapped balances (whether it was using dicts or a Ledger before); with the default
+    # copy-on-write mode, the simulation can carry on from there without changing the file.
+    metadata, usm_balances, fum_balances, usm_held, fum_held = load(path, mode)
+    assert metadata['model'] == usm_metrics.model_name(model), "{} is a snapshot of {}, not {}".format(path, metadata['model'], usm_metrics.model_name(model))
+    for name, value in metadata['scalars'].items():
+        setattr(model, name, value)
+    ledger = usm_ledger.Ledger.from_balances(usm_balances, fum_balances, metadata['names'], usm_held, fum_held)
+    model.usm_holdings, model.fum_holdings = ledger.usm, ledger.fum
+    model.forks.clear()
+    if hasattr(model, 'invalidate_derived_state'):
+        model.invalidate_derived_state()
+    return ledger
+
+def main():
+    parser = argparse.ArgumentParser(description="Save and restore model state snapshots, optionally replaying a trace in between.")
+    parser.add_argument('model', choices=['usm', 'usm_constproduct'])
+    parser.add_argument('--restore', metavar='SNAPSHOT', help="start from this snapshot, rather than the initial state")
+    parser.add_argument('--replay', metavar='TRACE', help="then apply the commands in TRACE, as for the model's own --replay")
+    parser.add_argument('--save', metavar='SNAPSHOT', help="then save the resulting state")
+    args = parser.parse_args()
+
+    model = importlib.import_module(args.model).Pool()
+    if args.restore:
+        start = perf_counter()
+        ledger = restore(model, args.restore)
+        print("Restored {:,} holders from {} in {:.3f}s.".format(ledger.size, args.restore, perf_counter() - start), file=sys.stderr)
+    if args.replay:
+        with open(args.replay) as trace:
+            model.replay(trace)
+    elif args.restore:
+        print(model.status_summary())
+    if args.save:
+        start = perf_counter()
+        save(model, args.save)
+        print("Saved {} in {:.3f}s.".format(args.save, perf_counter() - start), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import contextlib
+import hashlib
+import importlib
+import itertools
+import json
+import os
+import sys
+
+import usm_metrics
+
+# Runs one scenario trace (in the format usm.py/usm_constproduct.py --replay read) under every combination of a grid of protocol parameters, one process per core, eg:
+#   python usm_sweep.py usm_constproduct scenario.txt results.jsonl --param MAX_DEBT_RATIO=0.7,0.8,0.9 --param BUY_SELL_ADJUSTMENTS_HALF_LIFE=30,60,120
+# Each finished run is appended to the results file as one JSON line, so an interrupted sweep can just be rerun with the same arguments: runs already in the file are skipped.  A run only counts
+# as already done if it was for the same model and trace contents (by SHA-256), so pointing a different trace or model at an existing results file reruns everything.
+
+def parse_grid(param_specs, model_name):
+    # ["MAX_DEBT_RATIO=0.7,0.8", "USM_MINT_FEE=0.001"] -> {'MAX_DEBT_RATIO': [0.7, 0.8], 'USM_MINT_FEE': [0.001]}:
+    parameters = importlib.import_module(model_name).Pool.PARAMETERS
+    grid = {}
+    for spec in param_specs:
+        name, values = spec.split('=', 1)
+        if name not in parameters:
+            raise ValueError("{} is not a parameter of {}.Pool".format(name, model_name))
+        grid[name] = [json.loads(value) for value in values.split(',')]
+    return grid
+
+def grid_points(grid):
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+def params_key(params):
+    return json.dumps(params, sort_keys=True)
+
+def trace_hash(trace_path):
+    sha256 = hashlib.sha256()
+    with open(trace_path, 'rb') as trace:
+        for block in iter(lambda: trace.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def completed_runs(results_path, model_name, trace_sha256):
+    # params_key()s of the runs in results_path for this model and trace:
+    done = set()
+    if os.path.exists(results_path):
+        with open(results_path, 'r+') as results:
+            complete_length = 0
+            for line in iter(results.readline, ''):
+                if not line.endswith('\n'):
+                    results.truncate(complete_length)                               # A half-written last line from an interrupted sweep: drop it, and that run will just be redone
+                    break
+                row = json.loads(line)
+                if row.get('model') == model_name and row.get('trace_sha256') == trace_sha256:
+                    done.add(params_key(row['params']))
+                complete_length = results.tell()
+    return done
+
+def run_scenario(model_name, trace_path, trace_sha256, params, path_every=100):
+    # Runs in a worker process: replays the trace from scratch under params, and returns the run's metrics.
+    model = importlib.import_module(model_name).Pool(**params)
+    max_debt_ratio = model.MAX_DEBT_RATIO
+    commands = errors = steps_above_max_debt_ratio = 0
+    peak_debt_ratio = time_above_max_debt_ratio = fee_revenue = 0
+    fum_price_path = []
+    with open(trace_path) as trace, open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):     # Silence the min FUM buy price messages
+        previous_time = usm_metrics.sim_time(model)
+        previous_debt_ratio = model.debt_ratio()
+        for line in trace:
+            words = line.split()
+            if not words or words[0].startswith('#'):
+                continue
+            model.prepare_for_next_command()
+            eth_mid_price, fum_mid_price = usm_metrics.eth_mid_price(model), usm_metrics.fum_mid_price(model)
+            try:
+                result = model.apply_command(words, verbose=False)
+            except Exception:
+                errors += 1
+            else:
+                if result is not None:
+                    fee_revenue += usm_metrics.fee_revenue(words[0], float(words[2]), result, eth_mid_price, fum_mid_price)
+            commands += 1
+
+            debt_ratio, time = model.debt_ratio(), usm_metrics.sim_time(model)
+            peak_debt_ratio = max(peak_debt_ratio, debt_ratio)
+            if debt_ratio > max_debt_ratio:
+                steps_above_max_debt_ratio += 1
+            if previous_debt_ratio > max_debt_ratio:
+                time_above_max_debt_ratio += time - previous_time
+            previous_time, previous_debt_ratio = time, debt_ratio
+            if commands % path_every == 0:
+                fum_price_path.append(usm_metrics.fum_mid_price(model))
+        model.prepare_for_next_command()
+
+    return {'model': model_name, 'trace': trace_path, 'trace_sha256': trace_sha256, 'params': params, 'commands': commands, 'errors': errors, 'final_debt_ratio': model.debt_ratio(), 'max_debt_ratio': peak_debt_ratio,
+            'steps_above_max_debt_ratio': steps_above_max_debt_ratio, 'time_above_max_debt_ratio': time_above_max_debt_ratio, 'fee_revenue': fee_revenue,
+            'final_fum_price': usm_metrics.fum_mid_price(model), 'fum_price_path': fum_price_path}
+
+def sweep(model_name, trace_path, grid, results_path, workers=None, path_every=100):
+    trace_sha256 = trace_hash(trace_path)
+    done = completed_runs(results_path, model_name, trace_sha256)
+    points = grid_points(grid)
+    todo = [params for params in points if params_key(params) not in done]
+    print("{:,} grid points, {:,} already done, {:,} to run.".format(len(points), len(points) - len(todo), len(todo)))
+    with open(results_path, 'a') as results, ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_scenario, model_name, trace_path, trace_sha256, params, path_every) for params in todo]
+        try:
+            for finished, future in enumerate(as_completed(futures), 1):
+                row = future.result()
+                results.write(json.dumps(row) + '\n')                                  # One write per row, flushed right away, so an interruption loses at most the runs in flight
+                results.flush()
+                print("[{}/{}] {}: final debt ratio {:.2%}, max {:.2%}, fee revenue ${:,.2f}".format(finished, len(todo), params_key(row['params']), row['final_debt_ratio'], row['max_debt_ratio'], row['fee_revenue']))
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            print("Interrupted: rerun the same command to resume.", file=sys.stderr)
+            raise
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a scenario trace under every combination of a grid of protocol parameters, in parallel.")
+    parser.add_argument('model', choices=['usm', 'usm_constproduct'])
+    parser.add_argument('trace', help="scenario trace: one command per line, as for --replay")
+    parser.add_argument('results', help="JSON-lines results file, appended to (and resumed from, if it already exists)")
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=V1,V2,...', help="a parameter of the model's Pool and the values to try, eg MAX_DEBT_RATIO=0.7,0.8")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes (default: one per core)")
+    parser.add_argument('--path-every', type=int, default=100, metavar='N', help="record the FUM price every N commands")
+    args = parser.parse_args()
+    grid = parse_grid(args.param, args.model)
+    sweep(args.model, args.trace, grid, args.results, args.workers, args.path_every)
+
+if __name__ == '__main__':
+    main()